@@ -2,7 +2,7 @@ from bokeh.models import HoverTool, ColumnDataSource
 from bokeh.plotting import figure
 from bokeh.io import save, output_file
 import sys
-from operator import methodcaller
+from depth_stats import read_depth_file
 
 #READ PATH TO COVERAGE_REPORT(samtools) & OUTPUT PATH
 path_to_depth_report_file, output_file_path = sys.argv[1], sys.argv[2]
@@ -34,9 +34,8 @@ def bar_plot(depth_dict):
     save(p, output_file_path)
 
 #READING SAMTOOLS REPORT TO PYTHON DICT
-with open(path_to_depth_report_file, "r+") as depth_file:
-    data_dict = dict(list(map(lambda x:list(map(int,x[1:])), list(map(methodcaller("split", "\t"), depth_file.read().split('\n')))))[:-1])
-    depth_dict = {'Genome position':list(data_dict.keys()), 'Coverage depth':list(data_dict.values())}
+positions, depths = read_depth_file(path_to_depth_report_file)
+depth_dict = {'Genome position':positions.tolist(), 'Coverage depth':depths.tolist()}
 
 #GENERATING PLOT
 bar_plot(depth_dict)
\ No newline at end of file
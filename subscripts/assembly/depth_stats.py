@@ -0,0 +1,56 @@
+'''
+Shared reader of samtools depth reports (chromosome, position, depth columns; positions with zero depth are not listed)
+and vectorized coverage statistics. Used by depth_plot.py (assembly) and pipeline_report.py (downstream).
+'''
+import os
+import numpy as np
+
+#LENGTH OF SARS-COV-2 REFERENCE GENOME (MN908947.3)
+sars_cov2_genome_length = 29903
+
+
+def read_depth_file(file_path:str, cache:bool=False):
+    '''
+    Reads position and depth columns of samtools depth report into two int32 arrays; chromosome column is not parsed.
+    If cache is set to True, arrays are stored in {file_path}.npy sidecar file and loaded from it while sidecar is newer than the report.
+    Returns tuple (positions, depths); both arrays are empty if report is empty.
+    '''
+    cache_path = f'{file_path}.npy'
+    if cache and os.path.isfile(cache_path) and os.stat(cache_path).st_mtime_ns >= os.stat(file_path).st_mtime_ns:
+        data = np.load(cache_path)
+        return data[0], data[1]
+    if os.stat(file_path).st_size == 0:
+        data = np.empty((2, 0), dtype=np.int32)
+    else:
+        data = np.loadtxt(file_path, delimiter='\t', usecols=(1, 2), dtype=np.int32, ndmin=2).T
+    if cache:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, data)
+        os.replace(tmp_path, cache_path)
+    return data[0], data[1]
+
+
+def coverage_stats(positions:np.ndarray, depths:np.ndarray, genome_length:int=sars_cov2_genome_length, thresholds:tuple=(1, 10, 20), dropout_depth:int=10, dropout_length:int=200):
+    '''
+    Given position and depth arrays of samtools depth report, returns dictionary of coverage statistics:
+    mean_depth and median_depth - over listed positions (as reported by samtools depth without -a);
+    breadth_{n}x - fraction of genome positions covered at least n times, for every n in thresholds;
+    dropout_regions - number of regions of at least dropout_length consecutive genome positions covered less than dropout_depth times (e.g. amplicon dropouts).
+    '''
+    genome_length = max(genome_length, int(positions.max()) if len(positions) else 0)
+    genome_depths = np.zeros(genome_length, dtype=np.int32) #DEPTH OF EVERY GENOME POSITION, UNLISTED POSITIONS ARE 0
+    genome_depths[positions-1] = depths
+    stats = {
+        'mean_depth':float(depths.mean()) if len(depths) else 0.0,
+        'median_depth':float(np.median(depths)) if len(depths) else 0.0,
+    }
+    stats.update({f'breadth_{threshold}x':round(float(np.count_nonzero(genome_depths >= threshold))/genome_length, 4) for threshold in thresholds})
+    low = np.concatenate(([0], (genome_depths < dropout_depth).view(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(low)) #STARTS AND ENDS OF LOW COVERAGE REGIONS
+    stats['dropout_regions'] = int(np.count_nonzero(edges[1::2]-edges[::2] >= dropout_length))
+    return stats
+
+
+def depth_file_stats(file_path:str, cache:bool=False, **kwargs):
+    '''Reads samtools depth report (see read_depth_file) and returns its coverage statistics (see coverage_stats).'''
+    return coverage_stats(*read_depth_file(file_path, cache), **kwargs)
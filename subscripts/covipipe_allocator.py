@@ -0,0 +1,78 @@
+import os, fcntl
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Processing_id_allocator:
+    '''
+    Allocates contiguous ranges of processing ids (e.g. COV000001-COV000384) for sample batches.
+    Latest used id is stored in plaintext id file; every reservation is made while holding exclusive lock on a separate lock file,
+    so assembly runs launched at the same time receive non-overlapping ranges.
+    Id file is replaced atomically and every reserved range is appended to the reservations log (batch, first id, last id, sample count, time).
+    '''
+
+    def __init__(self, id_file_path:str, lock_path:str=None, log_path:str=None):
+        self.id_file_path = id_file_path #file that contains latest used processing id
+        self.lock_path = lock_path if lock_path is not None else f'{id_file_path}.lock' #lock file is never removed, only locked
+        self.log_path = log_path if log_path is not None else f'{id_file_path}.reservations' #batch to id range records
+
+
+    @contextmanager
+    def _locked(self):
+        '''Holds exclusive lock on self.lock_path; blocks until lock held by another process is released.'''
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def next_ids(latest_id:str, count:int):
+        '''Given latest used processing id (3 letter prefix followed by 6 digit number) and number of ids, returns list of following processing ids.'''
+        return [latest_id[:3]+str(int(latest_id[3:])+i+1).zfill(6) for i in range(count)]
+
+
+    def read_latest_id(self):
+        '''Returns latest used processing id stored in self.id_file_path.'''
+        with open(self.id_file_path, 'r') as id_file: return id_file.readline().strip()
+
+
+    def _write_latest_id(self, latest_id:str):
+        '''Replaces contents of self.id_file_path with latest_id; temporary file is synced and moved over id file, so id file is never left partially written.'''
+        tmp_path = f'{self.id_file_path}.tmp'
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(latest_id)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.id_file_path)
+
+
+    def peek(self, count:int):
+        '''Returns list of count processing ids that would be reserved next, without reserving them (used when processing ids are not stored, e.g. reprocessing).'''
+        with self._locked():
+            return self.next_ids(self.read_latest_id(), count)
+
+
+    def reserve(self, count:int, batch:str):
+        '''
+        Reserves range of count processing ids for batch (e.g. output directory of the run) and returns list of reserved ids.
+        Reading latest id, updating id file and recording reservation happens under single lock.
+        '''
+        if count < 1: return []
+        with self._locked():
+            processing_id_list = self.next_ids(self.read_latest_id(), count)
+            self._write_latest_id(processing_id_list[-1])
+            with open(self.log_path, 'a') as log:
+                log.write(f"{batch}\t{processing_id_list[0]}\t{processing_id_list[-1]}\t{count}\t{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                log.flush()
+                os.fsync(log.fileno())
+        return processing_id_list
+
+
+    def read_reservations(self):
+        '''Returns list of (batch, first id, last id, sample count, time) tuples recorded in self.log_path.'''
+        if not os.path.isfile(self.log_path): return []
+        with open(self.log_path, 'r') as log:
+            return [tuple(line.rstrip("\n").split("\t")) for line in log if line.endswith("\n")]
@@ -1,7 +1,8 @@
-import re, os, pandas as pd, concurrent.futures, subprocess, sys
+import re, os, time, asyncio, pandas as pd, concurrent.futures, multiprocessing, subprocess, sys, threading
 from turtle import down
 from datetime import datetime
-from subscripts.covipipe_utilities import covipipe_housekeeper as hk
+from subscripts.covipipe_utilities import covipipe_housekeeper as hk, Rename_journal, Sample_id_map
+from subscripts.covipipe_allocator import Processing_id_allocator
 from subscripts.downstream.pipeline_report import copy_files_parallel
 from subscripts.src.modules import (
     Module, #base pipeline wrapper class
@@ -19,66 +20,112 @@ from subscripts.src.modules import (
 class Covid_assembly(Module):
     '''Class extends Module and implements pipeline-specific file processing methods'''
 
+    run_number_pattern = re.compile(r"_S[0-9]{1,3}") #illumina run sample number; removed from processing ids
+
     def __init__(self, *args, **kwargs):
         super(Covid_assembly, self).__init__(*args, **kwargs) #extending parent init method
-        self.latest_processing_id = None #latest processing id read from file
+        self.latest_processing_id = None #latest processing id used by the current batch; filled by compute_processing_ids
         self.processing_id_dict = {} #to map processing ids to original ids for the current batch of samples
+        self.sample_id_map = None #bidirectional map of original ids and ids annotated with processing ids (run number removed); filled by compute_processing_ids
         self.renamed_result_file_map = {} #to map file paths annotated with processing ids and with run id removed to the raw file paths
         self.backward_result_file_map = {} #to map file restored annotated paths to specific annotated path
         self.renamed_fastq_file_map = {} #to store original and illumina-formatted fastq file name
         self.backward_fastq_file_map = {} #storing reversed renamed_fastq_file_map to restore original fastq file names after processing
+        self.rename_journal = Rename_journal(f'{self.output_path}rename_journal.log') #write-ahead journal of all renaming steps of the run; used by recover_renames
 
-    def fill_input_dict(self, check_integrity:bool=False): #extends Module class
+    def fill_input_dict(self, check_integrity:bool=False, use_cache:bool=True, hash_content:bool=False): #extends Module class
         '''
         Extends fill_input_dict method of the Module class to run integrity check on fastq files before adding them to the input dictionary.
         The integrity check runs by-default. Set check_integrity = False to avoid it.
+        Files are checked as sample pairs: once one read file of a sample fails, the pending check of its mate is cancelled and both files are excluded.
+        Files without a mate (unpaired or not matching the sample sheet pattern) are checked on their own and listed with a MISSING mate.
+        Per-sample results are written to input_integrity_check.csv in the self.output_path.
+        Files that passed the check are recorded in input_integrity_check.cache in the self.output_path by their stat fingerprint,
+        so that reruns only check new or changed files. Set use_cache = False to check all files, set hash_content = True to also compare sampled content hashes.
         '''
         super(Covid_assembly, self).fill_input_dict() #running fill_input_dict of Module class - input_dict is filled by all fastq files found in folders and subfolders of input dir
         
         if check_integrity:
             fastq_total_count = len(self.input_dict["001.fastq.gz"]) #count total fastq found
             print(f"Performing fastq file integrity check:\n{fastq_total_count} total fastq files.") #announcing to the terminal
-            failed_log_list = [] #to store data about fastq that failed integrity test
-            with concurrent.futures.ProcessPoolExecutor() as executor: #using multiprocessing to speed-up (one check takes about 2.3 sec which translates to about 30 min for 384 nextseq batch using single thread)
-                    results = [executor.submit(hk.check_fastq_integrity, fastq) for fastq in self.input_dict["001.fastq.gz"]] #submitting function calls to different processes
-                    processed_count = 0 #counter for processed samples
-                    for f in concurrent.futures.as_completed(results): #collecting results from different processes
-                        result = f.result() #accessing results
-                        if not result[0]:
-                            failed_log_list.append(f'{result[1]} FAILED\n') #save result as failed to write to log later
-                            if 'R1' in result[1]: #if read 1 is corrupted
-                                self.input_dict["001.fastq.gz"].remove(result[1]) #remove from further processing
-                                self.input_dict["001.fastq.gz"].remove(result[1].replace("R1", "R2"))
-                            else: #if read 2 is corrupted
-                                self.input_dict["001.fastq.gz"].remove(result[1]) #remove from further processing
-                                self.input_dict["001.fastq.gz"].remove(result[1].replace("R2", "R1"))
-                        processed_count += 1 #counting processed files
-                        hk.printProgressBar(processed_count, fastq_total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
-            with open(f'{self.output_path}input_integrity_check.log', "w+") as logfile: #loggin failed results
-                for record in failed_log_list: logfile.write(f"{record}\n")
+            pairs = hk.create_sample_sheet(self.input_dict["001.fastq.gz"], self.patterns['sample_sheet'], mode=0) #sample_id, fq1, fq2 columns
+            cache_path = f'{self.output_path}input_integrity_check.cache'
+            verified_files = hk.read_integrity_cache(cache_path) if use_cache else {} #fingerprints of files that passed the check before
+            fingerprints = {fastq:hk.fastq_fingerprint(fastq, hash_content) for fastq in self.input_dict["001.fastq.gz"]}
+            check_table = {sample_id:{'sample_id':sample_id, 'fq1':fq1, 'fq2':fq2, 'fq1_status':'PENDING', 'fq2_status':'PENDING', 'note':''} for sample_id, fq1, fq2 in zip(pairs['sample_id'], pairs['fq1'], pairs['fq2'])}
+            paired_files = set(pairs['fq1']) | set(pairs['fq2'])
+            for fastq in self.input_dict["001.fastq.gz"]: #files left out of the sample sheet are still checked, keyed by their path
+                if fastq not in paired_files: check_table[fastq] = {'sample_id':os.path.basename(fastq), 'fq1':fastq, 'fq2':None, 'fq1_status':'PENDING', 'fq2_status':'MISSING', 'note':''}
+            excluded_samples = set() #samples where at least one file failed
+            passed_list = [] #to store fingerprints of files that passed integrity test
+            sample_futures = {sample_id:{} for sample_id in check_table} #to find pending check of the mate file
+            with concurrent.futures.ProcessPoolExecutor() as executor: #using multiprocessing to speed-up (each check streams the file in chunks, so memory usage per process is constant)
+                future_map = {}
+                for read in ['fq1', 'fq2']: #all read 1 files are queued before read 2 files, so that mates of failed files are still pending and can be cancelled
+                    for sample_id in check_table:
+                        fastq = check_table[sample_id][read]
+                        if fastq is None: continue #unpaired file
+                        if verified_files.get(fingerprints[fastq]['path']) == fingerprints[fastq]: #file is unchanged since last successful check
+                            check_table[sample_id][f'{read}_status'] = 'CACHED'
+                            continue
+                        future = executor.submit(hk.check_fastq_integrity, fastq) #submitting function calls to different processes
+                        future_map[future] = (sample_id, read)
+                        sample_futures[sample_id][read] = future
+                if len(future_map) < fastq_total_count:
+                    print(f"{fastq_total_count - len(future_map)} files are unchanged since last successful check - skipping.")
+                processed_count = 0 #counter for processed files
+                for f in concurrent.futures.as_completed(future_map): #collecting results from different processes
+                    processed_count += 1 #counting processed files
+                    hk.printProgressBar(processed_count, len(future_map), prefix = 'Progress:', suffix = 'Complete', length = 50)
+                    if f.cancelled(): continue #status was set when the check was cancelled
+                    sample_id, read = future_map[f]
+                    result = f.result() #accessing results
+                    if result[0]:
+                        check_table[sample_id][f'{read}_status'] = 'OK'
+                        passed_list.append(fingerprints[result[1]])
+                        continue
+                    check_table[sample_id][f'{read}_status'] = 'FAILED'
+                    check_table[sample_id]['note'] = result[2] #first problem found in the file
+                    excluded_samples.add(sample_id) #remove from further processing
+                    mate = 'fq2' if read == 'fq1' else 'fq1'
+                    if mate in sample_futures[sample_id] and sample_futures[sample_id][mate].cancel(): #mate check has not started yet
+                        check_table[sample_id][f'{mate}_status'] = 'CANCELLED'
+            hk.update_integrity_cache(cache_path, passed_list) #recording verified files for reruns
+            excluded_files = {check_table[sample_id][read] for sample_id in excluded_samples for read in ['fq1', 'fq2']}
+            self.input_dict["001.fastq.gz"] = [fastq for fastq in self.input_dict["001.fastq.gz"] if fastq not in excluded_files]
+            check_df = pd.DataFrame(list(check_table.values()), columns=['sample_id', 'fq1', 'fq2', 'fq1_status', 'fq2_status', 'note'])
+            check_df['passed'] = [key not in excluded_samples for key in check_table]
+            check_df.to_csv(f'{self.output_path}input_integrity_check.csv', header=True, index=False) #logging per-sample results
             print(f"Fastq integrity check complete!\n") #report completion
-            if len(failed_log_list) > 0: #if some files have failed
-                print(f"Please check {self.output_path}input_integrity_check.log for details on files that failed.")
+            if excluded_samples: #if some files have failed
+                print(f"{len(excluded_samples)} samples excluded. Please check {self.output_path}input_integrity_check.csv for details on files that failed.")
             else: #if no files failed
                 print(f"All fastq files are intact!")
                             
 
 
+    def recover_renames(self):
+        '''
+        Checks if self.rename_journal was left by an interrupted run. If it was, completes interrupted renaming steps and,
+        if fastq files were renamed to illumina format but never restored, loads the renaming maps so that original names are restored after this run.
+        '''
+        steps = self.rename_journal.recover()
+        if not steps: return
+        print(f"Recovered renaming journal of an interrupted run: {', '.join(steps)}.\n")
+        if 'fastq_forward' in steps and 'fastq_backward' not in steps: #fastq files still have illumina names
+            self.renamed_fastq_file_map.update(steps['fastq_forward']['path_map'])
+            self.backward_fastq_file_map.update({new_path:old_path for old_path, new_path in steps['fastq_forward']['path_map'].items()})
+
+
     def map_fastq_to_illumina(self):
         '''Generates illumina-format fastq file names for every fastq.gz file found in self.input_path and stores in self.renamed_fastq_file_map and self.backward_fastq_file_map'''
         fastq_path_list = hk.parse_folder(folder_pth_str=self.input_path, file_fmt_str='_[1,2].fastq.gz')
         fastq_total_count = len(fastq_path_list)
         if fastq_total_count > 0: #if non-illumina formatted samples present
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                print(f"Generating illumina format fastq file names:\n{fastq_total_count} total fastq files.") #announcing to the terminal
-                results = [executor.submit(hk.name_formatter, path) for path in fastq_path_list] #submitting function calls to different processes
-                processed_count = 0 #counter for processed samples
-                for f in concurrent.futures.as_completed(results):
-                    result = f.result()
-                    self.renamed_fastq_file_map[result[0]] = result[1]
-                    self.backward_fastq_file_map[result[1]] = result[0]
-                    processed_count += 1
-                    hk.printProgressBar(processed_count, fastq_total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            print(f"Generating illumina format fastq file names:\n{fastq_total_count} total fastq files.") #announcing to the terminal
+            forward_map, backward_map = hk.map_illumina_names(fastq_path_list, self.patterns.get('fastq_name_prefixes', []), self.patterns.get('fastq_name_suffixes', []))
+            self.renamed_fastq_file_map.update(forward_map)
+            self.backward_fastq_file_map.update(backward_map)
             print(f"Illumina name generation complete!\n") #report completion
 
     def convert_fastq_names(self, to_illumina:bool=True):
@@ -89,118 +136,65 @@ class Covid_assembly(Module):
         '''
 
         if to_illumina: #preprocessing fastq files
-            renaming_logs = []
-            fastq_total_count = len(self.renamed_fastq_file_map)
-            if fastq_total_count > 0:
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    print(f"Renaming fastq files to illumina format names:\n{fastq_total_count} total fastq files.") #announcing to the terminal
-                    results = [executor.submit(hk.renamer, path, self.renamed_fastq_file_map[path]) for path in self.renamed_fastq_file_map] #submitting function calls to different processes
-                    processed_count = 0
-
-                    for f in concurrent.futures.as_completed(results):
-                        result = f.result()
-                        renaming_logs.append(result)
-                        processed_count += 1
-                        hk.printProgressBar(processed_count, fastq_total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            if self.renamed_fastq_file_map:
+                print(f"Renaming fastq files to illumina format names:\n{len(self.renamed_fastq_file_map)} total fastq files.") #announcing to the terminal
+                hk.rename_files(self.renamed_fastq_file_map, log_path=f'{self.output_path}fastq_forward_renaming.log', journal=self.rename_journal, step='fastq_forward')
                 print(f"Fastq renaming to Illumina format finished!\n") #report completion
-                with open(f'{self.output_path}fastq_forward_renaming.log', "w+") as rename_log: #log renaming process
-                    for record in renaming_logs: rename_log.write(record)
                 
         else: #restoring names of fastq files to original
-            renaming_logs = []
-            fastq_total_count = len(self.backward_fastq_file_map)
-            if fastq_total_count > 0:
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    print(f"Restoring original (non-illumina) fastq file names:\n{fastq_total_count} total fastq files.") #announcing to the terminal
-                    results = [executor.submit(hk.renamer, path, self.backward_fastq_file_map[path]) for path in self.backward_fastq_file_map] #submitting function calls to different processes
-                    processed_count = 0
-
-                    for f in concurrent.futures.as_completed(results):
-                        result = f.result()
-                        renaming_logs.append(result)
-                        processed_count += 1
-                        hk.printProgressBar(processed_count, fastq_total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            if self.backward_fastq_file_map:
+                print(f"Restoring original (non-illumina) fastq file names:\n{len(self.backward_fastq_file_map)} total fastq files.") #announcing to the terminal
+                hk.rename_files(self.backward_fastq_file_map, log_path=f'{self.output_path}fastq_backward_renaming.log', journal=self.rename_journal, step='fastq_backward')
                 print(f"Fastq renaming to original format finished!\n") #report completion
-                with open(f'{self.output_path}fastq_backward_renaming.log', "w+") as rename_log: #log renaming process
-                    for record in renaming_logs: rename_log.write(record)
                 
 
     def restore_annotated_results(self):
         '''Checks if output directory contains annotations log file. If it is there, reads the contents and restores original name of all files according to the log.'''
         if os.path.isfile(f'{self.output_path}result_annotation.log') and os.stat(f'{self.output_path}result_annotation.log').st_size > 0:
             df = pd.read_table(f'{self.output_path}result_annotation.log', sep=" ", header=None)
-            fastq_total_count = len(df)
-            processed_count = 0
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                print(f"Removing processing id annotation from output file names for reprocessing:\n{fastq_total_count} total output files.") #announcing to the terminal
-                results = [] 
-                for i, path in enumerate(df[0]):#submitting function calls to different processes
-                    self.backward_result_file_map[str(path)] = str(df[1][i])
-                    results.append(executor.submit(hk.renamer, str(df[1][i]), str(path)))
-
-                for _ in concurrent.futures.as_completed(results):
-                    processed_count += 1
-                    hk.printProgressBar(processed_count, fastq_total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            self.backward_result_file_map = dict(zip(df[0].astype(str), df[1].astype(str))) #to reannotate results with the same processing ids after reprocessing
+            print(f"Removing processing id annotation from output file names for reprocessing:\n{len(df)} total output files.") #announcing to the terminal
+            hk.rename_files({annotated:original for original, annotated in self.backward_result_file_map.items()}, journal=self.rename_journal, step='result_restore')
             print(f"Finished removing processing ids for reprocessing!\n") #report completion
 
 
     def compute_processing_ids(self):
-        '''Calculates a range of processing ids for current batch of samples and stores it in self.processing_id_dict'''
-        self.latest_processing_id = hk.read_plaintext_file(self.config_file['latest_id_file'])[0] #reading latest id
-        processing_id_list = [self.latest_processing_id[:3]+str(int(self.latest_processing_id[3:])+i+1).zfill(6) for i in range(len(self.sample_sheet['sample_id']))] #generating processing ids
-        self.processing_id_dict = {ids[0]:f'{ids[1]}_{ids[0]}' for ids in zip(list(self.sample_sheet['sample_id']),processing_id_list)} #generating numbered ids
+        '''
+        Reserves a range of processing ids for current batch of samples and stores it in self.processing_id_dict.
+        If results are reprocessed (self.backward_result_file_map is filled), ids are only computed and the range is not reserved.
+        '''
+        allocator = Processing_id_allocator(self.config_file['latest_id_file'])
+        sample_count = len(self.sample_sheet['sample_id'])
         if not self.backward_result_file_map:
-            hk.overwrite_plaintext_file(self.config_file['latest_id_file'],processing_id_list[-1]) #updating processing id after range of ids was used 
+            processing_id_list = allocator.reserve(sample_count, batch=self.output_path) #updating processing id after range of ids was used
+        else:
+            processing_id_list = allocator.peek(sample_count)
+        self.latest_processing_id = processing_id_list[-1] if processing_id_list else allocator.read_latest_id()
+        self.processing_id_dict = {ids[0]:f'{ids[1]}_{ids[0]}' for ids in zip(list(self.sample_sheet['sample_id']),processing_id_list)} #generating numbered ids
+        self.sample_id_map = Sample_id_map.from_processing_ids(self.sample_sheet['sample_id'], processing_id_list, self.run_number_pattern) #numbered ids without run number
 
 
     def fill_output_file_maps(self):
-        '''Saves original-formatted file path pair in self.renamed_result_file_map'''
-        for file_path in self.config_file["assembly_target_files"]: #generating new file path
-            for id in self.processing_id_dict:
-                if id in file_path:
-                    new_path = re.sub(id, self.processing_id_dict[id], file_path) #adding numbered id
-                    new_path = re.sub(r"(_S[0-9]{3}|_S[0-9]{2}|_S[0-9]{1})", "", new_path) #removing illumina run sample number
-                    if 'qualimap' in file_path: #sample id in directory name and directory should be named
-                        old_path = os.path.dirname(file_path)
-                        new_path = os.path.dirname(new_path)
-                        self.renamed_result_file_map[old_path] = new_path
-                    else:
-                        self.renamed_result_file_map[file_path] = new_path #storing for forward renaming
-                    break
+        '''
+        Saves original-formatted file path pair in self.renamed_result_file_map. 
+        Target paths of each sample are generated directly from sample id and target templates (self.targets), 
+        if template contains directory (e.g. qualimap report), the directory is renamed instead of the file.
+        '''
+        for id, new_id in self.sample_id_map.forward.items():
+            for tmpl in self.targets:
+                tmpl = tmpl.split("/")[0] #sample id in directory name and directory should be renamed
+                self.renamed_result_file_map[f'{self.output_path}{id}{tmpl}'] = f'{self.output_path}{new_id}{tmpl}' #storing for forward renaming
 
 
     def annotate_processed_files(self):
         '''Renames processed files using self.renamed_result_file_map and creates a renaming log file in the output directory'''
         if self.backward_result_file_map:
-            total_count = len(self.backward_result_file_map)
-            processed_count = 0
-            annotation_logs = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                print(f"Reannotating output files with processing ids:\n{total_count} total output files.") #announcing to the terminal
-                results = [executor.submit(hk.renamer, path, self.backward_result_file_map[path]) for path in self.backward_result_file_map] #submitting function calls to different processes
-                for f in concurrent.futures.as_completed(results):
-                    result = f.result()
-                    annotation_logs.append(result)
-                    processed_count += 1
-                    hk.printProgressBar(processed_count, total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            print(f"Reannotating output files with processing ids:\n{len(self.backward_result_file_map)} total output files.") #announcing to the terminal
+            hk.rename_files(self.backward_result_file_map, log_path=f'{self.output_path}result_annotation.log', journal=self.rename_journal, step='result_annotation')
             print(f"Result annotation finished!\n") #report completion
-            with open(f'{self.output_path}result_annotation.log', 'w+') as ann_log: #opening log file for writing  
-                for log in annotation_logs: ann_log.write(log)         
         else:
-            total_count = len(self.renamed_result_file_map)
-            processed_count = 0
-            annotation_logs = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                print(f"Annotating output files with processing ids:\n{total_count} total output files.") #announcing to the terminal
-                results = [executor.submit(hk.renamer, path, self.renamed_result_file_map[path]) for path in self.renamed_result_file_map] #submitting function calls to different processes
-                for f in concurrent.futures.as_completed(results):
-                    result = f.result()
-                    annotation_logs.append(result)
-                    processed_count += 1
-                    hk.printProgressBar(processed_count, total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
-
-            with open(f'{self.output_path}result_annotation.log', 'w+') as ann_log: #opening log file for writing  
-                for log in annotation_logs: ann_log.write(log)
+            print(f"Annotating output files with processing ids:\n{len(self.renamed_result_file_map)} total output files.") #announcing to the terminal
+            hk.rename_files(self.renamed_result_file_map, log_path=f'{self.output_path}result_annotation.log', journal=self.rename_journal, step='result_annotation')
 
 
     def switch_sample_ids(self, new_to_old:bool = False):
@@ -208,17 +202,25 @@ class Covid_assembly(Module):
         Replaces sample_id column in self.sample_sheet with ids that contain processing number and lack run number.
         If new_to_old is set to True, performs the reverse operation.
         '''
-        if new_to_old:
-            temp_dict = {re.sub(r"(_S[0-9]{3}|_S[0-9]{2}|_S[0-9]{1})", "", self.processing_id_dict[id]):id for id in self.processing_id_dict} #removing run ids
-            self.sample_sheet = hk.map_replace_column(self.sample_sheet, temp_dict, 'sample_id', 'sample_id')
-        else:
-            temp_dict = {id:re.sub(r"(_S[0-9]{3}|_S[0-9]{2}|_S[0-9]{1})", "", self.processing_id_dict[id]) for id in self.processing_id_dict} #removing run ids
-            self.sample_sheet = hk.map_replace_column(self.sample_sheet, temp_dict, 'sample_id', 'sample_id')
+        self.sample_sheet['sample_id'] = self.sample_id_map.translate(self.sample_sheet['sample_id'], reverse=new_to_old) #swapping ids in place
 
 
 class Covid_downstream():
     '''Class implements pipeline-specific downstream processing methods'''
 
+    #stage dependency graph (stage method:list of stages it depends on); used by run_stages
+    stage_graph = {
+        'generate_pipeline_report':[],
+        'filter_pipeline_report':['generate_pipeline_report'],
+        'update_summary_file':['generate_pipeline_report'], #uses unfiltered report, independent of mutstat
+        'copy_mutation_files':['generate_pipeline_report'], #copies source files collected by pipeline report
+        'generate_mutstat_report':['filter_pipeline_report'],
+        'update_mut_heatmap':['copy_mutation_files'],
+        'generate_tessy_report':['filter_pipeline_report'],
+        'update_covidshare':['filter_pipeline_report'],
+        'generate_weekly_report':['filter_pipeline_report', 'generate_mutstat_report', 'update_summary_file'],
+    }
+
     def __init__(self, start_date:str, end_date:str, skip_pango:bool, skip_heatmap:bool, skip_db_update:bool, skip_tessy:bool, update_share:bool):
 
         #command-line arguments
@@ -249,6 +251,7 @@ class Covid_downstream():
         self.pipeline_report_path = None
         self.filtered_report_path = None
         self.mutstat_report_path = None
+        self.stage_context = threading.local() #name of the stage run by the current thread; set by _call_stage, used by run_logged to prefix streamed output
 
 
     def generate_pipeline_report(self):
@@ -265,9 +268,9 @@ class Covid_downstream():
                 if self.skip_pango:
                     print('Pangolin typing skipped, assuming report files exist.')
                     command.append('-s')
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
                 else: 
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
         except subprocess.CalledProcessError:
             sys.exit(f'Pipeline report generation failed\nSee {log_path} for details')
         self.report_folder_path = f"{self.report_folder_path}report_{datetime.today().date().strftime('%Y-%m-%d')}_{self.start_date}_{self.end_date}"
@@ -297,7 +300,7 @@ class Covid_downstream():
         try:
             with open(log_path, 'w+') as log_file:
                 log_file.write(" ".join(command))
-                subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                self.run_logged(command, log_file)
         except subprocess.CalledProcessError:
             sys.exit(f'Mutstat report generation failed\nSee {log_path} for details')
         self.mutstat_report_path = f"{self.report_folder_path}/mutstat_report.csv"
@@ -314,7 +317,7 @@ class Covid_downstream():
             try:
                 with open(log_path, 'w+') as log_file:
                     log_file.write(" ".join(command))
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
             except subprocess.CalledProcessError:
                 sys.exit(f'Summary file update failed\nSee {log_path} for details')
         else:
@@ -325,10 +328,11 @@ class Covid_downstream():
     def copy_mutation_files(self):
         '''
         Copies all .ann.csv files from self.report_folder_path/source_files/ to self.mutation_file_folder.
+        Copying processes are spawned instead of forked, as the stage runs in a worker thread of run_stages.
         '''
         path_list = [f'{self.report_folder_path}/source_files/{file}' for file in os.listdir(f'{self.report_folder_path}/source_files') if ".ann.csv" in file]
         print(f'Copying annotated variant files to {self.mutation_file_folder}')
-        copy_files_parallel(path_list, self.mutation_file_folder, progress_bar=False)
+        copy_files_parallel(path_list, self.mutation_file_folder, progress_bar=False, mp_context=multiprocessing.get_context('spawn'))
 
 
     def update_mut_heatmap(self):
@@ -342,7 +346,7 @@ class Covid_downstream():
             try:
                 with open(log_path, 'w+') as log_file:
                     log_file.write(" ".join(command))
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
             except subprocess.CalledProcessError:
                 sys.exit(f'Summary file update failed\nSee {log_path} for details')
         else:
@@ -359,7 +363,7 @@ class Covid_downstream():
         try:
             with open(log_path, 'w+') as log_file:
                 log_file.write(" ".join(command))
-                subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                self.run_logged(command, log_file)
         except subprocess.CalledProcessError:
             sys.exit(f'Weekly report generation failed\nSee {log_path} for details')
 
@@ -375,7 +379,7 @@ class Covid_downstream():
             try:
                 with open(log_path, 'w+') as log_file:
                     log_file.write(" ".join(command))
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
             except subprocess.CalledProcessError:
                 sys.exit(f'TESSY report generation failed\nSee {log_path} for details')
         else:
@@ -397,10 +401,77 @@ class Covid_downstream():
             try:
                 with open(log_path, 'w+') as log_file:
                     log_file.write(" ".join(command))
-                    subprocess.check_call(command, stdout=log_file, stderr=log_file)
+                    self.run_logged(command, log_file)
             except subprocess.CalledProcessError:
                 sys.exit(f'Covidshare update failed\nSee {log_path} for details')
 
+    def run_logged(self, command:list, log_file):
+        '''
+        Runs command, writing its output (stdout and stderr) to the open log_file and printing it line by line as it runs,
+        prefixed by the name of the current stage when called from run_stages. Raises subprocess.CalledProcessError if command fails.
+        '''
+        prefix = f'[{self.stage_context.name}] ' if getattr(self.stage_context, 'name', None) else ''
+        log_file.write("\n")
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, env=dict(os.environ, PYTHONUNBUFFERED='1')) as process:
+            for line in process.stdout:
+                log_file.write(line)
+                log_file.flush()
+                print(f'{prefix}{line}', end='', flush=True)
+        if process.returncode != 0: raise subprocess.CalledProcessError(process.returncode, command)
+
+
+    def _call_stage(self, stage:str):
+        '''Calls stage method; sys.exit called by failing stage is converted to RuntimeError, so that it does not stop the event loop of run_stages.'''
+        self.stage_context.name = stage
+        try:
+            getattr(self, stage)()
+        except SystemExit as e:
+            raise RuntimeError(e.code) from None
+        finally:
+            self.stage_context.name = None
+
+
+    async def _run_stage_graph(self, stage_graph:dict, max_workers:int):
+        '''
+        Runs every stage in a thread pool as soon as all stages it depends on are finished. On the first failure stages that were not started yet are cancelled
+        (running stages can not be interrupted and are left to finish). Returns tuple of (stage:runtime in seconds dictionary, failed stage, error).
+        '''
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        timings, tasks = {}, {}
+
+        async def run_stage(stage):
+            await asyncio.gather(*(tasks[dependency] for dependency in stage_graph[stage]))
+            print(f'[{stage}] started at {datetime.now().strftime("%H:%M:%S")}')
+            start = time.perf_counter()
+            await loop.run_in_executor(executor, self._call_stage, stage)
+            timings[stage] = time.perf_counter()-start
+            print(f'[{stage}] finished in {timings[stage]:.1f} s')
+
+        tasks.update({stage:asyncio.ensure_future(run_stage(stage)) for stage in stage_graph})
+        done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending: task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        executor.shutdown(wait=True) #waits only for stages that are already running
+        failed = [(stage, task.exception()) for stage, task in tasks.items() if task in done and not task.cancelled() and task.exception() is not None]
+        failed = [(stage, error) for stage, error in failed if not any(dependency in dict(failed) for dependency in stage_graph[stage])] #first failing stage, not the ones waiting for it
+        return (timings,)+(failed[0] if failed else (None, None))
+
+
+    def run_stages(self, stage_graph:dict=None, max_workers:int=4):
+        '''
+        Runs downstream stages according to the dependency graph (self.stage_graph by default), independent stages running concurrently.
+        Prints start and runtime of every stage and timing summary. If any stage fails, stages that were not started yet are skipped and the script exits with error message.
+        Returns dictionary of stage:runtime in seconds pairs.
+        '''
+        stage_graph = stage_graph if stage_graph is not None else self.stage_graph
+        start = time.perf_counter()
+        timings, failed_stage, error = asyncio.run(self._run_stage_graph(stage_graph, max_workers))
+        print(f'Downstream stages finished in {time.perf_counter()-start:.1f} s (sum of stage runtimes {sum(timings.values()):.1f} s):')
+        for stage, runtime in timings.items(): print(f'    {stage}: {runtime:.1f} s')
+        if failed_stage is not None: sys.exit(f'Downstream stage {failed_stage} failed: {error}')
+        return timings
+
 
 ################################################
 # Defining wrapper functions to call from main
@@ -456,6 +527,7 @@ def run_all(args, num_jobs):
             assembly.clear_working_directory() #to avoid manually moving files back to input
             raise e
         assembly.check_module_output()
+        assembly.write_output_check()
         assembly.write_sample_sheet()
         assembly.clear_working_directory()
     else:
@@ -464,15 +536,7 @@ def run_all(args, num_jobs):
 
     if (downstream.start_date and downstream.end_date):
     #Running downstream
-        downstream.generate_pipeline_report()
-        downstream.filter_pipeline_report()
-        downstream.generate_mutstat_report()
-        downstream.update_summary_file()
-        downstream.copy_mutation_files()
-        downstream.update_mut_heatmap()
-        downstream.generate_weekly_report()
-        downstream.generate_tessy_report()
-        downstream.update_covidshare()
+        downstream.run_stages()
     else:
         sys.exit(f'Skipping downstream as start-end dates (-d1; -d2) arguments were not supplied')
     
@@ -499,6 +563,7 @@ def run_assembly(args, num_jobs):
     )
     if assembly.input_path:
         assembly.make_output_dir()
+        assembly.recover_renames()
         assembly.map_fastq_to_illumina()
         assembly.convert_fastq_names()
         assembly.restore_annotated_results()
@@ -516,6 +581,7 @@ def run_assembly(args, num_jobs):
             assembly.clear_working_directory()
             raise e
         assembly.check_module_output()
+        assembly.write_output_check()
         assembly.compute_processing_ids()
         assembly.fill_output_file_maps()
         assembly.annotate_processed_files()
@@ -523,6 +589,7 @@ def run_assembly(args, num_jobs):
         assembly.write_sample_sheet()
         assembly.clear_working_directory()
         assembly.convert_fastq_names(to_illumina=False)
+        assembly.rename_journal.close() #all renaming steps are finished
     else:
         sys.exit(f'Path to a folder containing fastq files (-i argument) must be supplied to run assembly module.')
     
@@ -548,15 +615,7 @@ def run_downstream(args):
 
     if (downstream.start_date and downstream.end_date):
     #Running downstream
-        downstream.generate_pipeline_report()
-        downstream.filter_pipeline_report()
-        downstream.generate_mutstat_report()
-        downstream.update_summary_file()
-        downstream.copy_mutation_files()
-        downstream.update_mut_heatmap()
-        downstream.generate_weekly_report()
-        downstream.generate_tessy_report()
-        downstream.update_covidshare()
+        downstream.run_stages()
     else:
         sys.exit(f'Skipping downstream as start-end dates (-d1; -d2) arguments were not supplied')
     
\ No newline at end of file
@@ -1,5 +1,5 @@
 from subscripts.src.utilities import Housekeeper as hk
-import pandas as pd, gzip, re, os
+import pandas as pd, gzip, re, os, zlib, json, hashlib
 
 class covipipe_housekeeper(hk):
     '''Class extends the standard housekeeper class to implement functions required by specific pipeline'''
@@ -8,11 +8,9 @@ class covipipe_housekeeper(hk):
     def map_replace_column(df:pd.DataFrame, new_dict:dict, column_to_map:str ,column_to_replace:str):
         '''
         Given pandas dataframe,a new_dict dictionary, column to map the new_dict and a column to 
-        replace with the new dict, performs the replacement and returns resulting dataframe.
+        replace with the new dict, performs the replacement in place (column keeps its position) and returns resulting dataframe.
         '''
-        df['temp_col'] = df[column_to_map].map(new_dict) #adding numbered sample ids to the sample sheet to be used by downstream module
-        del df[column_to_replace] #removing old sample ids
-        df.rename(columns={'temp_col':column_to_replace}, inplace=True) #adding new sample ids
+        df[column_to_replace] = df[column_to_map].map(new_dict) #replacing sample ids with ids mapped by new_dict
         return df
 
     
@@ -36,46 +34,263 @@ class covipipe_housekeeper(hk):
 
     
     @staticmethod
-    def check_fastq_integrity(path_to_file:str):
+    def check_fastq_integrity(path_to_file:str, chunk_size:int=1048576):
         '''
-        Given path to a fastq file returns True if file is intact, otherwise returns False.
+        Given path to a gzipped fastq file, streams the file in fixed-size binary chunks, verifying CRC/ISIZE trailer of every gzip member
+        and 4-line structure of every fastq record (header, sequence, separator, quality of the same length as sequence).
+        Memory usage is bounded by chunk_size regardless of the file size; the check stops at the first problem found.
+        Returns (True, path_to_file, "") if file is intact, otherwise returns (False, path_to_file, note), where note describes the first problem and its byte offset.
         '''
-        try: 
-            gzip.open(path_to_file, "rt").read()
-        except EOFError:
-            return False, path_to_file
-        return True, path_to_file
+        decompressor = zlib.decompressobj(wbits=31) #31 - gzip header & trailer expected, crc32 and isize of each member are verified by zlib
+        member_started = False #set when the current member has received any input
+        compressed_offset = 0 #offset of the current chunk in the gzip file
+        line_state = {'count':0, 'offset':0, 'tail':b'', 'blank':0, 'seq_length':None} #fastq parsing state carried between chunks
+        try:
+            with open(path_to_file, 'rb') as fastq:
+                chunk = fastq.read(chunk_size)
+                if not chunk: return False, path_to_file, 'empty file'
+                while chunk:
+                    data = chunk
+                    while data:
+                        if not member_started: #skipping zero padding allowed between/after gzip members
+                            data = data.lstrip(b'\x00')
+                            if not data: break
+                        member_started = True
+                        text = decompressor.decompress(data, chunk_size) #max_length keeps decompressed block size bounded
+                        data = decompressor.unconsumed_tail
+                        note = covipipe_housekeeper._check_fastq_block(text, line_state)
+                        if note: return False, path_to_file, note
+                        if decompressor.eof: #member complete and its trailer verified - next member may follow in the same chunk
+                            data = decompressor.unused_data + data
+                            decompressor = zlib.decompressobj(wbits=31)
+                            member_started = False
+                    compressed_offset += len(chunk)
+                    chunk = fastq.read(chunk_size)
+        except zlib.error as msg:
+            return False, path_to_file, f'corrupted gzip stream near byte {compressed_offset}: {msg}'
+        except OSError as msg:
+            return False, path_to_file, f'read error near byte {compressed_offset}: {msg}'
+        if member_started: #file ended before the gzip trailer of the last member was reached
+            return False, path_to_file, f'truncated gzip stream at byte {compressed_offset}'
+        note = covipipe_housekeeper._check_fastq_block(b'', line_state, final=True)
+        if note: return False, path_to_file, note
+        return True, path_to_file, ""
 
 
+    @staticmethod
+    def _check_fastq_block(text:bytes, line_state:dict, final:bool=False):
+        '''
+        Helper function for check_fastq_integrity: checks complete lines of decompressed text against the 4-line fastq record structure,
+        carrying incomplete last line and record position in line_state dictionary. Returns None if block is valid, otherwise returns a note
+        describing the first invalid line and its offset in the decompressed stream. Set final to True to check the end of the stream.
+        Empty lines at the end of the block are held back until more text follows, so blank lines at the end of the stream are accepted.
+        '''
+        lines = (line_state['tail'] + text).split(b'\n')
+        line_state['tail'] = lines.pop() #last element is either an incomplete line or an empty string
+        if final and line_state['tail']: #last line without trailing newline
+            lines.append(line_state['tail'])
+            line_state['tail'] = b''
+        if lines: #held back empty lines are followed by more text
+            lines = [b''] * line_state['blank'] + lines
+            line_state['blank'] = 0
+        while lines and not lines[-1]: #holding back trailing empty lines
+            lines.pop()
+            line_state['blank'] += 1
+        count, seq_length = line_state['count'], line_state['seq_length']
+        #fast path - slicing lines by their role in the record (0 - header, 1 - sequence, 2 - separator, 3 - quality)
+        first = [(role - count) % 4 for role in range(4)]
+        sequence_lengths = list(map(len, lines[first[1]::4]))
+        quality_lengths = list(map(len, lines[first[3]::4]))
+        if first[3] < first[1]: sequence_lengths.insert(0, seq_length) #first quality line belongs to the sequence from previous block
+        block_valid = (
+            all(line[:1] == b'@' for line in lines[first[0]::4]) and 
+            all(line[:1] == b'+' for line in lines[first[2]::4]) and 
+            sequence_lengths[:len(quality_lengths)] == quality_lengths
+            )
+        if block_valid:
+            if len(sequence_lengths) > len(quality_lengths): seq_length = sequence_lengths[-1]
+            line_state['offset'] += sum(map(len, lines)) + len(lines)
+            line_state['count'] += len(lines)
+            line_state['seq_length'] = seq_length
+            if final and line_state['count'] % 4 != 0:
+                return f'incomplete fastq record at line {line_state["count"]+1} (uncompressed byte {line_state["offset"]})'
+            return None
+        #slow path - locating the first invalid line to report its offset
+        offset = line_state['offset']
+        for line in lines:
+            role = count % 4
+            if (role == 0 and line[:1] != b'@') or (role == 2 and line[:1] != b'+') or (role == 3 and len(line) != seq_length):
+                return f'invalid fastq record at line {count+1} (uncompressed byte {offset})'
+            if role == 1: seq_length = len(line)
+            offset += len(line) + 1
+            count += 1
+
+
+    @staticmethod
+    def fastq_fingerprint(path_to_file:str, hash_content:bool=False, sample_size:int=1048576):
+        '''
+        Given path to a file, returns a dictionary identifying the current state of the file by its absolute path, size, modification time and inode.
+        If hash_content is set to True, adds blake2b hash of the first and last sample_size bytes of the file to detect in-place rewrites that keep the stat values.
+        '''
+        stat = os.stat(path_to_file)
+        fingerprint = {'path':os.path.abspath(path_to_file), 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'inode':stat.st_ino}
+        if hash_content:
+            content_hash = hashlib.blake2b(digest_size=16)
+            with open(path_to_file, 'rb') as file:
+                content_hash.update(file.read(sample_size))
+                if stat.st_size > sample_size:
+                    file.seek(max(sample_size, stat.st_size - sample_size))
+                    content_hash.update(file.read(sample_size))
+            fingerprint['hash'] = content_hash.hexdigest()
+        return fingerprint
+
 
     @staticmethod
-    def name_formatter(path_to_fastq:str):
-        '''Helper function to remove prefix and suffix patters from fastq file name before processing.'''
-        prefix_patterns = [r'CO-[0-9]{5}_LVA[0-9]{3}_'] #Eurofins prefixes
-        suffix_patterns = [r'_lib[0-9]{6}'] #Eurofins suffixes
-        new_path = path_to_fastq
-        #replace prefix
-        for prefix in prefix_patterns: 
-            if re.search(prefix,new_path).group(0) is not None: #if pattern is detected in file name
-                new_path = re.sub(prefix,"",new_path) #replace
-                break #done with prefixes
-        #replace suffix
-        for suffix in suffix_patterns:
-            if re.search(suffix,new_path).group(0) is not None: #if pattern is detected in file name
-                new_path = re.sub(suffix,"",new_path) #replace
-                break #done with suffixes
-        #convert fastq part to illumina format
-        if "_1.fastq.gz" in new_path: new_path = new_path.replace("_1.fastq.gz", "_R1_001.fastq.gz") #read_1
-        if "_2.fastq.gz" in new_path: new_path = new_path.replace("_2.fastq.gz", "_R2_001.fastq.gz") #read_2
-        return path_to_fastq, new_path #save to forward map
+    def read_integrity_cache(path_to_cache:str):
+        '''
+        Given path to json-lines integrity cache file, returns a dictionary mapping absolute path of each verified file to its latest fingerprint.
+        Returns empty dictionary if the file does not exist. Lines that cannot be parsed (e.g. interrupted write) are skipped.
+        '''
+        cache = {}
+        if not os.path.isfile(path_to_cache): return cache
+        with open(path_to_cache, 'r') as cache_file:
+            for line in cache_file:
+                try:
+                    record = json.loads(line)
+                    cache[record['path']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return cache
 
 
     @staticmethod
-    def renamer(old_path:str, new_path:str):
-        '''Helper function to rename fastq files to illumina format.'''
-        try: #attempt renaming
-            os.rename(old_path, new_path)
-            return f'{old_path} {new_path} OK\n'#return info about successful renaming
-        except OSError: #if failed
-            return f'{old_path} {new_path} FAILED\n'#return info about successful renaming
+    def update_integrity_cache(path_to_cache:str, fingerprint_list:list):
+        '''
+        Given path to json-lines integrity cache file and list of fingerprints of verified files (see fastq_fingerprint), appends the fingerprints to the cache file.
+        If the cache file ends with an incomplete line (interrupted write), new records are started on a new line.
+        '''
+        if not fingerprint_list: return
+        separator = ""
+        if os.path.isfile(path_to_cache) and os.path.getsize(path_to_cache) > 0:
+            with open(path_to_cache, 'rb') as cache_file:
+                cache_file.seek(-1, os.SEEK_END)
+                if cache_file.read(1) != b'\n': separator = "\n"
+        with open(path_to_cache, 'a') as cache_file:
+            cache_file.write(separator + "".join(f'{json.dumps(fingerprint)}\n' for fingerprint in fingerprint_list))
+
+
+    @staticmethod
+    def map_illumina_names(path_list:list, prefix_patterns:list=[], suffix_patterns:list=[]):
+        '''
+        Given list of fastq file paths (_1.fastq.gz/_2.fastq.gz format), list of prefix and list of suffix regex patterns,
+        removes prefix from the start and suffix from the end of sample id part of each file name and converts read tag to illumina format (_R1_001.fastq.gz/_R2_001.fastq.gz).
+        All rules are compiled into single regex and applied to all file names at once.
+        Returns forward (original:illumina) and backward (illumina:original) maps of files that need to be renamed.
+        '''
+        prefix_rule = f"(?:{'|'.join(prefix_patterns)})?" if prefix_patterns else "" #optional prefix at the start of the file name
+        suffix_rule = f"(?:{'|'.join(suffix_patterns)})?" if suffix_patterns else "" #optional suffix before read tag
+        name_rule = re.compile(rf"^{prefix_rule}(?P<sample_id>.+?){suffix_rule}_(?P<read>[12])\.fastq\.gz$")
+        paths = pd.Series(path_list, dtype=object)
+        if paths.empty: return {}, {}
+        parts = paths.str.rpartition("/") #directory, separator, file name
+        new_paths = parts[0] + parts[1] + parts[2].str.replace(name_rule, r"\g<sample_id>_R\g<read>_001.fastq.gz", regex=True)
+        changed = paths != new_paths
+        forward_map = dict(zip(paths[changed], new_paths[changed]))
+        backward_map = dict(zip(new_paths[changed], paths[changed]))
+        return forward_map, backward_map
+
+
+class Sample_id_map:
+    '''
+    Bidirectional mapping between original sample ids and sample ids annotated with processing ids.
+    Both directions are computed once and reused to translate sample sheet columns and to generate result file maps.
+    '''
+
+    def __init__(self, original_ids:list, annotated_ids:list):
+        self.forward = dict(zip(original_ids, annotated_ids)) #original id to annotated id
+        self.backward = dict(zip(annotated_ids, original_ids)) #annotated id to original id
+
+
+    @classmethod
+    def from_processing_ids(cls, sample_ids:list, processing_ids:list, drop_pattern:re.Pattern):
+        '''
+        Given list of original sample ids, list of processing ids in the same order and compiled pattern to remove (e.g. illumina run number),
+        annotates all sample ids at once (processing id prefix, drop_pattern removed) and returns mapping object.
+        '''
+        sample_ids = pd.Series(sample_ids, dtype=object)
+        annotated_ids = (pd.Series(processing_ids, dtype=object) + "_" + sample_ids).str.replace(drop_pattern, "", regex=True)
+        return cls(sample_ids.tolist(), annotated_ids.tolist())
+
+
+    def translate(self, ids:pd.Series, reverse:bool=False):
+        '''Given series of sample ids, returns series of annotated ids (or original ids if reverse is set to True).'''
+        return ids.map(self.backward if reverse else self.forward)
+
+
+class Rename_journal:
+    '''
+    Append-only write-ahead journal of file renaming steps. Every step is recorded (BEGIN line followed by one MOVE line per file) 
+    and synced to disk before any file is renamed, and marked with COMMIT line after all files are renamed.
+    If the process crashes, the journal is used on restart to complete interrupted steps and to find steps that still need to be reverted.
+    '''
+
+    def __init__(self, journal_path:str):
+        self.journal_path = journal_path #journal file is created on first write
+
+
+    def _append(self, records:list):
+        '''Appends tab-separated records to the journal file and forces them to disk.'''
+        with open(self.journal_path, 'a') as journal:
+            journal.write("".join("\t".join(record)+"\n" for record in records))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+    def begin(self, step:str, path_map:dict, log_path:str=None):
+        '''Given step name, dictionary mapping old paths to new paths and optional path to renaming log, records the planned renaming.'''
+        self._append([('BEGIN', step, log_path or '')] + [('MOVE', step, old_path, new_path) for old_path, new_path in path_map.items()])
+
+
+    def commit(self, step:str):
+        '''Given step name, records that all files of the step were renamed.'''
+        self._append([('COMMIT', step)])
+
+
+    def read_steps(self):
+        '''
+        Returns dictionary mapping each step name found in the journal to a dictionary with log_path, path_map and committed keys.
+        If step was started more than once, only the latest attempt is kept. Incomplete last line (interrupted write) is ignored.
+        '''
+        steps = {}
+        if not os.path.isfile(self.journal_path): return steps
+        with open(self.journal_path, 'r') as journal:
+            for line in journal:
+                if not line.endswith("\n"): break #interrupted write - planned renaming was not synced, so no file was renamed
+                record = line.rstrip("\n").split("\t")
+                if record[0] == 'BEGIN':
+                    steps.pop(record[1], None) #keeping step order of latest attempt
+                    steps[record[1]] = {'log_path':record[2] or None, 'path_map':{}, 'committed':False}
+                elif record[0] == 'MOVE':
+                    steps[record[1]]['path_map'][record[2]] = record[3]
+                elif record[0] == 'COMMIT':
+                    steps[record[1]]['committed'] = True
+        return steps
+
+
+    def recover(self):
+        '''
+        Replays every step that was started but not committed (files that were already renamed are skipped) and commits it.
+        Returns dictionary of all steps found in the journal (see read_steps).
+        '''
+        steps = self.read_steps()
+        for step in steps:
+            if not steps[step]['committed']:
+                print(f"Completing interrupted renaming step {step}:\n{len(steps[step]['path_map'])} total files.")
+                hk.rename_files(steps[step]['path_map'], log_path=steps[step]['log_path'], journal=self, step=step)
+                steps[step]['committed'] = True
+        return steps
+
 
+    def close(self):
+        '''Removes the journal file once all renaming steps of the run are finished.'''
+        if os.path.isfile(self.journal_path): os.remove(self.journal_path)
@@ -0,0 +1,178 @@
+import os, re, sqlite3, time, pandas as pd
+
+#DEFAULT LOCATION OF THE INDEX DATABASE
+index_path = '/mnt/home/groups/nmrl/cov_analysis/analysis_history/file_index.sqlite'
+
+#INDEXED ARCHIVE FOLDERS SHARED BY DOWNSTREAM SCRIPTS
+covid_output_path = '/mnt/home/groups/nmrl/cov_analysis/covid_output/'
+
+#FILE CONTEXTS (FILE NAME ENDINGS) RECOGNIZED BY THE INDEX
+contexts = ("ann.csv", "seq_depth.txt", "mapped_report.txt", "consensus.fasta", "fastp_report.json", "cutadapt_log.txt", "ivar_log.txt", "fastq.gz")
+
+
+class File_index:
+    '''
+    Persistent SQLite index of files stored in archive folders (e.g. raw/ and covid_output/).
+    Every indexed file is stored with its size, modification time, sample id, processing id, run folder (top-level folder under indexed root) and context (file type).
+    Index is updated by delta scan (refresh): directory is listed again only if its modification time changed since the last scan,
+    for unchanged directories stored entries are reused, so only one stat call per directory is needed.
+    Note: directory modification time changes when files are added, removed or renamed, but not when existing file is overwritten in place,
+    so size and mtime of such files are updated only when the directory changes or full refresh is requested.
+    '''
+
+    #read number (e.g. _R1_001) is only stripped from fastq file names, as sample ids may end with _1 or _2
+    name_pattern = re.compile(r"^(?:(?P<processing_id>COV[0-9]{6})_)?(?P<sample_id>.+?)(?:_S[0-9]{1,3})?(?:_R?[12](?:_001)?(?=[._]fastq\.gz$))?[._](?P<context>"+"|".join(map(re.escape, contexts))+r")$")
+    settle_time_ns = 2*10**9 #directories modified less than 2 s before the scan are rescanned next time (changes within the same timestamp tick would be missed)
+
+    def __init__(self, db_path:str=index_path, timeout:float=60):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=timeout)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, root TEXT NOT NULL, mtime_ns INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dir TEXT NOT NULL, root TEXT NOT NULL, name TEXT NOT NULL, is_dir INTEGER NOT NULL,
+                size INTEGER, mtime_ns INTEGER, sample_id TEXT, processing_id TEXT, run_folder TEXT, context TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+            CREATE INDEX IF NOT EXISTS files_root_context ON files (root, context);
+            CREATE INDEX IF NOT EXISTS files_sample_id ON files (sample_id);
+            CREATE INDEX IF NOT EXISTS dirs_root ON dirs (root);
+        ''')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.connection.close()
+
+
+    @staticmethod
+    def normalize(path:str):
+        '''Returns canonical path (symlinks resolved, no trailing slash), so that the same folder is indexed once regardless of the path used.'''
+        return os.path.realpath(path)
+
+
+    def _scan_directory(self, dir_path:str, root:str):
+        '''Lists directory and returns list of rows to store in files table (subdirectories are stored with is_dir=1).'''
+        run_folder = None if dir_path == root else os.path.relpath(dir_path, root).split(os.sep)[0]
+        rows = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir() and not entry.is_symlink() #symlinked folders are not indexed
+                    stat = entry.stat()
+                    size, mtime_ns = stat.st_size, stat.st_mtime_ns
+                except OSError: #broken symlink
+                    is_dir, size, mtime_ns = False, None, None
+                name_match = None if is_dir else self.name_pattern.match(entry.name)
+                sample_id, processing_id, context = (name_match['sample_id'], name_match['processing_id'], name_match['context']) if name_match else (None, None, None)
+                rows.append((f'{dir_path}/{entry.name}', dir_path, root, entry.name, int(is_dir), size, mtime_ns, sample_id, processing_id, entry.name if dir_path == root and is_dir else run_folder, context))
+        return rows
+
+
+    def refresh(self, root_path:str, full:bool=False):
+        '''
+        Updates index of all files under root_path, listing only directories that changed since the last refresh (all directories if full is set to True).
+        Entries of removed directories are deleted. Returns tuple (number of listed directories, number of directories reused from index).
+        '''
+        root = self.normalize(root_path)
+        if not os.path.isdir(root): raise ValueError(f'Expected path to folder - {root_path} does not exist or refers to a file')
+        scan_start = time.time_ns()
+        listed, reused, visited = 0, 0, set()
+        stack = [root]
+        with self.connection: #single transaction
+            while stack:
+                dir_path = stack.pop()
+                try:
+                    mtime_ns = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    continue
+                visited.add(dir_path)
+                stored = self.connection.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (dir_path,)).fetchone()
+                if not full and stored is not None and stored[0] == mtime_ns: #directory unchanged
+                    subdirs = [row[0] for row in self.connection.execute('SELECT path FROM files WHERE dir = ? AND is_dir = 1', (dir_path,))]
+                    reused += 1
+                else:
+                    try:
+                        rows = self._scan_directory(dir_path, root)
+                    except OSError: #unreadable directory
+                        continue
+                    self.connection.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+                    self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+                    trusted_mtime = mtime_ns if scan_start - mtime_ns > self.settle_time_ns else -1
+                    self.connection.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)', (dir_path, root, trusted_mtime))
+                    subdirs = [row[0] for row in rows if row[4]]
+                    listed += 1
+                stack.extend(subdirs)
+            removed = [row[0] for row in self.connection.execute('SELECT path FROM dirs WHERE root = ?', (root,)) if row[0] not in visited]
+            self.connection.executemany('DELETE FROM files WHERE dir = ?', [(path,) for path in removed])
+            self.connection.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in removed])
+        return listed, reused
+
+
+    def run_folders(self, root_path:str):
+        '''Returns dictionary of folder name:folder path pairs of all indexed folders directly under root_path.'''
+        root = self.normalize(root_path)
+        return dict(self.connection.execute('SELECT name, path FROM files WHERE dir = ? AND is_dir = 1 ORDER BY name', (root,)).fetchall())
+
+
+    def run_folder_mtimes(self, root_path:str):
+        '''
+        Returns dictionary of folder name:modification time (ns) pairs of all indexed folders directly under root_path, as stored in dirs table by the last refresh
+        (updated whenever files are added to the folder). Folders modified just before the refresh have no trusted mtime stored, so their mtime is read again.
+        '''
+        root = self.normalize(root_path)
+        rows = self.connection.execute('''
+            SELECT files.name, files.path, COALESCE(dirs.mtime_ns, files.mtime_ns) FROM files LEFT JOIN dirs ON dirs.path = files.path
+            WHERE files.dir = ? AND files.is_dir = 1 ORDER BY files.name''', (root,)).fetchall()
+        mtimes = {}
+        for name, path, mtime_ns in rows:
+            if mtime_ns == -1: #modified within settle_time_ns before the refresh
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+            mtimes[name] = mtime_ns
+        return mtimes
+
+
+    def _fill_temp_table(self, table:str, values:list):
+        '''Stores values in single-column temporary table (used to filter queries by long lists of values).'''
+        self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (value TEXT)')
+        self.connection.execute(f'DELETE FROM {table}')
+        self.connection.executemany(f'INSERT INTO {table} VALUES (?)', [(str(value),) for value in values])
+
+
+    def query(self, root_path:str=None, dirs:list=None, contexts:list=None, sample_ids:list=None, name_like:str=None, name_contains:list=None):
+        '''
+        Returns dataframe of indexed files (path, dir, name, size, mtime_ns, sample_id, processing_id, run_folder, context columns) ordered by path.
+        All provided filters are combined: root_path - files under this folder; dirs - files directly in these folders; contexts - file contexts;
+        sample_ids - sample ids; name_like - SQL LIKE pattern of file name; name_contains - file name contains at least one of the substrings.
+        '''
+        conditions, params = ['is_dir = 0'], []
+        if root_path is not None:
+            conditions.append('root = ?')
+            params.append(self.normalize(root_path))
+        if dirs is not None:
+            self._fill_temp_table('query_dirs', [self.normalize(path) for path in dirs])
+            conditions.append('dir IN (SELECT value FROM query_dirs)')
+        if contexts is not None:
+            conditions.append(f'context IN ({",".join("?"*len(contexts))})')
+            params.extend(contexts)
+        if sample_ids is not None:
+            self._fill_temp_table('query_ids', sample_ids)
+            conditions.append('sample_id IN (SELECT value FROM query_ids)')
+        if name_like is not None:
+            conditions.append('name LIKE ?')
+            params.append(name_like)
+        if name_contains is not None:
+            self._fill_temp_table('query_substrings', name_contains)
+            conditions.append('EXISTS (SELECT 1 FROM query_substrings WHERE instr(name, value) > 0)')
+        sql = f'SELECT path, dir, name, size, mtime_ns, sample_id, processing_id, run_folder, context FROM files WHERE {" AND ".join(conditions)} ORDER BY path'
+        return pd.read_sql_query(sql, self.connection, params=params)
@@ -1,5 +1,7 @@
 #!/mnt/home/groups/nmrl/cov_analysis/SARS-CoV2_assembly/tools/rbase_env/bin/python
-import pandas as pd, sys, os, datetime, argparse, datetime, re
+import pandas as pd, sys, os, datetime, argparse, datetime, re, pathlib
+sys.path.append(str(pathlib.Path(__file__).absolute().parents[2])) #PIPELINE HOME FOLDER, TO IMPORT PIPELINE MODULES WHEN RUN AS SCRIPT
+from subscripts.downstream.file_index import File_index, index_path, covid_output_path
 
 parser = argparse.ArgumentParser(description='A script to calculate mutation statistics given range of dates or list of sample ids.') #argparser object to provide command-line functionality
 parser.add_argument('-d1', '--start_date', metavar='\b', help = 'A starting sequencing date of the reference interval (YYYY-MM-DD).', default=None, required=False)
@@ -35,30 +37,23 @@ def check_date(date_string):
 
 file_list = []
 
-if date_1 != None: #IF SELECTING BY DATE RANGE
-    if check_date(date_1) and check_date(date_2):
-        start = datetime.datetime.strptime(date_1, "%Y-%m-%d")
-        end = datetime.datetime.strptime(date_2, "%Y-%m-%d") 
-        for (root,dirs,files) in os.walk("/home/groups/nmrl/cov_analysis/covid_output/", topdown=True): #FINDING PATH TO EACH FILE THAT MATCHES TIME CRITERIA
-            for dir in dirs: 
-                if "NMRL" not in dir:
-                     continue                    
-                else: 
-                    date = datetime.datetime.strptime(dir.split("-")[1],"%Y_%m_%d")
-                    if start <= date <= end:
-                        for file in os.listdir(os.path.join(root,dir)):
-                            if ".ann.csv" in file:
-                                file_list.append(os.path.join(root,dir,file))
-else: #IF SELECTING BY SAMPLE LIST
-    id_df = pd.read_csv(id_list_path, header=0).astype(str)
-    full_id_set = set(id_df.iloc[:,1]+"_"+id_df.iloc[:,0]) #CONVERT COLUMN OF IDS TO SET (faster lookup)
-    sample_id_set = set(id_df.iloc[:,0])
-    id_set = full_id_set.union(sample_id_set)
-    for (root,dirs,files) in os.walk("/home/groups/nmrl/cov_analysis/covid_output/", topdown=True): #FINDING PATH TO EACH FILE THAT MATCHES TIME CRITERIA
-            for file in files:
-                if '.ann.csv' in file:
-                    if file.split(".",1)[0] in id_set:
-                        file_list.append(os.path.join(root, file))
+with File_index(index_path) as file_index:
+    file_index.refresh(covid_output_path) #RESCANS ONLY FOLDERS THAT CHANGED SINCE LAST SEARCH
+    if date_1 != None: #IF SELECTING BY DATE RANGE
+        if check_date(date_1) and check_date(date_2):
+            start = datetime.datetime.strptime(date_1, "%Y-%m-%d")
+            end = datetime.datetime.strptime(date_2, "%Y-%m-%d") 
+            run_folders = [path for name, path in file_index.run_folders(covid_output_path).items() if "NMRL" in name and start <= datetime.datetime.strptime(name.split("-")[1],"%Y_%m_%d") <= end] #FOLDERS THAT MATCH TIME CRITERIA
+            file_df = file_index.query(dirs=run_folders)
+            file_list = file_df.loc[file_df['name'].str.contains(".ann.csv", regex=False), 'path'].tolist()
+    else: #IF SELECTING BY SAMPLE LIST
+        id_df = pd.read_csv(id_list_path, header=0).astype(str)
+        full_id_set = set(id_df.iloc[:,1]+"_"+id_df.iloc[:,0]) #CONVERT COLUMN OF IDS TO SET (faster lookup)
+        sample_id_set = set(id_df.iloc[:,0])
+        id_set = full_id_set.union(sample_id_set)
+        file_df = file_index.query(root_path=covid_output_path, contexts=["ann.csv"])
+        file_df = file_df[file_df['name'].str.contains(".ann.csv", regex=False)]
+        file_list = file_df.loc[file_df['name'].str.split(".", n=1).str[0].isin(id_set), 'path'].tolist()
                 
 
 def calculate_statistics(file_list):
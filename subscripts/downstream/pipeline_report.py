@@ -3,8 +3,13 @@
 #IMPORTS
 ##########
 
-import sys, os, pandas as pd, re, time, concurrent.futures, subprocess, argparse, shutil, pathlib, filecmp, numpy as np, warnings
+import sys, os, json, pandas as pd, re, time, asyncio, concurrent.futures, subprocess, argparse, shutil, pathlib, filecmp, numpy as np, warnings
 from datetime import datetime
+from itertools import repeat
+sys.path.append(str(pathlib.Path(__file__).absolute().parents[2])) #PIPELINE HOME FOLDER, TO IMPORT PIPELINE MODULES WHEN RUN AS SCRIPT
+from subscripts.downstream.file_index import File_index, index_path, covid_output_path
+from subscripts.src.cluster_status import wait_for_job
+from subscripts.assembly.depth_stats import depth_file_stats
 
 
 #################
@@ -17,7 +22,6 @@ warnings.simplefilter(action='ignore', category=UserWarning)
 
 #PATHS
 subprocess_path = f'/mnt/home/groups/nmrl/cov_analysis/SARS-CoV2_assembly/subscripts/downstream/'
-covid_output_path = "/mnt/home/groups/nmrl/cov_analysis/covid_output/"
 report_folder_path = f'/mnt/home/groups/nmrl/cov_analysis/reports'
 raw_folder_path = f'/mnt/home/groups/nmrl/cov_analysis/raw'
 filter_path = f'/mnt/home/groups/nmrl/cov_analysis/SARS-CoV2_assembly/resources/downstream/report_filters.txt'
@@ -37,20 +41,36 @@ p_value = 0.05 #SET MAX ACCEPTABLE P VALUE TO CONFIRM THAT MUTATION IS DETECTED
 skip_excel_mining = False
 skip_sequence_stats = False
 rename_fasta_header = True
+cache_depth_arrays = False #STORE PARSED DEPTH REPORTS AS .NPY SIDECAR FILES NEXT TO THE REPORTS (FASTER REPEATED REPORTS)
 use_p_filter = False
 use_f_filter = True
 
+#SAMPLE ID IN GISAID-STYLE FASTA HEADERS
+gisaid_id_regex = re.compile(r'[A-Z]{2}[0-9]{4}\.B([0-9]{2}|[0-9])')
+
+#QC LOG PATTERNS (CUTADAPT AND IVAR TRIM LOGS)
+cutadapt_total_regex = re.compile(r"Total read pairs processed:\s+([0-9,]+)")
+cutadapt_passing_regex = re.compile(r"Pairs written \(passing filters\):\s+([0-9,]+)")
+ivar_trimmed_regex = re.compile(r"Trimmed primers from ([0-9.]+)%")
+
 #FILE FORMAT STRINGS TO LOOK FOR IN PIPELINE OUTPUT FILES
 context_path_map = {
     "ann.csv":[],
     "seq_depth.txt":[],
     "mapped_report.txt":[],
-    "consensus.fasta":[],
+    "consensus.fasta":[]
+}
+
+#OPTIONAL QC REPORTS (NOT REQUIRED FOR EVERY SAMPLE, NOT COPIED TO REPORT FOLDER; QC COLUMNS ARE EMPTY IF MISSING)
+qc_context_path_map = {
     "fastp_report.json":[],
     "cutadapt_log.txt":[],
     "ivar_log.txt":[]
 }
 
+#QC COLUMNS FILLED BY QC_INFO_EXTRACTOR
+qc_columns = ['READS_BEFORE_QC', 'READS_AFTER_QC', 'Q30_RATE_AFTER_QC', 'ADAPTER_PASSING_FRACTION', 'PRIMER_TRIMMED_PERCENT']
+
 
 
 
@@ -148,38 +168,26 @@ def find_report_files(arguments:dict, walk_path:str, context_path_map:dict, pid_
     context_path_map dictionary where every key represents a file extension to be included in the report,
     fills the context_path_map with paths to files if folder contains pipeline_outdir_format as substring and
     file matches the format and contains pid format as substring.  
-    If by_date set to False, search by id list is performed. Returns None.
-    '''
-    if by_date:
-        for (root,dirs,_) in os.walk(walk_path, topdown=True): #FINDING PATH TO EACH FOLDER THAT MATCHES TIME CRITERIA
-            for dir in dirs: 
-                if pipeline_outdir_format not in dir: #SCAN ONLY PROPERLY NAMED FOLDERS
-                    continue          
-                else: 
-                    date = datetime.strptime(dir.split("-")[1],"%Y_%m_%d") #EXTRACT DATE FROM FOLDER NAME
-                    if arguments['date_1'] <= date <= arguments['date_2']: #DATE IN SEARCH RANGE
-                        for file in os.listdir(os.path.join(root,dir)): #CHECK FILES IN THAT FOLDER
-                            for context in context_path_map: #AGAINST EVERY TYPE REQUIRED IN CONTEXT MAP
-                                if context in file and pid_format in file: #TYPE AND ID IS MATCHED
-                                    context_path_map[context].append(os.path.join(root,dir,file))
-            break
-    else:
-        id_list = list(pd.read_csv(arguments["id_list_path"], header=None).iloc[:,0]) #CONVERT COLUMN OF IDS TO LIST
-        for (root,dirs,_) in os.walk(covid_output_path, topdown=True): #FINDING PATH TO EACH FILE THAT MATCHES TIME CRITERIA
-            for dir in sorted(dirs)[::-1]: 
-                if pipeline_outdir_format not in dir: #SCAN ONLY PROPERLY NAMED FOLDERS
-                    continue          
-                else: 
-                    for file in os.listdir(os.path.join(root,dir)):
-                        for id in id_list:
-                         #CHECK FILES IN THAT FOLDER
-                            if f'_{id}_' in file or f'_{id}.' in file:
-                                for context in context_path_map:
-                                    if context in file:
-                                        context_path_map[context].append(os.path.join(root, file))
-                                break
-                    if all(len(context_path_map[context])==len(id_list) for context in context_path_map): break
-            break
+    If by_date set to False, search by id list is performed (for every id and file extension the file from the latest folder is used). 
+    Files are looked up in the file index, which is refreshed before the search. Returns None.
+    '''
+    with File_index(index_path) as file_index:
+        file_index.refresh(walk_path) #RESCANS ONLY FOLDERS THAT CHANGED SINCE LAST SEARCH
+        run_folders = {name:path for name, path in file_index.run_folders(walk_path).items() if pipeline_outdir_format in name} #SCAN ONLY PROPERLY NAMED FOLDERS
+        if by_date:
+            run_folders = {name:path for name, path in run_folders.items() if arguments['date_1'] <= datetime.strptime(name.split("-")[1],"%Y_%m_%d") <= arguments['date_2']} #DATE IN SEARCH RANGE
+            file_df = file_index.query(dirs=list(run_folders.values())) #FILES DIRECTLY IN MATCHED FOLDERS
+            for context in context_path_map: #AGAINST EVERY TYPE REQUIRED IN CONTEXT MAP
+                matched = file_df['name'].str.contains(context, regex=False) & file_df['name'].str.contains(pid_format, regex=False) #TYPE AND ID IS MATCHED
+                context_path_map[context].extend(file_df.loc[matched, 'path'])
+        else:
+            id_list = pd.read_csv(arguments["id_list_path"], header=None).iloc[:,0].astype(str).tolist() #CONVERT COLUMN OF IDS TO LIST
+            file_df = file_index.query(dirs=list(run_folders.values()), sample_ids=id_list)
+            file_df['run_mtime'] = file_df['run_folder'].map(file_index.run_folder_mtimes(walk_path)) #MODIFICATION TIME OF RUN FOLDER STORED IN INDEX
+            file_df = file_df.sort_values(['run_mtime', 'run_folder'], ascending=False, kind='stable') #LATEST FOLDERS FIRST
+            for context in context_path_map:
+                matched = file_df[file_df['name'].str.contains(context, regex=False)].drop_duplicates(subset='sample_id', keep='first')
+                context_path_map[context].extend(matched['path'])
 
 
 def copy_files(file_path:str, source_files_path:str):
@@ -189,9 +197,12 @@ def copy_files(file_path:str, source_files_path:str):
         shutil.copy(file_path, f'{source_files_path}/')
 
 
-def copy_files_parallel(path_list:list, source_files_path:str, procs:int=6, progress_bar:bool=True):
-    '''Function to copy files using multiprocessing'''
-    with concurrent.futures.ProcessPoolExecutor(max_workers=procs) as executor:
+def copy_files_parallel(path_list:list, source_files_path:str, procs:int=6, progress_bar:bool=True, mp_context=None):
+    '''
+    Function to copy files using multiprocessing.
+    Pass mp_context (e.g. multiprocessing.get_context("spawn")) when called from a worker thread, as forking a multithreaded process may deadlock.
+    '''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=procs, mp_context=mp_context) as executor:
         results = [executor.submit(copy_files, file_path, source_files_path) for file_path in path_list]
         processed_count = 0 #TO VIEW PROGRESS
         for _ in concurrent.futures.as_completed(results):
@@ -199,6 +210,42 @@ def copy_files_parallel(path_list:list, source_files_path:str, procs:int=6, prog
             if progress_bar: printProgressBar(processed_count, len(path_list), prefix = 'Progress:', suffix = 'Complete', length = 50)
 
 
+def submit_copy_jobs(executor:concurrent.futures.Executor, context_map:dict, source_files_path:str):
+    '''Submits copying of all files in context_map to source_files_path to the executor (thread pool, as copying is I/O-bound). Returns list of futures (joined at the end of the report generation).'''
+    return [executor.submit(copy_files, file_path, source_files_path) for context in context_map for file_path in context_map[context]]
+
+
+def combine_fasta_files(fasta_paths:list, combined_fasta_path:str):
+    '''Concatenates fasta files (ordered by file name) into combined_fasta_path (written to temporary file first). Returns combined_fasta_path.'''
+    with open(f'{combined_fasta_path}.tmp', 'wb') as combined_fasta:
+        for fasta_path in sorted(fasta_paths, key=os.path.basename):
+            with open(fasta_path, 'rb') as fasta_file: shutil.copyfileobj(fasta_file, combined_fasta)
+    os.replace(f'{combined_fasta_path}.tmp', combined_fasta_path)
+    return combined_fasta_path
+
+
+def submit_pangolin_job(source_files_path:str, log_path:str):
+    '''Submits run_pangolin.sh job to HPC (lineage report and completion marker are named by timestr_fasta prefix). Returns job id.'''
+    marker_path = f'{source_files_path}/{timestr_fasta}_lineage_report.done'
+    if os.path.isfile(marker_path): os.remove(marker_path) #MARKER LEFT BY PREVIOUS RUN
+    command = ['qsub', "-o", log_path, "-e", log_path, "-F", f"{1} {source_files_path} {timestr_fasta}", f"{subprocess_path}run_pangolin.sh"]
+    return subprocess.check_output(command).decode('UTF-8').strip()
+
+
+def wait_for_pangolin(job_id:str, source_files_path:str, log_path:str):
+    '''
+    Waits until pangolin job is finished (see cluster_status.wait_for_job), checking for the completion marker written by run_pangolin.sh after the lineage report is in place.
+    Returns path to the lineage report; exits if the job finished without marker or pangolin failed.
+    '''
+    marker_path = f'{source_files_path}/{timestr_fasta}_lineage_report.done'
+    status = asyncio.run(wait_for_job(job_id, report_pattern=marker_path, initial_delay=30, max_delay=120))
+    if not os.path.isfile(marker_path): sys.exit(f'ERROR: pangolin job {job_id} finished ({status}) without writing lineage report\nSee {log_path} for details')
+    with open(marker_path, 'r') as marker: exit_code = marker.read().strip()
+    if exit_code != '0': sys.exit(f'ERROR: pangolin failed with exit code {exit_code}\nSee {log_path} for details')
+    print(f'Pangolin typing job {job_id} is complete.')
+    return f'{source_files_path}/{timestr_fasta}_lineage_report.csv'
+
+
 def validate_context_file_paths(context_map:dict):
     '''
     Given dictionary mapping file format to full file path, returns None if all file formats are mapped to the same number of paths.
@@ -233,25 +280,25 @@ def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1,
         print()
 
 
-def readGenome(combined_fasta_path:str):
+def read_fasta_records(fasta_path:str):
     '''
-    Given path to multifasta, parses a file and returns python dictionary mapping each sequence header to the corresponding sequence.
+    Given path to multifasta, yields (header, sequence) tuples one record at a time (header is a string that starts with >, sequence is bytes without line breaks).
     '''
-    genome_dict = {}
-    with open(combined_fasta_path, 'r') as fasta_file:
+    header, sequence_lines = None, []
+    with open(fasta_path, 'rb') as fasta_file:
         for line in fasta_file:
-            if line[0] == '>': # IF LINE IS A HEADER (NEW HEADER IS REACHED)
-                fasta_header = line # STORE HEADER UNTILE NEXT HEADER IS REACHED
-                genome_dict[fasta_header] = '' # INITIALIZE AN EMPTY SEQUENCE MAPPED TO HEADER
-            if line[0] != '>': # IF LINE IS A PART OF THE GENOME SEQUENCE
-                genome_dict[fasta_header] += line.rstrip() # ADD THE LINE TO THE STRING THAT IS MAPPED TO THE LAST REACHED HEADER
-    return genome_dict
+            if line.startswith(b'>'): # IF LINE IS A HEADER (NEW HEADER IS REACHED)
+                if header is not None: yield header, b''.join(sequence_lines)
+                header, sequence_lines = line.rstrip(b'\r\n').decode(), []
+            elif header is not None: # IF LINE IS A PART OF THE GENOME SEQUENCE
+                sequence_lines.append(line.rstrip())
+    if header is not None: yield header, b''.join(sequence_lines)
 
 
 def get_nt_counting_stats(combined_fasta_path:str, skip:bool=False, headers_changed:bool = True, column_list:list = ["receiving_lab_sample_id","genome_length","genome_N_percentage","genome_GC_content"]):
     '''
-    Given path to multifasta, converts it to python dictionary.
-    For each sequence in the dictionary, extracts sample id, sequence length, 
+    Given path to multifasta, reads it one record at a time.
+    For each sequence, extracts sample id, sequence length, 
     N base content (%), GC-content (%). Returns the dataframe containing the 
     results for each sequence as rows and column_list contents as columns.
     '''
@@ -259,58 +306,73 @@ def get_nt_counting_stats(combined_fasta_path:str, skip:bool=False, headers_chan
     if skip: #IF SKIPPING OPTION IS CHOSEN
         print("Statistics calculation option skipped.")
         return None #RETURN NONE FOR TESTING PURPOSES
-    elif not skip: #IF SKIPPING OPTION IS NOT CHOSEN
-        sequence_stats_df = pd.DataFrame(columns=column_list) #INITIALIZING DATAFRAME TO STORE THE RESULTING STATISTICS
-        genome_dict_items = readGenome(combined_fasta_path).items() #GET HEADER:SEQUENCE PAIRS FROM READGENOME() OUTPUT
-        for header, sequence in genome_dict_items: #LOOPING THROUGH EACH HEADER-SEQUENCE PAIR IN GENOME DICT
-            sequence_length = len(sequence) #CALCULATING GENOME LENGTH
-            if sequence_length > 0: 
-                gc_content = round(100 * (sequence.count('G') + sequence.count('C')) / len(sequence), 2) #CALCULATING GC-CONTENT FOR EACH SEQUENCE
-                n_content = round(100 * (sequence.count('N') / len(sequence)), 2)
-            else: 
-                gc_content = 0
-                n_content = 0
-            if re.search(r'[A-Z]{2}[0-9]{4}\.B([0-9]{2}|[0-9])', header): new_header = re.search(r'[A-Z]{2}[0-9]{4}\.B([0-9]{2}|[0-9])', header).group(0)
-            elif headers_changed: new_header = header.split("/")[2] #EXTRACTING SAMPLE ID FROM FASTA HEADER TO BE USED LATER IN THE COLUMN MAPPING PROCESS
-            else: new_header = header.split("_")[1].strip() #EXTRACTING SAMPLE ID FROM FASTA HEADER TO BE USED LATER IN THE COLUMN MAPPING PROCESS IF FASTA HEADERS WERE NOT CHANGED
-            sequence_stats_df = sequence_stats_df.append({column_list[0]:new_header, column_list[1]:sequence_length, column_list[2]:n_content, column_list[3]:gc_content}, ignore_index=True, sort=False)
-            #ADDING RESULT ROW TO THE DATAFRAME
-        return sequence_stats_df # RETURN RESULTING DATAFRAME
-
-
-def csv_info_extractor(file_path:str, filter_list:list, f_value:float):
+    sample_ids, lengths, n_contents, gc_contents = [], [], [], []
+    for header, sequence in read_fasta_records(combined_fasta_path):
+        sequence_length = len(sequence) #CALCULATING GENOME LENGTH
+        if sequence_length > 0:
+            gc_content = round(100 * (sequence.count(b'G') + sequence.count(b'C')) / sequence_length, 2) #CALCULATING GC-CONTENT FOR EACH SEQUENCE
+            n_content = round(100 * sequence.count(b'N') / sequence_length, 2)
+        else:
+            gc_content, n_content = 0.0, 0.0
+        gisaid_id = gisaid_id_regex.search(header)
+        if gisaid_id: new_header = gisaid_id.group(0)
+        elif headers_changed: new_header = header.split("/")[2] #EXTRACTING SAMPLE ID FROM FASTA HEADER TO BE USED LATER IN THE COLUMN MAPPING PROCESS
+        else: new_header = header.split("_")[1].strip() #EXTRACTING SAMPLE ID FROM FASTA HEADER TO BE USED LATER IN THE COLUMN MAPPING PROCESS IF FASTA HEADERS WERE NOT CHANGED
+        sample_ids.append(new_header)
+        lengths.append(sequence_length)
+        n_contents.append(n_content)
+        gc_contents.append(gc_content)
+    return pd.DataFrame({ #RESULTING DATAFRAME IS CONSTRUCTED ONCE
+        column_list[0]:pd.Series(sample_ids, dtype=object),
+        column_list[1]:pd.Series(lengths, dtype=np.int64),
+        column_list[2]:pd.Series(n_contents, dtype=np.float64),
+        column_list[3]:pd.Series(gc_contents, dtype=np.float64),
+    })
+
+
+def compile_filter_matrix(filter_list:dict):
+    '''
+    Compiles filter_list (dictionary that maps filter name to set of mutation names) into mutation x filter incidence matrix.
+    Returns tuple (list of filter names, dictionary mapping mutation name to matrix row, incidence matrix, number of mutations in each filter).
+    '''
+    filter_names = list(filter_list.keys())
+    mutation_index = {mutation:row for row, mutation in enumerate(sorted(set().union(*filter_list.values())))}
+    incidence = np.zeros((len(mutation_index), len(filter_names)), dtype=np.int32)
+    for column, filter_name in enumerate(filter_names): incidence[[mutation_index[mutation] for mutation in filter_list[filter_name]], column] = 1
+    return filter_names, mutation_index, incidence, incidence.sum(axis=0)
+
+
+def csv_info_extractor(file_path:str, filter_matrix:tuple, f_value:float):
     """
     Parses a csv file, exctract mutation information
-    based on set of provided filters.
+    based on set of provided filters (compiled by compile_filter_matrix; filter_list dictionary is compiled on the fly).
+    Detected mutations are matched against all filters at once.
     """
+    if isinstance(filter_matrix, dict): filter_matrix = compile_filter_matrix(filter_matrix)
+    filter_names, mutation_index, incidence, filter_sizes = filter_matrix
     sample_id = file_path.split('/')[-1].split("_", 1)[1]
     sample_id = sample_id[:len(sample_id) - 8]
     processing_id = file_path.split('/')[-1][:9]
     result_row = {"SAMPLE_ID": sample_id, "processing_id": processing_id}
     try:
-        df = pd.read_csv(file_path)
-        for key in filter_list.keys(): 
-            if use_f_filter:
-                mut_df = df.loc[
-                    (df["AMINO_ACID_CHANGE"].isin(filter_list[key])) & (df["FREQUENCY"] >= f_value)
-                ]
-            elif use_p_filter:
-                mut_df = df.loc[
-                    (df["AMINO_ACID_CHANGE"].isin(filter_list[key])) & (df["P_ERR_MUT_CALL"] < p_value)
-                ]
-            if len(mut_df["P_ERR_MUT_CALL"]) == len(filter_list[key]): #IF THE NUMBER OF EXTRACTED (UNIQUE) ROWS MATCHES THE NUMBER OF MUTATION_NAMES FOR A GIVEN FILTER_NAME
-                result_row[key] = str(1) #ASSUME THAT THE MUTATION SPECIFIED BY THE FILTER WAS FOUND - ADD FILTER_NAME:1 PAIR TO THE RESULT_ROW DICT
-            else: result_row[key] = str(round(len(mut_df["P_ERR_MUT_CALL"])/len(filter_list[key]), 2)) #IF THE NUMBER OF EXTRACTED (UNIQUE) ROWS DOES NOT MATCH THE NUMBER OF MUTATION_NAMES FOR A GIVEN FILTER_NAME - ADD FILTER_NAME:%MATCH PAIR TO THE RESULT_ROW DICT
-    except:
+        df = pd.read_csv(file_path, usecols=["AMINO_ACID_CHANGE", "FREQUENCY", "P_ERR_MUT_CALL"])
+        if use_f_filter: detected = df["FREQUENCY"] >= f_value
+        elif use_p_filter: detected = df["P_ERR_MUT_CALL"] < p_value
+        rows = df.loc[detected, "AMINO_ACID_CHANGE"].map(mutation_index).dropna().to_numpy(dtype=np.int64) #MATRIX ROWS OF DETECTED MUTATIONS THAT ARE USED BY ANY FILTER
+        found_counts = incidence[rows].sum(axis=0) #NUMBER OF DETECTED (ROWS OF) MUTATIONS OF EACH FILTER
+        #IF ALL MUTATIONS OF A FILTER ARE FOUND - '1', ELSE FRACTION OF FOUND MUTATIONS (SAME STRING REPRESENTATION AS str(round(fraction, 2)))
+        fractions = [str(1) if found == size else str(round(found/size, 2)) for found, size in zip(found_counts.tolist(), filter_sizes.tolist())]
+        result_row.update(zip(filter_names, fractions))
+    except Exception:
         print(f'WARNING: failed to parse {file_path}')
-        for key in filter_list.keys():
+        for key in filter_names:
             result_row[key] = str(0)
     return result_row
 
 
 def depth_info_extractor(file_path):
     '''
-    Helper function to extract average and median coverage, 
+    Helper function to extract average and median coverage, breadth of coverage (1x, 10x, 20x), number of low coverage regions,
     sequencing_date and sequencing lab for each sample.
     Returns result dictionary where sample is identified by SAMPLE_ID column.
     '''
@@ -322,19 +384,20 @@ def depth_info_extractor(file_path):
     seq_lab = path_split[-2].split("-")[0].replace("_","(")+")"
     processing_id = file_path.split('/')[-1][:9]
     
-    #BY-DEFAULT ASSUMING THAT COVERAGE FILE IS EMPTY (NO READS MAPPED - COVERAGE 0)
+    #COVERAGE STATISTICS (EMPTY COVERAGE FILE - NO READS MAPPED - COVERAGE 0)
+    stats = depth_file_stats(file_path, cache=cache_depth_arrays)
     result_row = {
         'SAMPLE_ID':sample_id, 
         "seq_date":seq_date, 
         'seq_institution':seq_lab, 
         "processing_id":processing_id, 
-        'AVERAGE_COVERAGE':0, 
-        'MEDIAN_COVERAGE':0
+        'AVERAGE_COVERAGE':stats['mean_depth'], 
+        'MEDIAN_COVERAGE':stats['median_depth'],
+        'BREADTH_1X':stats['breadth_1x'],
+        'BREADTH_10X':stats['breadth_10x'],
+        'BREADTH_20X':stats['breadth_20x'],
+        'DROPOUT_REGIONS':stats['dropout_regions']
     }
-
-    if not os.stat(file_path).st_size == 0:
-        data = pd.read_csv(file_path, delimiter='\t').iloc[:,2]
-        result_row['AVERAGE_COVERAGE'], result_row['MEDIAN_COVERAGE'] = sum(data)/len(data), data.median()
     return result_row
     
 
@@ -349,68 +412,112 @@ def mapped_info_extractor(file_path):
     sample_id = sample_id[:len(sample_id) - 18]
     processing_id = file_path.split('/')[-1][:9]
     try:
-        result_row = {'SAMPLE_ID':sample_id, "processing_id":processing_id, 'TOTAL_READS':data[0].split(" ")[0], 'READS_MAPPED':data[4].split(" ")[0], 'MAPPED_FRACTION':round(int(data[4].split(" ")[0])/int(data[0].split(" ")[0]),2)}
+        total_reads, reads_mapped = int(data[0].split(" ")[0]), int(data[4].split(" ")[0])
+        result_row = {'SAMPLE_ID':sample_id, "processing_id":processing_id, 'TOTAL_READS':total_reads, 'READS_MAPPED':reads_mapped, 'MAPPED_FRACTION':round(reads_mapped/total_reads,2) if total_reads else 0.0}
     except IndexError:
         sys.exit(f'ERROR: empty file {file_path}')
     return result_row
 
 
-def run_extractors_parallel(context_map:dict, filter_list:dict, f_value:float):
+def qc_info_extractor(sample_files:dict):
+    '''
+    Helper function to extract read QC statistics from fastp json report, cutadapt log and ivar trim log of one sample.
+    Returns result dictionary with all qc_columns (READS_BEFORE_QC, READS_AFTER_QC, Q30_RATE_AFTER_QC, ADAPTER_PASSING_FRACTION, PRIMER_TRIMMED_PERCENT);
+    values of reports that are missing or can not be parsed are NaN.
+    '''
+    result_row = dict.fromkeys(qc_columns, np.nan)
+    try:
+        if 'fastp_report.json' in sample_files:
+            with open(sample_files['fastp_report.json'], 'r') as file: summary = json.load(file)['summary']
+            result_row['READS_BEFORE_QC'] = summary['before_filtering']['total_reads']
+            result_row['READS_AFTER_QC'] = summary['after_filtering']['total_reads']
+            result_row['Q30_RATE_AFTER_QC'] = summary['after_filtering']['q30_rate']
+        if 'cutadapt_log.txt' in sample_files:
+            with open(sample_files['cutadapt_log.txt'], 'r') as file: log = file.read()
+            total_pairs, passing_pairs = cutadapt_total_regex.search(log), cutadapt_passing_regex.search(log)
+            if total_pairs and passing_pairs and int(total_pairs[1].replace(',', '')) > 0:
+                result_row['ADAPTER_PASSING_FRACTION'] = round(int(passing_pairs[1].replace(',', ''))/int(total_pairs[1].replace(',', '')), 4)
+        if 'ivar_log.txt' in sample_files:
+            with open(sample_files['ivar_log.txt'], 'r') as file: primer_trimmed = ivar_trimmed_regex.search(file.read())
+            if primer_trimmed: result_row['PRIMER_TRIMMED_PERCENT'] = float(primer_trimmed[1])
+    except (OSError, ValueError, KeyError) as e:
+        print(f'WARNING: failed to parse QC reports of {sample_files}: {e}')
+    return result_row
+
+
+def sample_info_extractor(sample_files:dict, filter_matrix:tuple, f_value:float):
+    '''
+    Runs all extractors on the files of one sample (dictionary mapping context to file path) and returns single merged result dictionary,
+    so that every sample is processed by one worker in one task.
+    '''
+    result_row = csv_info_extractor(sample_files['ann.csv'], filter_matrix, f_value)
+    if 'seq_depth.txt' in sample_files: result_row.update(depth_info_extractor(sample_files['seq_depth.txt']))
+    if 'mapped_report.txt' in sample_files: result_row.update(mapped_info_extractor(sample_files['mapped_report.txt']))
+    result_row.update(qc_info_extractor(sample_files))
+    return result_row
+
+
+def batch_info_extractor(sample_batch:list, filter_matrix:tuple, f_value:float):
+    '''Runs sample_info_extractor on a batch of samples (compiled filter matrix is sent to the worker once per batch). Returns list of result dictionaries.'''
+    return [sample_info_extractor(sample_files, filter_matrix, f_value) for sample_files in sample_batch]
+
+
+def group_sample_files(context_map:dict):
+    '''
+    Given dictionary that maps file types to file paths, groups files by sample (file name without context suffix, e.g. COV000001_100001)
+    and returns list of context:path dictionaries of samples that have .ann.csv file (other files are optional).
+    '''
+    sample_map = {}
+    for context, paths in context_map.items():
+        for path in paths:
+            sample_map.setdefault(os.path.basename(path)[:-len(context)-1], {})[context] = path #CONTEXT IS PRECEDED BY _ OR .
+    return [sample_files for sample_files in sample_map.values() if 'ann.csv' in sample_files]
+
+
+def run_extractors_parallel(context_map:dict, filter_list:dict, f_value:float, executor:concurrent.futures.Executor=None, qc_context_map:dict=None):
     '''
     Runs extractor functions using multiprocessing and assembles the results in single dataframe.
     Returns pandas dataframe. 
     Contect_map - dictionary that maps file types to file paths, 
     filter_list - dictionary that maps arbitrary name to mutation name, 
-    f_value - frequency threshold to reduce false-negative mutation detections.
-    '''
-
-    #DETECTING SPECIFIC MUTATIONS FROM FILTERS
-    result_df = pd.DataFrame() #INIT EMPTY DATAFRAME FOR THE REPORT
-    with concurrent.futures.ProcessPoolExecutor() as executor: # APPLYING THE EXTRACTOR FUNCTION IN-PARALLEL ON DIFFERENT CORES
-        results = [executor.submit(csv_info_extractor, file_path, filter_list, f_value) for file_path in context_map['ann.csv']] #SUBMITTING FUNCTION CALLS TO DIFFERENT PROCESSES
-        processed_count = 0
-        for f in concurrent.futures.as_completed(results): #COLLECTING PROCESSING RESULTS TO THE DATAFRAME
-            result_df = result_df.append(f.result(), ignore_index=True) #ADD THE RESULT_ROW TO THE REPORT DF
-            processed_count += 1
-            printProgressBar(processed_count, len(context_map['ann.csv']), prefix = 'Extracting mutation stats:', suffix = 'Complete', length = 50)
-    
-#EXTRACTING COVERAGE DATA
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = [executor.submit(depth_info_extractor, file_path) for file_path in context_map['seq_depth.txt']] #SUBMITTING FUNCTION CALLS TO DIFFERENT PROCESSES
-        coverage_df = pd.DataFrame()
-        processed_count = 0
-        for f in concurrent.futures.as_completed(results): #COLLECTING PROCESSING RESULTS TO THE DATAFRAME
-            coverage_df = coverage_df.append(f.result(), ignore_index=True) #ADD THE RESULT_ROW TO THE REPORT DF
-            processed_count += 1
-            printProgressBar(processed_count, len(context_map['seq_depth.txt']), prefix = 'Extracting coverage stats:', suffix = 'Complete', length = 50)
-    result_df = pd.merge(result_df.applymap(str), coverage_df.applymap(str), how="left", on="SAMPLE_ID")
-
-#EXTRACTING MAPPING STATISTICS
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = [executor.submit(mapped_info_extractor, file_path) for file_path in context_map['mapped_report.txt']] #SUBMITTING FUNCTION CALLS TO DIFFERENT PROCESSES
-        mapped_df = pd.DataFrame()
-        processed_count = 0
-        for f in concurrent.futures.as_completed(results): #COLLECTING PROCESSING RESULTS TO THE DATAFRAME
-            mapped_df = mapped_df.append(f.result(), ignore_index=True) #ADD THE RESULT_ROW TO THE REPORT DF
-            processed_count += 1
-            printProgressBar(processed_count, len(context_map['mapped_report.txt']), prefix = 'Extracting mapping stats:', suffix = 'Complete', length = 50)
-
-#ASSEMBLING AND FORMATTING RESULT DATAFRAME
-    result_df = pd.merge(result_df.applymap(str), mapped_df.applymap(str), how="left", on="SAMPLE_ID")    
+    f_value - frequency threshold to reduce false-negative mutation detections,
+    executor - shared process pool (other report tasks may run in it at the same time), new pool is used if not supplied,
+    qc_context_map - optional dictionary that maps QC report types to file paths (samples without QC reports get empty QC columns).
+    All files of a sample are processed by one task (see sample_info_extractor); samples are sent to the pool in batches, filters are compiled once (see compile_filter_matrix).
+    '''
+
+    sample_file_list = group_sample_files({**context_map, **(qc_context_map or {})})
+    own_executor = executor is None
+    if own_executor: executor = concurrent.futures.ProcessPoolExecutor()
+    filter_matrix = compile_filter_matrix(filter_list) #COMPILED ONCE FOR ALL SAMPLES
+    batch_size = max(1, len(sample_file_list)//(4*(os.cpu_count() or 1))) #ABOUT 4 BATCHES PER WORKER
+    sample_batches = [sample_file_list[i:i+batch_size] for i in range(0, len(sample_file_list), batch_size)]
+    result_rows = [] #RESULT ROWS (DICTS), CONVERTED TO DATAFRAME ONCE
+    for batch_rows in executor.map(batch_info_extractor, sample_batches, repeat(filter_matrix), repeat(f_value)):
+        result_rows.extend(batch_rows)
+        printProgressBar(len(result_rows), len(sample_file_list), prefix = 'Extracting mutation, coverage, mapping and QC stats:', suffix = 'Complete', length = 50)
+    if own_executor: executor.shutdown()
+
+#ASSEMBLING AND FORMATTING RESULT DATAFRAME (COLUMNS KEEP THEIR TYPES)
     column_reorder_list = ['SAMPLE_ID', 'processing_id'] + list(filter_list.keys()) + ['AVERAGE_COVERAGE', 'MAPPED_FRACTION', 'READS_MAPPED', 'TOTAL_READS', 'MEDIAN_COVERAGE', 'seq_date', 'seq_institution']
-    result_df = result_df[column_reorder_list] #REORDERING COLUMNS BASED IN ORDER OF FILTERS IN REPORT_FILTERS.TXT FILE
+    column_reorder_list += qc_columns #QC COLUMNS ARE APPENDED AFTER EXISTING REPORT COLUMNS
+    column_reorder_list += ['BREADTH_1X', 'BREADTH_10X', 'BREADTH_20X', 'DROPOUT_REGIONS']
+    result_df = pd.DataFrame(result_rows, columns=column_reorder_list) #COLUMNS IN ORDER OF FILTERS IN REPORT_FILTERS.TXT FILE
     result_df.rename(columns={'SAMPLE_ID':"receiving_lab_sample_id"}, inplace=True) #FOR MERGING PURPOSES
     return result_df
 
 
-def add_meta_pango(df:pd.DataFrame):
-    '''Adds metadata to the raw result_df produced by extractor runner function. Returns resulting pandas dataframe.'''
+def add_meta_pango(df:pd.DataFrame, metadata_df:pd.DataFrame=None, sequence_stats_df:pd.DataFrame=None, pango_report_path:str=None):
+    '''
+    Adds metadata, sequence statistics and pangolin lineages (each if supplied) to the raw result_df produced by extractor runner function.
+    Returns resulting pandas dataframe.
+    '''
 
     #ADDING METADATA AND PANGOLIN LINEAGES
-    if all_excel_dump_df is not None: #IF METADATA MINING OPTION SELECTED - ADD METADATA TO THE MUTATION REPORT
-        df = pd.merge(df.applymap(str), all_excel_dump_df.applymap(str), how="left", on="receiving_lab_sample_id")
+    if metadata_df is not None: #IF METADATA MINING OPTION SELECTED - ADD METADATA TO THE MUTATION REPORT
+        df = pd.merge(df, metadata_df.astype({"receiving_lab_sample_id":str}), how="left", on="receiving_lab_sample_id")
     if sequence_stats_df is not None: #IF STATISTICS CALCULATION OPTION SELECTED - ADD SEQUENCE STATISTICS DATA TO THE MUTATION REPORT
-        df = pd.merge(df.applymap(str), sequence_stats_df.applymap(str), how="left", on="receiving_lab_sample_id")
+        df = pd.merge(df, sequence_stats_df.astype({"receiving_lab_sample_id":str}), how="left", on="receiving_lab_sample_id")
     if pango_report_path is not None: #IF PANGOLIN TYPING OPTION SELECTED - ADD PANGOLIN LINEAGE DATA TO THE MUTATION REPORT
         pango_report_df= pd.read_csv(pango_report_path) # READ PANGOLIN REPORT TO A DATAFRAME
         if re.match(r'[A-Z]{2}[0-9]{4}\.B', pango_report_df['taxon'][0]): pango_id_dict = {taxon:taxon for taxon in pango_report_df['taxon']}# MAP TAXOT TO SAMPLE ID IN A DICT
@@ -418,7 +525,7 @@ def add_meta_pango(df:pd.DataFrame):
         else: pango_id_dict = {taxon:taxon.split("_")[1] for taxon in pango_report_df["taxon"]} # MAP TAXON TO SAMPLE ID IN A DICT IF FASTA HEADERS WERE NOT CHANGED
         pango_report_df["receiving_lab_sample_id"] = pango_report_df["taxon"].map(pango_id_dict)
         pango_report_df = pango_report_df[["receiving_lab_sample_id", 'lineage']] #KEEP ONLY LINEAGE MATCHED AGAINST SAMPLE IDS
-        df = pd.merge(df.applymap(str), pango_report_df.applymap(str), how="left", on="receiving_lab_sample_id")
+        df = pd.merge(df, pango_report_df.astype({"receiving_lab_sample_id":str}), how="left", on="receiving_lab_sample_id")
     return df
 
 
@@ -474,16 +581,13 @@ def parse_directory_tree(df:pd.DataFrame, report_path:str, raw_folder_path:str):
     df['analysis_batch_id'] = np.chararray(df['receiving_lab_sample_id'].shape, itemsize=len(analysis_batch_id)+1).tostring()
     df.loc[df.processing_id != 'Z_BMC', ['analysis_date','analysis_batch_id']] = [analysis_date,analysis_batch_id]
 
-    #PREPARING FILES TO USE BASH UTILITIES
+    #FINDNG FULL PATHS TO FASTQ FILES USING FILE INDEX
     sample_ids = df['receiving_lab_sample_id']
-    sample_ids.to_csv(f'{report_path}/sample_ids.csv',header=False,index=False)
-
-    #FINDNG FULL PATHS TO FASTQ FILES USING BASH
     if not os.path.isfile(f'{report_path}/path_list.csv') or os.stat(f'{report_path}/path_list.csv').st_size == 0:
-        os.system(f'ls -R {raw_folder_path} | grep 1.fastq.gz > {report_path}/fastq_files.csv')
-        os.system(f'cat {report_path}/sample_ids.csv | while IFS="," read a ; do cat {report_path}/fastq_files.csv | grep "$a" ; done > {report_path}/sample_file_list.csv')
-        os.system(f'cat {report_path}/sample_file_list.csv | xargs -n1 -P12 -I% find {raw_folder_path}/ -type f -name % > {report_path}/path_list.csv')
-        os.system(f'rm {report_path}/sample_file_list.csv {report_path}/fastq_files.csv {report_path}/sample_ids.csv')
+        with File_index(index_path) as file_index:
+            file_index.refresh(raw_folder_path)
+            fastq_df = file_index.query(root_path=raw_folder_path, name_like='%1.fastq.gz', name_contains=sample_ids.astype(str).tolist()) #READ 1 FILES THAT CONTAIN SAMPLE ID
+        fastq_df['path'].to_csv(f'{report_path}/path_list.csv', header=False, index=False)
     sample_paths = pd.read_csv(f'{report_path}/path_list.csv', header=None)
     sample_frame = pd.DataFrame({'id':[],'path':[]})
 
@@ -583,14 +687,20 @@ def add_tree_info(result_df:pd.DataFrame, nmrl_samples:pd.DataFrame, eurofins_sa
     return result_df
 
 
-def mutation_report_generator(output_path:str, f_value:float):
+def mutation_report_generator(output_path:str, f_value:float, context_map:dict, filter_list:dict, report_path:str, executor:concurrent.futures.Executor=None,
+                              metadata_df:pd.DataFrame=None, sequence_stats_job:concurrent.futures.Future=None, pango_job:concurrent.futures.Future=None, pango_report_path:str=None,
+                              qc_context_map:dict=None):
     """
     Generate mutation report using helper functions to extract and process metadata and pipeline results.
+    Extractors are run on executor (see run_extractors_parallel); sequence stats and pangolin typing started by the caller (futures, if supplied)
+    are joined after the extractors are finished.
     """
 
 #EXTRACTING DATA FROM PIPELINE REPORTS, ADDING METADATA AND PANGO LINEAGES
-    result_df = run_extractors_parallel(context_path_map, filter_list, f_value)
-    result_df = add_meta_pango(result_df)
+    result_df = run_extractors_parallel(context_map, filter_list, f_value, executor, qc_context_map)
+    sequence_stats_df = sequence_stats_job.result() if sequence_stats_job is not None else None #JOINING SEQUENCE STATS
+    if pango_job is not None: pango_job.result() #WAITING FOR PANGOLIN JOB (EXITS IF IT FAILED) BEFORE ADDING LINEAGES
+    result_df = add_meta_pango(result_df, metadata_df, sequence_stats_df, pango_report_path)
     result_df.drop_duplicates(subset=['receiving_lab_sample_id'],inplace=True)
 
 #ADDING STATIC VALUES
@@ -631,6 +741,7 @@ if __name__ == "__main__":
 #SEARCHING FOR RELEVANT FILES & FOLDERS
     if valid_args["date_1"]: find_report_files(valid_args, covid_output_path, context_path_map=context_path_map) #SEARCHING BY DATE RANGE
     else: find_report_files(valid_args, covid_output_path, context_path_map=context_path_map, by_date=False) #SEARCHING BY SAMPLE ID
+    find_report_files(valid_args, covid_output_path, context_path_map=qc_context_path_map, by_date=bool(valid_args["date_1"])) #OPTIONAL QC REPORTS (NOT VALIDATED)
 
 
 #VERIFYING PROCESSING COMPLETION
@@ -651,10 +762,12 @@ if __name__ == "__main__":
         pathlib.Path(source_files_path).mkdir(parents=True, exist_ok=True)
 
 
-    #COPY FILES REQUIRED FOR REPORT TO THE SOURCE_FILES FOLDER UNDER CREATED REPORTS FOLDER
-    for context in context_path_map:
-        print(f'Copying {context} files:')
-        copy_files_parallel(context_path_map[context],source_files_path)
+    #COPY FILES REQUIRED FOR REPORT TO THE SOURCE_FILES FOLDER UNDER CREATED REPORTS FOLDER (IN BACKGROUND, USING SEPARATE THREAD POOL)
+    report_executor = concurrent.futures.ProcessPoolExecutor() #SHARED BY SEQUENCE STATS AND EXTRACTORS (CPU-BOUND)
+    report_executor.submit(os.getpid).result() #WORKERS ARE FORKED NOW, BEFORE COPYING AND PANGOLIN THREADS ARE STARTED (FORKING A MULTITHREADED PROCESS MAY DEADLOCK)
+    copy_executor = concurrent.futures.ThreadPoolExecutor(max_workers=6) #COPYING IS I/O-BOUND AND DOES NOT QUEUE AHEAD OF REPORT EXTRACTION
+    print(f'Copying {", ".join(context_path_map)} files in background.')
+    copy_jobs = submit_copy_jobs(copy_executor, context_path_map, source_files_path)
 
 
 ##################
@@ -672,18 +785,18 @@ if __name__ == "__main__":
     else: all_excel_dump_df = None
 
 # RUNNING PANGOLIN IF ALLOWED BY CONTROLLERS
+    pango_job = None #FUTURE OF THE PANGOLIN WAITER; JOINED IN MUTATION_REPORT_GENERATOR BEFORE ADDING LINEAGES
     if not valid_args['skip_pango']: # PROVIDING CORRECT PATH FOR RUN_PANGOLIN.SH & USING SUBPROCESS TO RUN IT WITH OPTIONS FROM CONTROL VARIABLE
+        #COMBINED FASTA IS PREPARED FROM ORIGINAL CONSENSUS FILES BEFORE SUBMISSION, SO NEITHER PANGOLIN NOR SEQUENCE STATS WAIT FOR COPYING
+        combined_fasta_path = combine_fasta_files(context_path_map['consensus.fasta'], f'{source_files_path}/{timestr_fasta}_combined.fasta')
         #RUNNING THE COMMAND
         print(f'Submitting pangolin typing job to HPC.')
         log_path = f'{log_folder_path}{datetime.now().strftime("%Y-%m-%d-%H-%M")}_pangolin.log'
-        command = ['qsub', "-o", log_path, "-e", log_path, "-F", f"{1} {source_files_path}", f"{subprocess_path}run_pangolin.sh"]
-        subprocess.check_call(command)
-        #WAITING FOR JOB TO COMPLETE
-        while not os.path.isfile(f'{source_files_path}/{timestr_fasta}_lineage_report.csv'): time.sleep(30) #whould be a good place for asyncio
-        #PATHS TO REPORTS
+        pango_job_id = submit_pangolin_job(source_files_path, log_path)
+        #WAITING FOR JOB TO COMPLETE IN BACKGROUND WHILE SEQUENCE STATS AND EXTRACTORS ARE RUNNING
+        pango_waiter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        pango_job = pango_waiter.submit(wait_for_pangolin, pango_job_id, source_files_path, log_path)
         pango_report_path = f'{source_files_path}/{timestr_fasta}_lineage_report.csv'
-        combined_path = [path for path in os.listdir(source_files_path) if 'combined.fasta' in path][0]
-        combined_fasta_path = f'{source_files_path}/{combined_path}'
     elif valid_args['skip_pango']:
         print(f'Pangolin typing skipped.')
         pango_report_path = f'{report_path}/{timestr_fasta}_lineage_report.csv'
@@ -692,9 +805,14 @@ if __name__ == "__main__":
 
 
 
-#GENERATING MUTATION REPORT
-    if not skip_sequence_stats: sequence_stats_df = get_nt_counting_stats(combined_fasta_path, skip_sequence_stats, rename_fasta_header) 
-    mutation_report_generator(source_files_path, f_value)
+#GENERATING MUTATION REPORT (SEQUENCE STATS AND EXTRACTORS SHARE THE PROCESS POOL, COPYING RUNS ALONGSIDE; RESULTS ARE JOINED IN MUTATION_REPORT_GENERATOR)
+    sequence_stats_job = None
+    if not skip_sequence_stats: sequence_stats_job = report_executor.submit(get_nt_counting_stats, combined_fasta_path, skip_sequence_stats, rename_fasta_header)
+    mutation_report_generator(source_files_path, f_value, context_path_map, filter_list, report_path, report_executor,
+                              all_excel_dump_df, sequence_stats_job, pango_job, pango_report_path, qc_context_path_map)
+    for copy_job in concurrent.futures.as_completed(copy_jobs): copy_job.result() #RAISES IF ANY FILE FAILED TO COPY
+    copy_executor.shutdown()
+    report_executor.shutdown()
 
 #PERFORMING CLEANUP
     os.system(f'mv {source_files_path}/pipeline_report.csv {report_path}')
@@ -11,8 +11,9 @@
 ctrl_arg1=${1:-1} #IF NO PARAMETER VALUE PROVIDED, SET 1ST PARAMETER VALUE TO 1 (PERFORM PANGOLIN TYPING)
 pango_sif_path=$(find /mnt/home/groups/nmrl/image_files/ -type f -name "pangolin.sif") #PATH TO PANGOLIN CONTAINER
 ctrl_arg2=${2:-"~/"} #IF NO PARAMETER SUPPLIED, SET TO 0, ELSE SET TO PROVIDED VALUE - PATH WHERE TO RUN PANGOLIN
+ctrl_arg3=${3:-$(date +"%m_%d_%Y")} #PREFIX OF OUTPUT FILES (DATE STRING OF THE SUBMITTING SCRIPT), TODAY'S DATE IF NOT SUPPLIED
 module load singularity
-now=$(date +"%m_%d_%Y")
+now=${ctrl_arg3}
 if [ "$ctrl_arg2" == "~/" ]
 then
     cd /mnt/home/groups/nmrl/cov_analysis/reports/report_${now}
@@ -20,6 +21,13 @@ else
     cd ${ctrl_arg2}
 fi
 
-awk '{print}' *.fasta > ${now}_combined.fasta
-singularity run $pango_sif_path pangolin ${now}_combined.fasta -t 20 --outfile ${now}_lineage_report.csv # RUNNING PANGOLIN AND PROVIDING TIME-DEPENDENT OUTPUT FILE NAMING
+rm -f ${now}_lineage_report.done
+if [ ! -f ${now}_combined.fasta ] # COMBINED FASTA MAY BE PREPARED BY THE SUBMITTING SCRIPT
+then
+    awk '{print}' *.fasta > ${now}_combined.fasta.tmp && mv ${now}_combined.fasta.tmp ${now}_combined.fasta
+fi
+singularity run $pango_sif_path pangolin ${now}_combined.fasta -t 20 --outfile ${now}_lineage_report.tmp.csv # RUNNING PANGOLIN AND PROVIDING TIME-DEPENDENT OUTPUT FILE NAMING
+pango_status=$?
+if [ $pango_status -eq 0 ]; then mv ${now}_lineage_report.tmp.csv ${now}_lineage_report.csv; fi # REPORT APPEARS ONLY WHEN IT IS COMPLETE
+echo $pango_status > ${now}_lineage_report.done # COMPLETION MARKER WITH PANGOLIN EXIT CODE, WATCHED BY PIPELINE_REPORT.PY
 
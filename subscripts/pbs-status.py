@@ -1,25 +1,17 @@
 #!/usr/bin/env python3
 #Source: https://github.com/Snakemake-Profiles/pbs-torque/blob/master/%7B%7Bcookiecutter.profile_name%7D%7D/pbs-status.py
+#Job status is read from the snapshot saved by subscripts/src/cluster_status.py (path supplied in CLUSTER_STATUS_SNAPSHOT variable);
+#scheduler is queried directly only if the snapshot is missing, outdated or does not contain the job yet
+import os
 import sys
-import subprocess
-import xml.etree.cElementTree as ET
+import pathlib
+sys.path.append(str(pathlib.Path(__file__).absolute().parents[1]))
+from subscripts.src.cluster_status import read_status, query_job
 
 jobid = sys.argv[1]
 
 try:
-    res = subprocess.run("qstat -f -x {}".format(jobid), check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-
-    xmldoc = ET.ElementTree(ET.fromstring(res.stdout.decode())).getroot()
-    job_state = xmldoc.findall('.//job_state')[0].text
-
-    if job_state == "C":
-        exit_status = xmldoc.findall('.//exit_status')[0].text
-        if exit_status == '0':
-            print("success")
-        else:
-            print("failed")
-    else:
-        print("running")
-
-except (subprocess.CalledProcessError, IndexError, KeyboardInterrupt) as e:
-    print("failed")
\ No newline at end of file
+    status = read_status(jobid, os.environ.get("CLUSTER_STATUS_SNAPSHOT"))
+    print(status if status is not None else query_job(jobid, os.environ.get("CLUSTER_STATUS_SCHEDULER", "pbs")))
+except KeyboardInterrupt:
+    print("failed")
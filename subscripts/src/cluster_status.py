@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+'''
+Job status cache for snakemake --cluster-status.
+Daemon (run as script) queries the scheduler for all jobs of the user at once every few seconds (qselect + qstat -f -x on PBS/Torque, squeue + sacct on Slurm)
+and saves job statuses to a JSON snapshot file, which is replaced atomically. Status script (pbs-status.py) reads job status from the snapshot
+and queries the scheduler for a single job only if the snapshot is missing, outdated or does not contain the job.
+Jobs submitted by the pipeline itself (see Module.check_job_completion) are awaited with wait_for_job(s).
+Only standard library is used, as status script is run by snakemake environment.
+'''
+import os, sys, json, time, glob, asyncio, argparse, subprocess
+import xml.etree.ElementTree as ET
+
+#SLURM JOB STATES THAT MEAN THAT JOB IS STILL IN QUEUE OR RUNNING
+slurm_active_states = {"PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "SUSPENDED", "REQUEUED", "RESIZING", "REQUEUE_HOLD", "REQUEUE_FED", "SIGNALING", "STAGE_OUT", "STOPPED", "PREEMPTED"}
+
+
+def parse_qstat_xml(xml_text:str) -> dict:
+    '''Given output of qstat -f -x (one or many jobs), returns dictionary mapping job id to status (running, success or failed).'''
+    statuses = {}
+    for job in ET.fromstring(xml_text).iter('Job'):
+        job_state = job.findtext('job_state')
+        if job_state in ('C', 'F'): #completed (Torque) or finished (PBS Pro)
+            exit_status = job.findtext('exit_status', default=job.findtext('Exit_status'))
+            statuses[job.findtext('Job_Id')] = "success" if exit_status == '0' else "failed"
+        else:
+            statuses[job.findtext('Job_Id')] = "running"
+    return statuses
+
+
+def parse_slurm_states(text:str) -> dict:
+    '''Given "job_id|state" lines (squeue -h -o "%i|%T" or sacct -n -X -P -o JobID,State), returns dictionary mapping job id to status.'''
+    statuses = {}
+    for line in text.splitlines():
+        if "|" not in line: continue
+        job_id, state = line.strip().split("|", 1)
+        state = state.split(" ")[0] #e.g. CANCELLED by 1000
+        statuses[job_id] = "running" if state in slurm_active_states else "success" if state == "COMPLETED" else "failed"
+    return statuses
+
+
+def poll_scheduler(scheduler:str="pbs", user:str=None) -> dict:
+    '''
+    Queries scheduler for all jobs of user (current user by default) and returns dictionary mapping job id to status.
+    On PBS/Torque job ids are selected with qselect and queried with a single qstat call, on Slurm squeue and sacct are filtered by user.
+    '''
+    user = user if user is not None else os.environ.get("USER", "")
+    if scheduler == "pbs":
+        job_ids = subprocess.run(["qselect", "-u", user], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().split()
+        if not job_ids: return {}
+        res = subprocess.run(["qstat", "-f", "-x"]+job_ids, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) #non-zero exit if a job was removed after qselect; statuses of other jobs are still printed
+        return parse_qstat_xml(res.stdout.decode()) if res.stdout.strip() else {}
+    elif scheduler == "slurm":
+        finished = subprocess.run(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-u", user, "-S", "now-7days"], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        active = subprocess.run(["squeue", "-h", "-o", "%i|%T", "-u", user], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        statuses = parse_slurm_states(finished.stdout.decode())
+        statuses.update(parse_slurm_states(active.stdout.decode())) #squeue is more up to date for active jobs
+        return statuses
+    raise ValueError(f"Unsupported scheduler: {scheduler}")
+
+
+def query_job(job_id:str, scheduler:str="pbs", default:str="failed") -> str:
+    '''
+    Queries scheduler for status of single job (used when job is not found in the snapshot). Returns running, success or failed,
+    or default if scheduler does not know the job (e.g. completed job was already removed from qstat) or query fails.
+    '''
+    try:
+        if scheduler == "slurm":
+            res = subprocess.run(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", job_id], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return parse_slurm_states(res.stdout.decode()).get(job_id.split(".")[0], default)
+        res = subprocess.run(["qstat", "-f", "-x", job_id], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return list(parse_qstat_xml(res.stdout.decode()).values())[0]
+    except (subprocess.CalledProcessError, ET.ParseError, IndexError, OSError):
+        return default
+
+
+def write_snapshot(snapshot_path:str, statuses:dict, scheduler:str, interval:float):
+    '''Saves job statuses to snapshot_path; temporary file is moved over the snapshot, so readers never see partially written file.'''
+    tmp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as snapshot: json.dump({"updated":time.time(), "interval":interval, "scheduler":scheduler, "jobs":statuses}, snapshot)
+    os.replace(tmp_path, snapshot_path)
+
+
+def read_status(job_id:str, snapshot_path:str, max_age:float=None):
+    '''
+    Returns status of job_id stored in the snapshot, or None if snapshot is missing, older than max_age seconds (3 polling intervals by default)
+    or does not contain the job. Job ids are matched in full or by the numeric part (e.g. 123 and 123.server).
+    '''
+    try:
+        with open(snapshot_path, 'r') as snapshot: data = json.load(snapshot)
+    except (OSError, ValueError, TypeError):
+        return None
+    max_age = max_age if max_age is not None else 3*data.get("interval", 10)
+    if time.time() - data.get("updated", 0) > max_age: return None #daemon is not running
+    jobs = data.get("jobs", {})
+    if job_id in jobs: return jobs[job_id]
+    short_ids = {id.split(".")[0]:status for id, status in jobs.items()}
+    return short_ids.get(job_id.split(".")[0])
+
+
+async def wait_for_job(job_id:str, scheduler:str="pbs", report_pattern:str=None, initial_delay:float=5, max_delay:float=300, backoff:float=2,
+                       report_check_interval:float=1, max_unknown:int=5, snapshot_path:str=None, verbose:bool=False) -> str:
+    '''
+    Waits until job_id is finished and returns its status: success, failed or unknown (job is no longer known to scheduler, but its report exists).
+    Only job_id is queried (from snapshot if it is fresh); delay between queries starts at initial_delay and is multiplied by backoff up to max_delay seconds.
+    Between queries the job report (glob report_pattern, e.g. *o12345) is checked every report_check_interval seconds
+    and the scheduler is queried right away when the report appears. If scheduler does not know the job max_unknown times in a row
+    and report is not found, job is considered failed. Several jobs can be awaited concurrently (see wait_for_jobs).
+    '''
+    delay, unknown_count, report_found = initial_delay, 0, False
+    while True:
+        status = read_status(job_id, snapshot_path) if snapshot_path is not None else None
+        if status is None: status = await asyncio.to_thread(query_job, job_id, scheduler, None)
+        if verbose: print(f"{job_id} : {status or 'unknown'} : {time.ctime(time.time())}")
+        if status in ("success", "failed"): return status
+        if status is None: #job not found or scheduler not available
+            unknown_count += 1
+            if report_pattern is not None and glob.glob(report_pattern): return "unknown"
+            if unknown_count >= max_unknown: return "failed"
+        else:
+            unknown_count = 0
+        waited = 0
+        while waited < delay: #sleep until next query, unless job report appears
+            await asyncio.sleep(min(report_check_interval, delay-waited))
+            waited += report_check_interval
+            if report_pattern is not None and not report_found and glob.glob(report_pattern):
+                report_found = True
+                break
+        delay = min(delay*backoff, max_delay)
+
+
+async def wait_for_jobs(job_reports:dict, scheduler:str="pbs", **kwargs) -> dict:
+    '''Given dictionary of job_id:report_pattern pairs, waits for all jobs concurrently and returns dictionary of job_id:status pairs (see wait_for_job).'''
+    statuses = await asyncio.gather(*(wait_for_job(job_id, scheduler, report_pattern, **kwargs) for job_id, report_pattern in job_reports.items()))
+    return dict(zip(job_reports, statuses))
+
+
+def run_daemon(snapshot_path:str, scheduler:str="pbs", interval:float=10, parent_pid:int=None, max_polls:int=None, user:str=None):
+    '''Polls scheduler for jobs of user every interval seconds and saves snapshot, until parent process exits (if parent_pid is supplied) or max_polls is reached.'''
+    poll_count = 0
+    while max_polls is None or poll_count < max_polls:
+        if parent_pid is not None:
+            try:
+                os.kill(parent_pid, 0) #check if parent is alive
+            except OSError:
+                break
+        try:
+            write_snapshot(snapshot_path, poll_scheduler(scheduler, user), scheduler, interval)
+        except (subprocess.CalledProcessError, ET.ParseError, OSError) as e: #keep old snapshot; it becomes outdated if scheduler stays unavailable
+            print(f"cluster_status: scheduler query failed: {e}", file=sys.stderr)
+        poll_count += 1
+        if max_polls is None or poll_count < max_polls: time.sleep(interval)
+    if os.path.isfile(snapshot_path) and max_polls is None: os.remove(snapshot_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Caches statuses of all cluster jobs in a JSON snapshot file for snakemake --cluster-status script.')
+    parser.add_argument('-s', '--snapshot', help='Path to the snapshot file', required=True)
+    parser.add_argument('-c', '--scheduler', help='Scheduler type (pbs or slurm)', choices=['pbs', 'slurm'], default='pbs')
+    parser.add_argument('-i', '--interval', help='Polling interval in seconds', type=float, default=10)
+    parser.add_argument('-p', '--parent_pid', help='Stop when process with this id exits', type=int, default=None)
+    parser.add_argument('-u', '--user', help='Query jobs of this user (current user by default)', default=None)
+    args = parser.parse_args()
+    run_daemon(args.snapshot, args.scheduler, args.interval, args.parent_pid, user=args.user)
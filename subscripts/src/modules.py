@@ -1,9 +1,11 @@
 from .utilities import Housekeeper as hk
-import os, warnings, re, subprocess, shutil, time, pandas as pd, glob
+from .cluster_status import wait_for_jobs
+import os, sys, warnings, re, subprocess, shutil, time, asyncio, pandas as pd
 from itertools import chain
 from getpass import getuser
 from pathlib import Path
 from shutil import move
+from glob import glob
 
 #Suppressing pandas warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -47,8 +49,13 @@ class Module:
         self.unpack_output = unpack_output #used to move files outside sample folders and do a rerun; used by unfold_output
         self.removed_samples = pd.DataFrame() #to store dataframe containing information about samples that were deemed invalid by the module
         self.pack_output = pack_output #switch to control putting output files into one folder named after sample_id; used by fold_output
-        self.cleanup_dict = {} #to map origin paths of input files to path in working directory; filled by move_to_wd; used by clear_working_directory
+        self.fold_manifest_path = f'{self.output_path}folded_output_manifest.json' #where fold_output records moved files; used by unfold_output
+        self.output_check = None #boolean sample x target dataframe indicating which output files exist; filled by check_module_output; used by write_output_check
+        self.cleanup_dict = {} #to map paths in working directory to origin (or redirect) paths of input files; filled by files_to_wd; used by clear_working_directory
+        self.staging_dict = {} #to map files staged in working directory to input files; filled by files_to_wd; used by clear_working_directory
         self.status_script = f"{os.path.dirname(Path(__file__).parents[0].absolute())}/pbs-status.py"
+        self.status_daemon_script = f"{Path(__file__).parents[0].absolute()}/cluster_status.py" #caches statuses of all cluster jobs for self.status_script; used by run_module_cluster
+        self.status_poll_interval = 10 #seconds between scheduler queries made by status daemon; used by run_module_cluster
 
     def fill_input_dict(self, substring_list=['reads_unclassified', 'reads_classified'], mixed:bool=False):
         '''Fills self.input_dict using self.input_path and self.module_name by
@@ -125,21 +132,32 @@ class Module:
 
     def check_module_output(self, mixed:bool=False):
         '''Checks if output files are generated according to self.module_name and adds check_note_{self.module_name} column 
-        to the self.sample_sheet dataframe, where boolean value is stored for each expected file.'''
-        ###Development - Automatically scale dirs_up depending on input structure - currently two dirs up max
+        to the self.sample_sheet dataframe, where boolean value is stored for each expected file.
+        Stores the same information as boolean sample x target dataframe in self.output_check (targets not expected for the sample are left empty).'''
         check_dict = hk.check_file_existance(file_list=self.target_list)
         if mixed:
-            id_check_dict = {id:"" for id in self.sample_sheet['sample_id'].to_list()+self.removed_samples['sample_id'].to_list()}
+            id_list = self.sample_sheet['sample_id'].to_list()+self.removed_samples['sample_id'].to_list()
         else:
-            id_check_dict = {id:"" for id in self.sample_sheet['sample_id']}
-        for file in check_dict:
-            two_dirs_up = os.path.basename(os.path.dirname(os.path.dirname(file)))+"/"+os.path.basename(os.path.dirname(file))+"/"+os.path.basename(file) #required for outputs where directory patters are defined in addition to file extensions
-            if isinstance(self.targets, list): #if only un-specific targets are supplied
-                id = os.path.basename(re.sub("("+"|".join(self.targets)+")","",two_dirs_up))
-            elif isinstance(self.targets, dict): #if taxonomy-based targets are supplied - all species-specific target lists are to be merged into one list using chain.from_iterables
-                id = os.path.basename(re.sub("("+"|".join(chain.from_iterable(self.targets.values()))+")","",two_dirs_up))
-            id_check_dict[id] += f"|{file}:{check_dict[file]}"
-        self.sample_sheet = hk.map_new_column(self.sample_sheet, id_check_dict, 'sample_id', f"check_note_{self.module_name}")
+            id_list = self.sample_sheet['sample_id'].to_list()
+        if isinstance(self.targets, list): #if only un-specific targets are supplied
+            target_list = list(self.targets)
+        elif isinstance(self.targets, dict): #if taxonomy-based targets are supplied - all species-specific target lists are to be merged into one list using chain.from_iterables
+            target_list = list(dict.fromkeys(chain.from_iterable(self.targets.values())))
+        target_regex = re.compile("^(?P<sample_id>.+?)(?P<target>"+"|".join(map(re.escape, target_list))+")$") #longest target suffix is matched
+        check_df = pd.DataFrame({'file':pd.Series(list(check_dict), dtype=object), 'exists':pd.Series(list(check_dict.values()), dtype=bool)})
+        relative_paths = [file[len(self.output_path):] if file.startswith(self.output_path) else os.path.basename(file) for file in check_df['file']]
+        matches = [target_regex.match(path) for path in relative_paths]
+        check_df[['sample_id', 'target']] = pd.DataFrame([match.group('sample_id', 'target') if match else (path, None) for match, path in zip(matches, relative_paths)], columns=['sample_id', 'target'], dtype=object)
+        check_df['sample_id'] = check_df['sample_id'].map(os.path.basename)
+        check_notes = ("|" + check_df['file'] + ":" + check_df['exists'].astype(str)).groupby(check_df['sample_id'], sort=False).agg("".join).to_dict()
+        self.sample_sheet = hk.map_new_column(self.sample_sheet, {id:check_notes.get(id, "") for id in id_list}, 'sample_id', f"check_note_{self.module_name}")
+        self.output_check = check_df.pivot_table(index='sample_id', columns='target', values='exists', aggfunc='all').reindex(index=id_list, columns=target_list).astype('boolean')
+        self.output_check.index.name, self.output_check.columns.name = 'sample_id', None
+
+
+    def write_output_check(self):
+        '''Creates {self.module_name}_output_check.csv file in the self.output_path folder (next to the sample sheet), using self.output_check.'''
+        self.output_check.to_csv(f"{self.output_path}{self.module_name}_output_check.csv", header=True, index=True)
 
 
     def supply_sample_sheet(self, removed:bool=False): #getter, may not be required now as all variables are public, but makes it easier to encapsulate later, if needed
@@ -211,28 +229,33 @@ class Module:
             raise Exception(f"{self.module_name} job submission error: {msg}")
         
 
-    def check_job_completion(self, sleeping_time=5):
+    def check_job_completion(self, sleeping_time=5, max_sleeping_time=300):
         """
-        Checks if the job is complete every n seconds, given sleeping time (in seconds) between checks (int). 
-        Waiting is finished when the job status is C (complete), then the file with job std(out/err) is moved to self.output_path.
+        Waits until the submitted job is finished, given initial and maximal sleeping time (in seconds) between job status checks (int);
+        sleeping time is doubled after every check. Then the file with job std(out/err) is moved to self.output_path.
         """
-        self.job_id = self.job_id.decode('UTF-8').strip() #job id is returned as byte string
-        search_string = f"{self.job_id}.*{getuser()}.*[RCQ]" #regex to check the current job status (Running, Complete or Queued)
-        print(f'Going to sleep until ardetype/{self.module_name}/{self.job_id} job is finished') #Informing the user
-        while True: #event-driven check
-            qstat = os.popen("qstat").read() #read qstat output
-            check_job = re.search(search_string,qstat).group(0) #check job status
-            print(f"{check_job} : {time.ctime(time.time())}") #inform the user about last check time
-            if check_job[-1] == "C": #if job is complete - stop waiting
-                print(f'Finished waiting: ardetype/{self.module_name}/{self.job_id} is complete')
-                break
-            time.sleep(sleeping_time) #if job is not complete - wait some more
-        job_report = f"*o{self.job_id.split('.')[0]}" #job stdout/stderr file name (job report)
-        try:
-            move(job_report, f'{self.output_path}/{self.module_name}_{self.job_name}_{self.job_id}.txt') #move job report to the output folder, where the rest of related files are generated
-        except:
-            print(f'Failed to move {job_report} to {self.output_path}')
-        #os.system(f"mv {job_report} {self.output_path}/{self.module_name}_{self.job_name}_{self.job_id}.txt") #move job report to the output folder, where the rest of related files are generated
+        return Module.check_jobs_completion([self], sleeping_time, max_sleeping_time)[0]
+
+
+    @staticmethod
+    def check_jobs_completion(modules:list, sleeping_time=5, max_sleeping_time=300):
+        """
+        Waits concurrently until jobs of all given modules (submitted with submit_module_job) are finished, querying scheduler only for these job ids
+        (see cluster_status.wait_for_job). Job report of each module is moved to its output folder. Returns list of job statuses (success, failed or unknown).
+        """
+        for module in modules:
+            if isinstance(module.job_id, bytes): module.job_id = module.job_id.decode('UTF-8').strip() #job id is returned as byte string
+            print(f'Going to sleep until ardetype/{module.module_name}/{module.job_id} job is finished') #Informing the user
+        job_reports = {module.job_id:f"*o{module.job_id.split('.')[0]}" for module in modules} #job stdout/stderr file name (job report)
+        statuses = asyncio.run(wait_for_jobs(job_reports, initial_delay=sleeping_time, max_delay=max_sleeping_time, verbose=True))
+        for module in modules:
+            print(f'Finished waiting: ardetype/{module.module_name}/{module.job_id} is complete ({statuses[module.job_id]})')
+            job_report = glob(job_reports[module.job_id])
+            try:
+                move(job_report[0], f'{module.output_path}/{module.module_name}_{module.job_name}_{module.job_id}.txt') #move job report to the output folder, where the rest of related files are generated
+            except (IndexError, OSError):
+                print(f'Failed to move {job_reports[module.job_id]} to {module.output_path}')
+        return [statuses[module.job_id] for module in modules]
 
 
     def run_module_cluster(self, job_count): #AKA do_not_mess_with_my_quatation_marks
@@ -241,6 +264,7 @@ class Module:
         Allows the snakemake to do job submissions to the computing nodes automatically.     
         '''
         #job_submission command to be used by snakmake to automatically submit jobs to HPC; stuff in curly brackets are snakemake arguments, not python variables
+        scheduler = 'slurm' if os.path.basename(self.cluster_config_path) == 'cluster_slurm.yaml' else 'pbs'
         if os.path.basename(self.cluster_config_path) == 'cluster.yaml':
             job_submission_command = '"qsub -N {cluster.jobname} -l procs={cluster.procs},pmem={cluster.pmem},walltime={cluster.walltime} -q {cluster.queue} -j {cluster.jobout} -o {cluster.outdir} -V"'
         elif os.path.basename(self.cluster_config_path) == 'cluster_slurm.yaml':
@@ -250,17 +274,28 @@ class Module:
         eval "$(conda shell.bash hook)";
         conda activate /mnt/home/$(whoami)/.conda/envs/mamba_env/envs/snakemake;
         snakemake --reason --nolock --restart-times 3 --jobs {job_count} --cluster-config {self.cluster_config_path} --cluster-status {self.status_script} --cluster-cancel qdel --configfile {self.config_file_path} --snakefile {self.snakefile_path} --keep-going --use-envmodules --use-conda --conda-frontend conda --rerun-incomplete --latency-wait 30 {self.force_all} {self.dry_run} --cluster {job_submission_command} {self.rule_graph} '''
+        #status daemon queries scheduler for all jobs every few seconds, status script reads job status from its snapshot instead of running qstat for every job
+        snapshot_path = f'{self.output_path}{self.module_name}_cluster_status.json'
+        status_env = dict(os.environ, CLUSTER_STATUS_SNAPSHOT=snapshot_path, CLUSTER_STATUS_SCHEDULER=scheduler)
+        status_daemon = subprocess.Popen([sys.executable, self.status_daemon_script, '-s', snapshot_path, '-c', scheduler, '-i', str(self.status_poll_interval), '-p', str(os.getpid())])
         try:
-            subprocess.check_call(shell_command, shell=True)
+            subprocess.check_call(shell_command, shell=True, env=status_env)
         except subprocess.CalledProcessError as msg:
             raise Exception(f"{self.module_name} module process running error: {msg}")
+        finally:
+            status_daemon.terminate()
+            status_daemon.wait()
+            if os.path.isfile(snapshot_path): os.remove(snapshot_path)
 
 
-    def run_module(self, job_count, jobscript_path='./subscripts/ardetype_jobscript.sh'):
-        '''Runs module on hpc as job or as snakemake submitter (on login node), based on self.run_mode value (True - job, False - submitter).'''
+    def run_module(self, job_count, jobscript_path='./subscripts/ardetype_jobscript.sh', wait:bool=True):
+        '''
+        Runs module on hpc as job or as snakemake submitter (on login node), based on self.run_mode value (True - job, False - submitter).
+        In job mode, if wait is False, job is only submitted (several submitted modules can be awaited at once with Module.check_jobs_completion).
+        '''
         if self.run_mode:
             self.submit_module_job(jobscript_path)
-            self.check_job_completion()
+            if wait: self.check_job_completion()
         else:
             self.run_module_cluster(job_count)
 
@@ -273,71 +308,89 @@ class Module:
 
 
     def clear_working_directory(self):
-        '''Moves all files from working directory to source directory stored in self.cleanup_dict.'''
+        '''
+        Removes files staged in working directory by files_to_wd (input files are not moved, so only staged links/copies are removed) and,
+        if redirection was requested, moves source files to the location stored in self.cleanup_dict. Other files are moved to the location stored in self.cleanup_dict.
+        '''
         for key in self.cleanup_dict: 
             try:
-                move(key, self.cleanup_dict[key])
+                if key in self.staging_dict: #staged input file
+                    source_path = self.staging_dict[key]
+                    hk.unstage_file(key, source_path)
+                    if self.cleanup_dict[key] != source_path: move(source_path, self.cleanup_dict[key]) #redirect
+                else:
+                    move(key, self.cleanup_dict[key])
             except:
                 continue
+        self.staging_dict = {}
             
 
     def files_to_wd(self, redirect_filter:dict=None):
         '''
-        Moves all input files from input and output directories to working directory before running snakemake.
+        Stages all input files from input and output directories in working directory before running snakemake. Input files are never moved: 
+        each file is hardlinked, reflinked or (if nothing else is possible) copied to the working directory (see hk.stage_file).
         If redirect_filter dictionary is passed, checks each files against the keys of it. If a match is found,
         sets source path in self.cleanup_dict to the value mapped to the corresponding key of redirect_filter (only one filter applied to each file).
+        Files that already exist in working directory and differ from the input file are not changed and not staged.
+        Files that are already in the working directory (e.g. working directory is the input directory) are used in place and never removed.
         '''
         os.makedirs(os.path.abspath(self.config_file['work_dir']), exist_ok=True)
+        path_map, map_dict = {}, {}
         for format in self.input_dict:
-            map_dict = {}
             for source_path in self.input_dict[format]:
                 full_path = f"{self.config_file['work_dir']}/{os.path.basename(source_path)}" #full input path to file
+                map_dict[full_path] = source_path #no redirection
                 if redirect_filter is not None: #if redirection was requested
                     for filter in redirect_filter: #starting to check filters against file names
                         if filter in source_path: #if match
                             map_dict[full_path] = redirect_filter[filter] #redirect
-                            try:
-                                move(source_path, os.path.abspath(self.config_file['work_dir']))  #move to wd
-                            except:
-                                break #match found by moving file was not succesful
                             break #stop matching filters
-                    if full_path not in map_dict: #if all filters are parsed but no match (if match happend, the full path will be in map_dict)
-                        map_dict[full_path] = source_path #no redirection
-                        try:
-                            move(source_path, os.path.abspath(self.config_file['work_dir']))
-                        except:
-                            continue
-                else: #if no filtering required during function call
-                    map_dict[full_path] = source_path
-                    try:
-                        move(source_path, os.path.abspath(self.config_file['work_dir']))
-                    except:
-                        continue
-            self.cleanup_dict.update(map_dict) #add new entries to self.cleanup_dict - these are use to place files back to source/redirect location during cleanup
+                if hk.is_same_path(source_path, full_path): #input file is already in working directory
+                    if map_dict[full_path] != source_path: self.cleanup_dict[full_path] = map_dict[full_path] #moved only if redirected
+                    continue
+                path_map[source_path] = full_path
+        staging_methods = hk.stage_files(path_map)
+        for source_path, full_path in path_map.items():
+            if staging_methods[full_path] == 'FAILED': #existing different file or no permissions
+                print(f"Could not stage {source_path} in working directory: {full_path} exists or is not writable.")
+                continue
+            self.staging_dict[full_path] = source_path
+            self.cleanup_dict[full_path] = map_dict[full_path] #add new entries to self.cleanup_dict - these are use to place files to redirect location during cleanup
+        method_counts = pd.Series(list(staging_methods.values()), dtype=object).value_counts()
+        print(f"Staged {len(self.staging_dict)} input files in working directory ({', '.join(f'{method}: {count}' for method, count in method_counts.items())}).")
 
 
     def fold_output(self):
         '''Creates a folder for each sample_id in self.sample_sheet and self.removed_samples.
-        Structures the pipeline output by putting all tartets for each sample into curresponding folder.'''
+        Structures the pipeline output by putting all tartets for each sample into curresponding folder.
+        Output folder is listed once, every entry is assigned to the sample id it starts with and moved using a pool of threads;
+        moved paths are saved to self.fold_manifest_path, which is used by unfold_output.'''
         full_sample_list = self.sample_sheet['sample_id'].tolist() 
         if not self.removed_samples.empty: full_sample_list += self.removed_samples['sample_id'].to_list()
-        for sample_id in full_sample_list: 
-            os.makedirs(f'{self.output_path}folded_{sample_id}_output', exist_ok=True)
-            for file in glob.glob(f'{self.output_path}{sample_id}*'): 
-                try:
-                    move(file, f'{self.output_path}folded_{sample_id}_output/')
-                except:
-                    continue
+        for sample_id in full_sample_list: os.makedirs(f'{self.output_path}folded_{sample_id}_output', exist_ok=True)
+        with os.scandir(self.output_path) as entries: names = [entry.name for entry in entries if not entry.name.startswith('folded_')]
+        buckets = hk.bucket_by_sample_id(names, full_sample_list)
+        path_map = {f'{self.output_path}{name}':f'{self.output_path}folded_{sample_id}_output/{name}' for name, sample_id in buckets.items()}
+        renaming_logs = hk.rename_files(path_map, progress_bar=False)
+        manifest = hk.read_json_dict(self.fold_manifest_path) if os.path.isfile(self.fold_manifest_path) else {} #sample_id: {folded path: original path}
+        for (old_path, new_path), record in zip(path_map.items(), renaming_logs):
+            if record.endswith(' OK\n'): manifest.setdefault(buckets[os.path.basename(old_path)], {})[new_path] = old_path
+        hk.write_json(manifest, self.fold_manifest_path)
 
 
     def unfold_output(self):
-        '''Moves target files outside of folders created by fold_output method in order to avoid having to move file out manually to do a rerun.'''
+        '''Moves target files outside of folders created by fold_output method in order to avoid having to move file out manually to do a rerun.
+        Files are moved back to the paths recorded in self.fold_manifest_path; folders of samples missing in the manifest are listed and moved out entirely.'''
+        manifest = hk.read_json_dict(self.fold_manifest_path) if os.path.isfile(self.fold_manifest_path) else {}
+        path_map = {}
         for id in self.sample_sheet['sample_id']: 
-            for file in glob.glob(f'{self.output_path}folded_{id}_output/*'):
-                try:
-                    move(file, self.output_path)
-                except:
-                    continue
+            if id in manifest:
+                path_map.update(manifest.pop(id))
+            elif os.path.isdir(f'{self.output_path}folded_{id}_output'): #folded without manifest
+                path_map.update({f'{self.output_path}folded_{id}_output/{name}':f'{self.output_path}{name}' for name in os.listdir(f'{self.output_path}folded_{id}_output')})
+        hk.rename_files(path_map, progress_bar=False)
+        if manifest: hk.write_json(manifest, self.fold_manifest_path)
+        elif os.path.isfile(self.fold_manifest_path): os.remove(self.fold_manifest_path)
 
     def set_permissions(self, permissions:str='775'):
         '''Given Linux permission string in numeric format, sets requested permissions (775 by default) recursively on the contents of self.output_path.'''
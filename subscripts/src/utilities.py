@@ -1,48 +1,103 @@
-import os, sys, yaml, pandas as pd, re, argparse, json, base64, requests, numpy as np, urllib, pandas as pd, concurrent.futures
+import os, sys, yaml, pandas as pd, re, argparse, json, base64, requests, numpy as np, urllib, pandas as pd, concurrent.futures, fcntl
 from dateutil.relativedelta import relativedelta
 from Bio import SeqIO, Entrez
 from datetime import datetime
 from pathlib import Path
-from shutil import move
+from shutil import move, copy2
 
 
 class Housekeeper:
     '''Class to contain methods that perform general housekeeping tasks for the pipeline, 
     like reading from/writing to certain file types, generating sample sheets etc.'''
 
+    FICLONE = 0x40049409 #linux ioctl request to clone (reflink) file contents; used by stage_file
+    read_number_regex = re.compile(r"_R?(?P<read>[12])(?=[_.])") #read number in the generic part of fastq file name (e.g. _R1_001.fastq.gz); used by create_sample_sheet
+
+    @staticmethod
+    def scan_directory(dir_path:str, include_regex:re.Pattern, exclude_regex:re.Pattern=None):
+        '''
+        Given absolute path to directory, compiled regex that file names should contain and optional compiled regex that file paths should not contain,
+        lists directory once and returns list of matching file paths and list of subdirectories to descend into (symlinked directories are skipped), both in listing order.
+        Unreadable directories are treated as empty.
+        '''
+        files, subdirs = [], []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink(): subdirs.append(os.path.join(dir_path, entry.name))
+                    elif include_regex.search(entry.name):
+                        file_path = f"{dir_path}/{entry.name}"
+                        if exclude_regex is None or not exclude_regex.search(file_path): files.append(file_path)
+        except OSError:
+            pass
+        return files, subdirs
+
+
+    @staticmethod
+    def scan_folder(folder_pth_str:str, file_fmt_str:str, substr_lst:list=None, regstr_lst:list=None, max_depth:int=None):
+        '''
+        Generator version of parse_folder: yields absolute paths of matching files one directory at a time, in the same (top-down) order as parse_folder.
+        max_depth limits how many subfolder levels are scanned (0 - only folder_pth_str itself, None - no limit).
+        '''
+        if not os.path.isdir(folder_pth_str): raise ValueError(f'Expected path to folder - {folder_pth_str} does not exist or refers to a file')
+        include_regex, exclude_regex = Housekeeper.compile_path_filters(file_fmt_str, substr_lst, regstr_lst)
+        stack = [(os.path.abspath(folder_pth_str), 0)]
+        while stack:
+            dir_path, depth = stack.pop()
+            files, subdirs = Housekeeper.scan_directory(dir_path, include_regex, exclude_regex)
+            yield from files
+            if max_depth is None or depth < max_depth:
+                stack.extend((subdir, depth+1) for subdir in reversed(subdirs)) #reversed, so that subfolders are scanned in listing order
+
+
     @staticmethod
-    def parse_folder(folder_pth_str:str, file_fmt_str:str, substr_lst:list=None, regstr_lst:list=None) -> list:
+    def compile_path_filters(file_fmt_str:str, substr_lst:list=None, regstr_lst:list=None):
+        '''Compiles file format pattern (matched against file names) and joined exclusion patterns (matched against file paths; None if no exclusions) used by scan_folder.'''
+        exclusions = (substr_lst or []) + (regstr_lst or [])
+        return re.compile(file_fmt_str), re.compile('|'.join(exclusions)) if exclusions else None
+
+
+    @staticmethod
+    def parse_folder(folder_pth_str:str, file_fmt_str:str, substr_lst:list=None, regstr_lst:list=None, max_depth:int=None, threads:int=1) -> list:
         '''
         Given path to the folder (folder_pth_str) and file format (file_fmt_str), returns a list, 
         containing absolute paths to all files of specified format found in folder and subfolders,
-        except for files that contain patterns to exclude (specified in regstr_lst) or substrings to exclude (specified in substr_lst).    
+        except for files that contain patterns to exclude (specified in regstr_lst) or substrings to exclude (specified in substr_lst).
+        max_depth limits how many subfolder levels are scanned (None - no limit); if threads > 1, directories of each level are listed in parallel
+        (useful on network file systems), the order of returned paths is the same in both cases.
         '''
+        if threads <= 1: return list(Housekeeper.scan_folder(folder_pth_str, file_fmt_str, substr_lst, regstr_lst, max_depth))
         if not os.path.isdir(folder_pth_str): raise ValueError(f'Expected path to folder - {folder_pth_str} does not exist or refers to a file')
-        name_series = pd.Series(dtype="str") #initialize pandas series to store path values
-        for (root,_,files) in os.walk(folder_pth_str, topdown=True): #get list of file paths (from parent dir & subdir)
-            new_files = pd.Series(files, dtype="str") #convert file names in new folder to pandas series
-            new_files = new_files[new_files.str.contains(file_fmt_str)] #keep only paths to files of specifed format
-            new_files = f"{os.path.abspath(root)}/"  + new_files #append absolute path to the file
-            if substr_lst is not None and regstr_lst is not None and (len(substr_lst) + len(substr_lst) > 0): #if both regex and substring filters provided
-                new_files = new_files[~new_files.str.contains('|'.join(substr_lst+regstr_lst))].reset_index(drop=True)
-            elif regstr_lst is not None and len(regstr_lst) > 0: #if only regex filters provided
-                if len(regstr_lst) > 1: #checking single filter case
-                    new_files = new_files[~new_files.str.contains('|'.join(regstr_lst))].reset_index(drop=True)
-                else:
-                    new_files = new_files[~new_files.str.contains(regstr_lst[0])].reset_index(drop=True)
-            elif substr_lst is not None and len(substr_lst) > 0: #if only substring filters provided
-                if len(substr_lst) > 1: #checking single filter case
-                    new_files = new_files[~new_files.str.contains('|'.join(substr_lst))].reset_index(drop=True)
-                else:
-                    new_files = new_files[~new_files.str.contains(substr_lst[0])].reset_index(drop=True)
-            name_series = name_series.append(new_files).reset_index(drop=True) #aggregating filtered paths
-        return name_series.tolist()
+        include_regex, exclude_regex = Housekeeper.compile_path_filters(file_fmt_str, substr_lst, regstr_lst)
+        top = os.path.abspath(folder_pth_str)
+        listing = {} #directory path: (matching files, subdirectories)
+        level, depth = [top], 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            while level:
+                listing.update(zip(level, executor.map(Housekeeper.scan_directory, level, [include_regex]*len(level), [exclude_regex]*len(level))))
+                level = [subdir for dir_path in level for subdir in listing[dir_path][1]] if max_depth is None or depth < max_depth else []
+                depth += 1
+        path_list, stack = [], [top]
+        while stack: #assembling results in top-down order
+            dir_path = stack.pop()
+            files, subdirs = listing[dir_path]
+            path_list.extend(files)
+            stack.extend(subdir for subdir in reversed(subdirs) if subdir in listing)
+        return path_list
+
 
     @staticmethod
     def create_sample_sheet(file_lst:list, generic_str:str, regex_str:str=None, mode:int=0):
         """
         Given (list) of paths to files and a generic part of the file name (e.g. _contigs.fasta or _R[1,2]_001.fastq.gz string, regex expected for fastq), mode value (int 1 for fasta, 0 (default) for fastq)
         and a sample_id regex pattern to exclude (regex string), returns pandas dataframe with sample_id column and one (fa for fasta) or two (fq1 fq2, for fastq) file path columns. 
+        Fastq file names are parsed once into sample id and read number (R1/R2 in the generic part of the name) and pivoted by read number;
+        unpaired files are reported and excluded, samples with more than one file of the same read are reported as errors and excluded.
         """
         file_series = pd.Series(file_lst, dtype="str") #to facilitate filtering
         ss_df = pd.DataFrame(dtype="str") #to store sample sheet
@@ -56,28 +111,159 @@ class Housekeeper:
                 id_series = id_series[id_series.str.contains(regex_str)] #additional sample id filtering based on regex was requested
                 if len(id_series) == 0:
                     raise Exception('utilities/create_sample_sheet: After filtering sample ids using regex no sample ids left')
-            path_series = file_series[file_series.str.contains("|".join(id_series))].reset_index(drop=True) #getting corresponding paths to fastq files
-            ss_df['sample_id'], ss_df['fa'] = id_series, path_series #adding to sample sheet dataframe
+            path_series = file_series[id_series.index].reset_index(drop=True) #paths of the remaining sample ids
+            ss_df['sample_id'], ss_df['fa'] = id_series.reset_index(drop=True), path_series #adding to sample sheet dataframe
             return ss_df
         
-        id_extractor = lambda x: re.sub(generic_str,"",os.path.basename(x)) #extract id from string by using regex
-        id_series = file_series.apply(id_extractor).drop_duplicates(keep = "first").sort_values().reset_index(drop=True)
+        generic_regex = re.compile(generic_str)
+        file_df = pd.DataFrame({'path':file_series})
+        file_df['sample_id'] = [generic_regex.sub("", os.path.basename(path)) for path in file_series] #extract id from each file name once by using regex
+        generic_parts = [generic_regex.search(os.path.basename(path)) for path in file_series]
+        read_matches = [Housekeeper.read_number_regex.search(part.group()) if part is not None else None for part in generic_parts] #read number is parsed from the generic part of the name
+        file_df['read'] = pd.Series([int(read['read']) if read is not None else 0 for read in read_matches], index=file_df.index, dtype=int) #1 - read 1, 2 - read 2, 0 - not matching generic_str
         if regex_str is not None: #additional sample id filtering based on regex was requested
-            id_series = id_series[id_series.str.contains(regex_str)]
-            if len(id_series) == 0:
+            file_df = file_df[file_df['sample_id'].str.contains(regex_str)]
+            if len(file_df) == 0:
                 raise Exception('utilities/create_sample_sheet: After filtering sample ids using regex no sample ids left')
-        read_1_dict, read_2_dict = {}, {} #to use python mapping to ensure correspondance between id and path
-
-        for id in id_series:
-            read_files = file_series[file_series.str.contains(id)].reset_index(drop=True).sort_values().reset_index(drop=True) #extract read paths
-            read_1_dict[id] = read_files[0]
-            read_2_dict[id] = read_files[1]
-            
-        ss_df['sample_id'] = id_series #adding to sample sheet dataframe
-        ss_df['fq1'] = ss_df['sample_id'].map(read_1_dict)
-        ss_df['fq2'] = ss_df['sample_id'].map(read_2_dict)
+        file_df = file_df.sort_values('path').drop_duplicates(subset='path')
+        matched_df = file_df[file_df['read'] > 0]
+        duplicated = matched_df[matched_df.duplicated(subset=['sample_id', 'read'], keep=False)]
+        if len(duplicated) > 0: #same read of the same sample found more than once (e.g. in different subfolders) - pair can not be chosen
+            print(f"utilities/create_sample_sheet: ERROR: {duplicated['sample_id'].nunique()} samples have more than one file of the same read, all their files are excluded from sample sheet:\n"+"\n".join(duplicated['path']))
+            matched_df = matched_df[~matched_df['sample_id'].isin(duplicated['sample_id'])]
+        read_counts = matched_df.groupby('sample_id')['read'].transform('size')
+        unpaired = pd.concat([file_df[file_df['read'] == 0], matched_df[read_counts < 2]]).sort_values('path')
+        if len(unpaired) > 0: #files without pair (or not matching generic_str) are not included in the sample sheet
+            print(f"utilities/create_sample_sheet: {len(unpaired)} unpaired fastq files excluded from sample sheet:\n"+"\n".join(unpaired['path']))
+        matched_df = matched_df[read_counts == 2]
+        ss_df = matched_df.pivot(index='sample_id', columns='read', values='path').rename(columns={1:'fq1', 2:'fq2'}) #one row per sample id
+        ss_df = ss_df.reindex(columns=['fq1', 'fq2']).sort_index().reset_index()
+        ss_df.columns.name = None
         return ss_df
 
+    @staticmethod
+    def renamer(old_path:str, new_path:str, dry_run:bool=False):
+        '''
+        Helper function to rename single file, returns log record indicating if renaming was successful (OK, FAILED or DRY_RUN if dry_run is set to True).
+        If old_path is missing but new_path exists, the file is assumed to be renamed before and the record is marked as SKIPPED.
+        '''
+        if dry_run: return f'{old_path} {new_path} DRY_RUN\n' #only record the planned renaming
+        try: #attempt renaming
+            os.rename(old_path, new_path)
+            return f'{old_path} {new_path} OK\n' #return info about successful renaming
+        except OSError: #if failed
+            if not os.path.exists(old_path) and os.path.exists(new_path): return f'{old_path} {new_path} SKIPPED\n' #renamed by earlier (interrupted) run
+            return f'{old_path} {new_path} FAILED\n' #return info about failed renaming
+
+    @staticmethod
+    def rename_files(path_map:dict, log_path:str=None, dry_run:bool=False, threads:int=8, progress_bar:bool=True, journal=None, step:str=None) -> list:
+        '''
+        Given dictionary mapping old file paths to new file paths, renames all files using a pool of threads (os.rename is a single system call,
+        so threads avoid the process startup & pickling costs of multiprocessing). Returns list of log records in the order of path_map.
+        If log_path is supplied, all records are written to the log file at once by replacing it with a complete temporary file.
+        If dry_run is set to True, files are not renamed and records are marked as DRY_RUN.
+        If journal object (with begin and commit methods) and step name are supplied, the renaming is recorded in the journal before any file is renamed
+        and the step is committed after the log is written.
+        '''
+        total_count = len(path_map)
+        renaming_logs = []
+        if journal is not None and not dry_run: journal.begin(step, path_map, log_path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for record in executor.map(Housekeeper.renamer, path_map.keys(), path_map.values(), [dry_run]*total_count):
+                renaming_logs.append(record)
+                if progress_bar: Housekeeper.printProgressBar(len(renaming_logs), total_count, prefix = 'Progress:', suffix = 'Complete', length = 50)
+        if log_path is not None:
+            with open(f'{log_path}.tmp', 'w+') as rename_log: rename_log.write("".join(renaming_logs))
+            os.replace(f'{log_path}.tmp', log_path) #log is either fully written or not changed
+        if journal is not None and not dry_run: journal.commit(step)
+        return renaming_logs
+
+    @staticmethod
+    def bucket_by_sample_id(names:list, sample_ids:list) -> dict:
+        '''
+        Given list of file names and list of sample ids, returns dictionary mapping each file name to the longest sample id that the name starts with,
+        followed by "_" or "." (or equal to the name), e.g. S10_consensus.fasta is matched to S10, not S1. Names without matching sample id are not included.
+        Each name is checked only at its separator positions, so the time is linear in the total length of names.
+        '''
+        id_set = set(sample_ids)
+        buckets = {}
+        for name in names:
+            cut_positions = [i for i, char in enumerate(name) if char in "_."] + [len(name)]
+            for cut in reversed(cut_positions): #longest prefix first
+                if name[:cut] in id_set:
+                    buckets[name] = name[:cut]
+                    break
+        return buckets
+
+    @staticmethod
+    def stage_file(source_path:str, staged_path:str):
+        '''
+        Helper function to make source_path available as staged_path without moving it. Tries, in order: hardlink (same file system),
+        reflink (copy-on-write clone, e.g. on XFS/Btrfs) and full copy. Modification time of the source is kept, so snakemake does not rerun jobs.
+        Symlinks are not used, as their targets outside of the working directory may not be mounted in the containers the rules run in.
+        Returns tuple of staged_path and staging method (link, reflink, copy, existing or FAILED); existing means staged_path already refers to source_path
+        (left by an interrupted run). If staged_path exists and is a different file, it is not changed and FAILED is returned.
+        '''
+        if os.path.lexists(staged_path):
+            try:
+                return staged_path, 'existing' if os.path.samefile(source_path, staged_path) else 'FAILED'
+            except OSError:
+                return staged_path, 'FAILED'
+        source_stat = os.stat(source_path)
+        try:
+            os.link(source_path, staged_path)
+            return staged_path, 'link'
+        except OSError: #different file system or links not supported
+            pass
+        try:
+            with open(source_path, 'rb') as source, open(staged_path, 'xb') as staged: fcntl.ioctl(staged.fileno(), Housekeeper.FICLONE, source.fileno())
+            os.utime(staged_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            return staged_path, 'reflink'
+        except (OSError, AttributeError): #reflinks not supported
+            if os.path.lexists(staged_path): os.remove(staged_path)
+        try:
+            copy2(source_path, staged_path)
+            return staged_path, 'copy'
+        except OSError:
+            if os.path.lexists(staged_path): os.remove(staged_path)
+            return staged_path, 'FAILED'
+
+    @staticmethod
+    def is_same_path(path_1:str, path_2:str):
+        '''
+        Returns True if both paths name the same directory entry (same name in the same folder, e.g. ./wd/a.fastq.gz and wd/a.fastq.gz).
+        Hardlinks and symlinks of a file are not the file itself, so os.path.samefile is only applied to the parent folders.
+        '''
+        if os.path.basename(path_1) != os.path.basename(path_2): return False
+        try:
+            return os.path.samefile(os.path.dirname(os.path.abspath(path_1)), os.path.dirname(os.path.abspath(path_2)))
+        except OSError:
+            return False
+
+    @staticmethod
+    def stage_files(path_map:dict, threads:int=8) -> dict:
+        '''
+        Given dictionary mapping source file paths to staged paths, stages all files using a pool of threads (see stage_file).
+        Returns dictionary mapping staged paths to staging methods.
+        '''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            return dict(executor.map(Housekeeper.stage_file, path_map.keys(), path_map.values()))
+
+    @staticmethod
+    def unstage_file(staged_path:str, source_path:str):
+        '''
+        Removes file staged by stage_file. If source_path no longer exists, staged file is moved to source_path instead,
+        so that the data is never removed. If staged_path is the source file itself (see is_same_path), nothing is removed. Returns True if source_path exists afterwards.
+        '''
+        if Housekeeper.is_same_path(staged_path, source_path): return True
+        if os.path.exists(source_path):
+            if os.path.lexists(staged_path): os.remove(staged_path) #link or copy of the source
+            return True
+        if os.path.lexists(staged_path) and not os.path.islink(staged_path): #source is gone, the staged file is the only copy
+            move(staged_path, source_path)
+            return True
+        return False
+
     @staticmethod
     def map_new_column(ss_df:pd.DataFrame, info_dict:dict, id_column:str, new_col_name:str):
         """
@@ -97,8 +283,15 @@ class Housekeeper:
         """
         Given (list) of paths files, returns a dictionary where each file path is matched with the boolean (dict)
         indicating if it is present in the file system.
+        Every parent folder is listed once and files are looked up in the listing, instead of checking each path separately.
         """
-        return {file: os.path.isfile(file) for file in file_list}
+        dir_files = {} #folder path: set of names of regular files in the folder
+        for dir_path in {os.path.dirname(file) for file in file_list}:
+            try:
+                with os.scandir(dir_path if dir_path else ".") as entries: dir_files[dir_path] = {entry.name for entry in entries if entry.is_file()}
+            except OSError: #folder does not exist or is not readable
+                dir_files[dir_path] = set()
+        return {file: os.path.basename(file) in dir_files[os.path.dirname(file)] for file in file_list}
                 
     @staticmethod
     def read_yaml(yaml_path:str):
@@ -0,0 +1,63 @@
+import unittest, os, concurrent.futures
+from shutil import rmtree
+from subscripts.covipipe_allocator import Processing_id_allocator
+
+
+def reserve_in_process(id_file_path:str, count:int, batch:str):
+    '''Reserves processing ids from a separate process'''
+    return Processing_id_allocator(id_file_path).reserve(count, batch)
+
+
+class test_allocator(unittest.TestCase):
+    '''Testing processing id allocator'''
+
+
+    def setUp(self):
+        self.root_name = './top/'
+        os.makedirs(self.root_name, exist_ok=True)
+        self.id_file_path = f'{self.root_name}current_id'
+        with open(self.id_file_path, 'w') as f: f.write('COV000010')
+
+
+    def tearDown(self):
+        rmtree(self.root_name)
+
+
+    def test_next_ids(self):
+        test = {
+            'Valid case':['COV000010', 3, ['COV000011', 'COV000012', 'COV000013']],
+            'Valid case|No ids':['COV000010', 0, []],
+            'Exception|Non-numeric id':['COVABCDEF', 1, ValueError],
+        }
+        for case in test:
+            if 'Exception' not in case:
+                self.assertListEqual(Processing_id_allocator.next_ids(test[case][0], test[case][1]), test[case][2])
+            else:
+                with self.assertRaises(test[case][2]):
+                    Processing_id_allocator.next_ids(test[case][0], test[case][1])
+
+
+    def test_peek_and_reserve(self):
+        allocator = Processing_id_allocator(self.id_file_path)
+        self.assertListEqual(allocator.peek(2), ['COV000011', 'COV000012'])
+        self.assertEqual(allocator.read_latest_id(), 'COV000010') #peek does not reserve
+        self.assertListEqual(allocator.reserve(2, 'batch_1'), ['COV000011', 'COV000012'])
+        self.assertListEqual(allocator.reserve(3, 'batch_2'), ['COV000013', 'COV000014', 'COV000015'])
+        self.assertListEqual(allocator.reserve(0, 'batch_3'), [])
+        self.assertEqual(allocator.read_latest_id(), 'COV000015')
+        self.assertListEqual([record[:4] for record in allocator.read_reservations()], [('batch_1', 'COV000011', 'COV000012', '2'), ('batch_2', 'COV000013', 'COV000015', '3')])
+
+
+    def test_parallel_reserve(self):
+        batch_count, batch_size = 8, 50
+        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(reserve_in_process, [self.id_file_path]*batch_count, [batch_size]*batch_count, [f'batch_{i}' for i in range(batch_count)]))
+        reserved = [id for result in results for id in result]
+        self.assertEqual(len(set(reserved)), batch_count*batch_size) #no overlapping ranges
+        self.assertListEqual(sorted(reserved), Processing_id_allocator.next_ids('COV000010', batch_count*batch_size)) #ranges are contiguous
+        self.assertEqual(Processing_id_allocator(self.id_file_path).read_latest_id(), 'COV000410')
+        self.assertEqual(len(Processing_id_allocator(self.id_file_path).read_reservations()), batch_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest, os, sys, json, time, asyncio, subprocess
+from shutil import rmtree
+from subscripts.src.cluster_status import parse_qstat_xml, parse_slurm_states, poll_scheduler, query_job, write_snapshot, read_status, run_daemon, wait_for_job, wait_for_jobs
+
+#FAKE QSTAT: PRINTS REQUESTED JOBS (EXIT CODE 153 IF ANY JOB IS UNKNOWN) AND COUNTS CALLS
+fake_qstat = '''#!/bin/sh
+echo "$@" >> "$(dirname "$0")/qstat_calls"
+shift 2
+found="" status=0
+for job in "$@"; do
+    grep "<Job_Id>$job" "$(dirname "$0")/jobs.xml" > /dev/null || status=153
+    found="$found$(grep "<Job_Id>$job" "$(dirname "$0")/jobs.xml")"
+done
+[ -n "$found" ] && echo "<Data>$found</Data>"
+exit $status
+'''
+
+#FAKE QSELECT: PRINTS IDS OF JOBS OF USER "pipeline_user"
+fake_qselect = '''#!/bin/sh
+[ "$2" = "pipeline_user" ] && sed -n 's/.*<Job_Id>\\([^<]*\\)<.*/\\1/p' "$(dirname "$0")/jobs.xml"
+exit 0
+'''
+
+fake_jobs = [
+    '<Job><Job_Id>101.server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>',
+    '<Job><Job_Id>102.server</Job_Id><job_state>C</job_state><exit_status>1</exit_status></Job>',
+    '<Job><Job_Id>103.server</Job_Id><job_state>R</job_state></Job>',
+    '<Job><Job_Id>104.server</Job_Id><job_state>Q</job_state></Job>',
+]
+
+
+class test_cluster_status(unittest.TestCase):
+    '''Testing cluster job status daemon and status script with fake qstat'''
+
+
+    def setUp(self):
+        self.root_name = os.path.abspath('./top')
+        self.bin_path = f'{self.root_name}/bin'
+        os.makedirs(self.bin_path, exist_ok=True)
+        with open(f'{self.bin_path}/qstat', 'w') as f: f.write(fake_qstat)
+        with open(f'{self.bin_path}/qselect', 'w') as f: f.write(fake_qselect)
+        os.chmod(f'{self.bin_path}/qstat', 0o755)
+        os.chmod(f'{self.bin_path}/qselect', 0o755)
+        with open(f'{self.bin_path}/jobs.xml', 'w') as f: f.write("\n".join(fake_jobs))
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = f'{self.bin_path}{os.pathsep}{self.old_path}'
+        self.snapshot_path = f'{self.root_name}/cluster_status.json'
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        rmtree(self.root_name)
+
+
+    def count_qstat_calls(self):
+        if not os.path.isfile(f'{self.bin_path}/qstat_calls'): return 0
+        with open(f'{self.bin_path}/qstat_calls', 'r') as f: return len(f.readlines())
+
+
+    def run_status_script(self, job_id:str, snapshot_path:str=None):
+        env = dict(os.environ, CLUSTER_STATUS_SNAPSHOT=snapshot_path) if snapshot_path is not None else os.environ
+        return subprocess.check_output([sys.executable, './subscripts/pbs-status.py', job_id], env=env).decode().strip()
+
+
+    def test_parse_states(self):
+        test = {
+            'Valid case|PBS':[parse_qstat_xml, f'<Data>{"".join(fake_jobs)}</Data>', {'101.server':'success', '102.server':'failed', '103.server':'running', '104.server':'running'}],
+            'Valid case|PBS Pro finished':[parse_qstat_xml, '<Data><Job><Job_Id>1.pbs</Job_Id><job_state>F</job_state><Exit_status>0</Exit_status></Job></Data>', {'1.pbs':'success'}],
+            'Valid case|Slurm':[parse_slurm_states, '11|COMPLETED\n12|CANCELLED by 1000\n13|PENDING\n14|OUT_OF_MEMORY\n', {'11':'success', '12':'failed', '13':'running', '14':'failed'}],
+            'Valid case|Empty':[parse_slurm_states, '', {}],
+        }
+        for case in test:
+            self.assertDictEqual(test[case][0](test[case][1]), test[case][2])
+
+
+    def test_poll_and_read(self):
+        run_daemon(self.snapshot_path, 'pbs', interval=0, max_polls=2, user='pipeline_user')
+        self.assertEqual(self.count_qstat_calls(), 2) #one bulk call per poll
+        self.assertDictEqual(poll_scheduler('pbs', 'pipeline_user'), parse_qstat_xml(f'<Data>{"".join(fake_jobs)}</Data>'))
+        self.assertDictEqual(poll_scheduler('pbs', 'other_user'), {}) #jobs of other users are not queried
+        self.assertEqual(self.count_qstat_calls(), 3)
+        self.assertEqual(read_status('101.server', self.snapshot_path, max_age=60), 'success')
+        self.assertEqual(read_status('102', self.snapshot_path, max_age=60), 'failed') #matched by numeric part
+        self.assertIsNone(read_status('105.server', self.snapshot_path, max_age=60)) #not in snapshot
+        self.assertIsNone(read_status('101.server', f'{self.root_name}/missing.json')) #no snapshot
+
+        #outdated snapshot
+        with open(self.snapshot_path, 'r') as f: data = json.load(f)
+        write_snapshot(self.snapshot_path, data['jobs'], 'pbs', interval=1)
+        self.assertEqual(read_status('101.server', self.snapshot_path), 'success')
+        with open(self.snapshot_path, 'r') as f: data = json.load(f)
+        data['updated'] = time.time()-10
+        with open(self.snapshot_path, 'w') as f: json.dump(data, f)
+        self.assertIsNone(read_status('101.server', self.snapshot_path))
+
+
+    def test_status_script(self):
+        write_snapshot(self.snapshot_path, {'201.server':'running'}, 'pbs', interval=10)
+        self.assertEqual(self.run_status_script('201.server', self.snapshot_path), 'running')
+        self.assertEqual(self.count_qstat_calls(), 0) #answered from snapshot
+        self.assertEqual(self.run_status_script('101.server', self.snapshot_path), 'success') #not in snapshot, qstat fallback
+        self.assertEqual(self.run_status_script('103.server'), 'running') #no snapshot, qstat fallback
+        self.assertEqual(self.run_status_script('999.server'), 'failed') #unknown job
+        self.assertEqual(self.count_qstat_calls(), 3)
+        self.assertEqual(query_job('102.server'), 'failed')
+
+
+    def test_wait_for_jobs(self):
+        async def finish_jobs():
+            await asyncio.sleep(0.3)
+            with open(f'{self.bin_path}/jobs.xml', 'w') as f: f.write("\n".join(fake_jobs[:2]+[fake_jobs[2].replace('<job_state>R</job_state>', '<job_state>C</job_state><exit_status>0</exit_status>')]))
+            open(f'{self.root_name}/job.o103', 'w').close() #job report is written when job ends
+
+        async def wait_with_finisher():
+            finisher = asyncio.create_task(finish_jobs())
+            statuses = await wait_for_jobs({'101.server':None, '103.server':f'{self.root_name}/*o103'}, initial_delay=0.1, max_delay=10, report_check_interval=0.05)
+            await finisher
+            return statuses
+
+        start = time.time()
+        self.assertDictEqual(asyncio.run(wait_with_finisher()), {'101.server':'success', '103.server':'success'})
+        self.assertLess(time.time()-start, 2) #woken by job report, not by backoff delay
+        self.assertLessEqual(self.count_qstat_calls(), 6) #only 101 and 103 queried, with backoff
+
+        #job removed from qstat: unknown if report exists, failed otherwise
+        open(f'{self.root_name}/job.o105', 'w').close()
+        self.assertEqual(asyncio.run(wait_for_job('105.server', report_pattern=f'{self.root_name}/*o105', initial_delay=0.01)), 'unknown')
+        self.assertEqual(asyncio.run(wait_for_job('106.server', report_pattern=f'{self.root_name}/*o106', initial_delay=0.01, max_unknown=3)), 'failed')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest, os, numpy as np
+from shutil import rmtree
+from subscripts.assembly.depth_stats import read_depth_file, coverage_stats, depth_file_stats
+
+
+class test_depth_stats(unittest.TestCase):
+    '''Testing samtools depth report reader and coverage statistics'''
+
+
+    def setUp(self):
+        self.root_name = './top/'
+        os.makedirs(self.root_name, exist_ok=True)
+        self.depth_path = f'{self.root_name}COV000001_100001_seq_depth.txt'
+        with open(self.depth_path, 'w') as f: #positions 1-400 (except 101-350) covered
+            for position in list(range(1, 101))+list(range(351, 401)): f.write(f'MN908947.3\t{position}\t{position % 30}\n')
+        self.empty_path = f'{self.root_name}COV000002_100002_seq_depth.txt'
+        open(self.empty_path, 'w').close()
+
+
+    def tearDown(self):
+        rmtree(self.root_name)
+
+
+    def test_read_depth_file(self):
+        positions, depths = read_depth_file(self.depth_path)
+        self.assertEqual(len(positions), 150)
+        self.assertListEqual(depths[:3].tolist(), [1, 2, 3])
+        self.assertEqual(len(read_depth_file(self.empty_path)[0]), 0)
+
+        #cache is used while it is newer than the report
+        read_depth_file(self.depth_path, cache=True)
+        self.assertTrue(os.path.isfile(f'{self.depth_path}.npy'))
+        np.save(f'{self.depth_path}.npy', np.array([[1], [99]], dtype=np.int32))
+        self.assertListEqual(read_depth_file(self.depth_path, cache=True)[1].tolist(), [99])
+        os.utime(self.depth_path, ns=(0, os.stat(f'{self.depth_path}.npy').st_mtime_ns+10**9))
+        self.assertEqual(len(read_depth_file(self.depth_path, cache=True)[1]), 150)
+
+
+    def test_coverage_stats(self):
+        test = {
+            'Valid case|Listed positions':[np.array([1, 2, 3, 4]), np.array([0, 10, 20, 30]), 10, {'mean_depth':15.0, 'median_depth':15.0, 'breadth_1x':0.3, 'breadth_10x':0.3, 'breadth_20x':0.2, 'dropout_regions':1}],
+            'Valid case|Empty':[np.array([], dtype=np.int32), np.array([], dtype=np.int32), 10, {'mean_depth':0.0, 'median_depth':0.0, 'breadth_1x':0.0, 'breadth_10x':0.0, 'breadth_20x':0.0, 'dropout_regions':1}],
+            'Valid case|Full coverage':[np.arange(1, 11), np.full(10, 25), 10, {'mean_depth':25.0, 'median_depth':25.0, 'breadth_1x':1.0, 'breadth_10x':1.0, 'breadth_20x':1.0, 'dropout_regions':0}],
+        }
+        for case in test:
+            self.assertDictEqual(coverage_stats(test[case][0], test[case][1], genome_length=test[case][2], dropout_length=5), test[case][3])
+
+
+    def test_depth_file_stats(self):
+        stats = depth_file_stats(self.depth_path, genome_length=400, dropout_length=200)
+        self.assertEqual(stats['dropout_regions'], 1) #positions 101-350 not covered
+        self.assertAlmostEqual(stats['breadth_1x'], 145/400) #5 listed positions have depth 0
+        self.assertEqual(depth_file_stats(self.empty_path)['median_depth'], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest, os
+from shutil import rmtree
+from subscripts.downstream.file_index import File_index
+
+
+class test_file_index(unittest.TestCase):
+    '''Testing persistent file index used by downstream report scripts'''
+
+
+    def setUp(self):
+        self.root_name = os.path.abspath('./top')
+        self.files = [
+            'NMRL-2022_05_11-run1/COV000001_100001.ann.csv',
+            'NMRL-2022_05_11-run1/COV000001_100001_consensus.fasta',
+            'NMRL-2022_05_11-run1/COV000001_100001_qualimap/qualimapReport.html',
+            'NMRL-2022_06_01-run2/COV000002_100002_seq_depth.txt',
+            'NMRL-2022_06_01-run2/100003_S12_R1_001.fastq.gz',
+        ]
+        for path in self.files:
+            os.makedirs(os.path.dirname(f'{self.root_name}/{path}'), exist_ok=True)
+            open(f'{self.root_name}/{path}', 'w').close()
+        self.set_old_mtimes()
+        self.file_index = File_index(f'{self.root_name}_index.sqlite')
+
+
+    def tearDown(self):
+        self.file_index.close()
+        os.remove(f'{self.root_name}_index.sqlite')
+        rmtree(self.root_name)
+
+
+    def set_old_mtimes(self, changed:list=None, mtime:int=10**6):
+        '''Sets modification time of test folders (all or only changed ones) to the past, as if they were modified long before the scan'''
+        for root, dirs, _ in os.walk(self.root_name):
+            for path in [root]+[os.path.join(root, dir) for dir in dirs]:
+                if changed is None or path in changed: os.utime(path, (0, mtime))
+
+
+    def test_query(self):
+        self.assertEqual(self.file_index.refresh(self.root_name), (4, 0))
+        self.assertListEqual(list(self.file_index.run_folders(self.root_name)), ['NMRL-2022_05_11-run1', 'NMRL-2022_06_01-run2'])
+        file_df = self.file_index.query(root_path=self.root_name)
+        self.assertListEqual(file_df['path'].tolist(), sorted(f'{self.root_name}/{path}' for path in self.files))
+        self.assertListEqual(file_df['context'].tolist(), ['ann.csv', 'consensus.fasta', None, 'fastq.gz', 'seq_depth.txt'])
+        self.assertListEqual(file_df['sample_id'].tolist(), ['100001', '100001', None, '100003', '100002'])
+        self.assertListEqual(file_df['processing_id'].tolist(), ['COV000001', 'COV000001', None, None, 'COV000002'])
+        self.assertListEqual(file_df['run_folder'].tolist(), ['NMRL-2022_05_11-run1']*3+['NMRL-2022_06_01-run2']*2)
+
+        #filters
+        run_folders = self.file_index.run_folders(self.root_name)
+        self.assertEqual(len(self.file_index.query(dirs=[run_folders['NMRL-2022_05_11-run1']])), 2) #qualimap subfolder excluded
+        self.assertListEqual(self.file_index.query(root_path=self.root_name, sample_ids=[100002, '100003'])['sample_id'].tolist(), ['100003', '100002'])
+        self.assertEqual(len(self.file_index.query(root_path=self.root_name, contexts=['ann.csv', 'seq_depth.txt'])), 2)
+        self.assertEqual(len(self.file_index.query(root_path=self.root_name, name_like='%1.fastq.gz', name_contains=['100003', '999'])), 1)
+
+
+    def test_name_pattern(self):
+        test = {
+            'Valid case|Annotated id':['COV000001_100001.ann.csv', ('100001', 'COV000001', 'ann.csv')],
+            'Valid case|Id ending with _2':['ABC_2.ann.csv', ('ABC_2', None, 'ann.csv')],
+            'Valid case|Annotated id ending with _1':['COV000123_ABC_1_consensus.fasta', ('ABC_1', 'COV000123', 'consensus.fasta')],
+            'Valid case|Id ending with _1 and depth report':['COV000123_ABC_1_seq_depth.txt', ('ABC_1', 'COV000123', 'seq_depth.txt')],
+            'Valid case|Illumina fastq':['100003_S12_R1_001.fastq.gz', ('100003', None, 'fastq.gz')],
+            'Valid case|Fastq of id ending with _2':['ABC_2_R2_001.fastq.gz', ('ABC_2', None, 'fastq.gz')],
+            'Valid case|Short read tag':['ABC_1.fastq.gz', ('ABC', None, 'fastq.gz')],
+        }
+        for case in test:
+            name_match = File_index.name_pattern.match(test[case][0])
+            self.assertTupleEqual((name_match['sample_id'], name_match['processing_id'], name_match['context']), test[case][1], case)
+
+
+    def test_run_folder_mtimes(self):
+        self.set_old_mtimes(changed=[f'{self.root_name}/NMRL-2022_05_11-run1'], mtime=3*10**6) #older folder name, latest modification
+        self.file_index.refresh(self.root_name)
+        mtimes = self.file_index.run_folder_mtimes(self.root_name)
+        self.assertDictEqual(mtimes, {'NMRL-2022_05_11-run1':3*10**15, 'NMRL-2022_06_01-run2':10**15})
+
+        #new file in older run folder (root folder is not changed)
+        open(f'{self.root_name}/NMRL-2022_06_01-run2/COV000003_100004.ann.csv', 'w').close()
+        self.set_old_mtimes(changed=[f'{self.root_name}/NMRL-2022_06_01-run2'], mtime=4*10**6)
+        self.file_index.refresh(self.root_name)
+        mtimes = self.file_index.run_folder_mtimes(self.root_name)
+        self.assertGreater(mtimes['NMRL-2022_06_01-run2'], mtimes['NMRL-2022_05_11-run1'])
+
+        #folder modified right before refresh
+        open(f'{self.root_name}/NMRL-2022_05_11-run1/COV000005_100005.ann.csv', 'w').close()
+        self.file_index.refresh(self.root_name)
+        mtimes = self.file_index.run_folder_mtimes(self.root_name)
+        self.assertGreater(mtimes['NMRL-2022_05_11-run1'], mtimes['NMRL-2022_06_01-run2'])
+
+
+    def test_delta_refresh(self):
+        self.file_index.refresh(self.root_name)
+        self.assertEqual(self.file_index.refresh(self.root_name), (0, 4)) #nothing changed, nothing listed
+
+        #new file in one folder, removed folder
+        open(f'{self.root_name}/NMRL-2022_06_01-run2/COV000003_100004.ann.csv', 'w').close()
+        rmtree(f'{self.root_name}/NMRL-2022_05_11-run1/COV000001_100001_qualimap')
+        self.set_old_mtimes(changed=[f'{self.root_name}/NMRL-2022_06_01-run2', f'{self.root_name}/NMRL-2022_05_11-run1'], mtime=2*10**6)
+        self.assertEqual(self.file_index.refresh(self.root_name), (2, 1))
+        file_df = self.file_index.query(root_path=self.root_name)
+        self.assertIn(f'{self.root_name}/NMRL-2022_06_01-run2/COV000003_100004.ann.csv', file_df['path'].tolist())
+        self.assertEqual(len(file_df), 5)
+        self.assertEqual(self.file_index.refresh(self.root_name, full=True), (3, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
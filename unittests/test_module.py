@@ -1,5 +1,6 @@
-import unittest, pandas as pd, os, uuid
-from subscripts.covipipe_classes import Covid_assembly as ca
+import unittest, pandas as pd, os, sys, io, contextlib, uuid, time, threading, gzip
+from shutil import rmtree
+from subscripts.covipipe_classes import Covid_assembly as ca, Covid_downstream
 
 
 class test_module(unittest.TestCase):
@@ -55,16 +56,27 @@ class test_module(unittest.TestCase):
 
 
     def test_fill_input_dict(self):
-        test = {
-            'Valid input':[],
-            'Exception|':[]
-        }
-        for case in test:
-            if 'Exception' not in case:
-                self.assertEqual(1,1)
-            else:
-                with self.assertRaises(Exception):
-                    raise Exception
+        root_name = './top/'
+        os.makedirs(root_name, exist_ok=True)
+        record = b'@read_1\nACGT\n+\nFFFF\n'
+        files = {'S1_R1_001.fastq.gz':gzip.compress(record), 'S1_R2_001.fastq.gz':gzip.compress(record), #valid pair
+                 'S2_R1_001.fastq.gz':gzip.compress(record)[:-4], #corrupted file without mate
+                 'S3_R2_001.fastq.gz':gzip.compress(record)} #valid file without mate
+        for name in files:
+            with open(f'{root_name}{name}', 'wb') as f: f.write(files[name])
+        module = ca(module_name='assembly', input_path=root_name, module_config={}, output_path=root_name, run_mode=None, job_name='test', patterns={'inputs':['001.fastq.gz'], 'sample_sheet':'_R[1,2]_001.fastq.gz'}, 
+            targets=[], requests={}, snakefile_path='', cluster_config_path='', dry_run=False, force_all=False, rule_graph=False, pack_output=None, unpack_output=None)
+        try:
+            module.fill_input_dict(check_integrity=True, use_cache=False)
+            self.assertListEqual(sorted(map(os.path.basename, module.input_dict["001.fastq.gz"])), ['S1_R1_001.fastq.gz', 'S1_R2_001.fastq.gz', 'S3_R2_001.fastq.gz'])
+            check_df = pd.read_csv(f'{root_name}input_integrity_check.csv').set_index('sample_id')
+            self.assertListEqual(sorted(check_df.index), ['S1', 'S2_R1_001.fastq.gz', 'S3_R2_001.fastq.gz'])
+            self.assertListEqual(check_df.loc['S2_R1_001.fastq.gz', ['fq1_status', 'fq2_status', 'passed']].tolist(), ['FAILED', 'MISSING', False])
+            self.assertListEqual(check_df.loc['S3_R2_001.fastq.gz', ['fq1_status', 'fq2_status', 'passed']].tolist(), ['OK', 'MISSING', True])
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
 
 
     def test_fill_sample_sheet(self):
@@ -153,16 +165,25 @@ class test_module(unittest.TestCase):
 
 
     def test_check_module_output(self):
-        test = {
-            'Valid input':[],
-            'Exception|':[]
-        }
-        for case in test:
-            if 'Exception' not in case:
-                self.assertEqual(1,1)
-            else:
-                with self.assertRaises(Exception):
-                    raise Exception
+        root_name = './top/'
+        os.makedirs(f'{root_name}S1_qualimap', exist_ok=True)
+        targets = ['_qualimap/qualimapReport.html', '_consensus.fasta', '.vcf']
+        module = ca(module_name='assembly', input_path=root_name, module_config={}, output_path=root_name, run_mode=None, job_name='test', patterns={}, targets=targets, 
+            requests={}, snakefile_path='', cluster_config_path='', dry_run=False, force_all=False, rule_graph=False, pack_output=None, unpack_output=None)
+        module.sample_sheet = pd.DataFrame({'sample_id':['S1', 'S10'], 'fq1':['S1_R1', 'S10_R1'], 'fq2':['S1_R2', 'S10_R2']})
+        module.fill_target_list()
+        for target in module.target_list[:2]: open(target, 'w').close() #all S1 targets except vcf
+        try:
+            module.check_module_output()
+            module.write_output_check()
+            self.assertListEqual(module.sample_sheet['check_note_assembly'].tolist(), ["".join(f"|{target}:{target in module.target_list[:2]}" for target in module.target_list[i*3:i*3+3]) for i in range(2)])
+            true = pd.DataFrame({'sample_id':['S1', 'S10'], '_qualimap/qualimapReport.html':[True, False], '_consensus.fasta':[True, False], '.vcf':[False, False]})
+            self.assertEqual(module.output_check.reset_index().astype({target:bool for target in targets}), true)
+            self.assertEqual(pd.read_csv(f'{root_name}assembly_output_check.csv'), true)
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
 
 
     def test_clear_working_directory(self):
@@ -179,16 +200,28 @@ class test_module(unittest.TestCase):
 
 
     def test_files_to_wd(self):
+        root_name = './top/'
+        os.makedirs(f'{root_name}input', exist_ok=True)
+        input_files = [f'{root_name}input/S1_R1_001.fastq.gz', f'{root_name}input/S1_R2_001.fastq.gz']
+        for path in input_files: open(path, 'w').close()
         test = {
-            'Valid input':[],
-            'Exception|':[]
+            'Valid case|Separate working directory':[f'{root_name}wd', 2],
+            'Valid case|Working directory is input directory':[f'{root_name}input/', 0],
         }
-        for case in test:
-            if 'Exception' not in case:
-                self.assertEqual(1,1)
-            else:
-                with self.assertRaises(Exception):
-                    raise Exception
+        try:
+            for case in test:
+                module = ca(module_name='assembly', input_path=f'{root_name}input', module_config={'work_dir':test[case][0]}, output_path=root_name, run_mode=None, job_name='test', patterns={}, targets=[], 
+                    requests={}, snakefile_path='', cluster_config_path='', dry_run=False, force_all=False, rule_graph=False, pack_output=None, unpack_output=None)
+                module.input_dict = {'001.fastq.gz':input_files}
+                module.files_to_wd()
+                self.assertEqual(len(module.staging_dict), test[case][1], case)
+                module.clear_working_directory()
+                self.assertTrue(all(os.path.isfile(path) for path in input_files), case) #input files are never removed
+                self.assertListEqual(os.listdir(f'{root_name}wd') if os.path.isdir(f'{root_name}wd') else [], [], case)
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
 
 
     def test_fold_output(self):
@@ -321,6 +354,63 @@ class test_module(unittest.TestCase):
                     raise Exception
 
 
+    def test_run_stages(self):
+        downstream = Covid_downstream('2022-01-01', '2022-01-31', True, True, True, True, False)
+        events, lock = [], threading.Lock() #(stage, start/end) in the order they happened
+        filter_started, summary_started = threading.Event(), threading.Event()
+        def stage(name, fail=False, wait_for=None, started_event=None):
+            def run():
+                with lock: events.append((name, 'start'))
+                if started_event is not None: started_event.set()
+                if wait_for is not None: wait_for.wait(timeout=10) #stage ends only after the independent stage has started
+                time.sleep(0.05)
+                with lock: events.append((name, 'end'))
+                if fail: sys_exit(f'{name} failed')
+            return run
+        def sys_exit(msg): raise SystemExit(msg)
+        stage_graph = {'report':[], 'filter':['report'], 'summary':['report'], 'mutstat':['filter'], 'tessy':['filter'], 'weekly':['mutstat', 'summary']}
+        for name in stage_graph: setattr(downstream, name, stage(name))
+        setattr(downstream, 'filter', stage('filter', wait_for=summary_started, started_event=filter_started))
+        setattr(downstream, 'summary', stage('summary', wait_for=filter_started, started_event=summary_started))
+
+        timings = downstream.run_stages(stage_graph)
+        self.assertListEqual(sorted(timings), sorted(stage_graph))
+        for name in stage_graph: #stage starts only after all its dependencies ended
+            for dependency in stage_graph[name]: self.assertLess(events.index((dependency, 'end')), events.index((name, 'start')), f'{dependency} -> {name}')
+        self.assertLess(events.index(('summary', 'start')), events.index(('filter', 'end'))) #independent stages overlapped
+        self.assertLess(events.index(('filter', 'start')), events.index(('summary', 'end')))
+
+        #fail fast: dependent stages are not started
+        events.clear()
+        setattr(downstream, 'filter', stage('filter', fail=True))
+        setattr(downstream, 'summary', stage('summary'))
+        with self.assertRaises(SystemExit) as error:
+            downstream.run_stages(stage_graph)
+        self.assertIn('filter failed', str(error.exception.code))
+        self.assertNotIn(('mutstat', 'start'), events)
+        self.assertNotIn(('weekly', 'start'), events)
+
+
+
+    def test_run_logged(self):
+        downstream = Covid_downstream('2022-01-01', '2022-01-31', True, True, True, True, False)
+        log_path = './unittest_stage.log'
+        def stage(fail=False):
+            def run():
+                with open(log_path, 'w') as log_file: downstream.run_logged([sys.executable, '-c', f'print("line 1"); print("line 2"); exit({int(fail)})'], log_file)
+            return run
+        setattr(downstream, 'report', stage())
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output): downstream.run_stages({'report':[]})
+            self.assertIn('[report] line 1\n[report] line 2\n', output.getvalue()) #output is streamed with stage prefix
+            with open(log_path, 'r') as log_file: self.assertEqual(log_file.read(), '\nline 1\nline 2\n')
+            setattr(downstream, 'report', stage(fail=True))
+            with self.assertRaises(SystemExit), contextlib.redirect_stdout(output): downstream.run_stages({'report':[]})
+            os.remove(log_path)
+        except AssertionError as e:
+            os.remove(log_path)
+            raise e
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import unittest, os, json, numpy as np
+from shutil import rmtree
+from subscripts.downstream.pipeline_report import csv_info_extractor, qc_info_extractor, run_extractors_parallel, qc_columns
+
+
+class test_pipeline_report(unittest.TestCase):
+    '''Testing extractors of the downstream pipeline report'''
+
+
+    def setUp(self):
+        self.run_path = os.path.abspath('./top/NMRL-2022_05_11-run1')
+        os.makedirs(self.run_path, exist_ok=True)
+        self.context_map = {'ann.csv':[], 'seq_depth.txt':[], 'mapped_report.txt':[]}
+        self.qc_context_map = {'fastp_report.json':[], 'cutadapt_log.txt':[], 'ivar_log.txt':[]}
+        for sample in ['COV000001_100001', 'COV000002_100002']:
+            self.write_file(f'{sample}.ann.csv', 'AMINO_ACID_CHANGE,FREQUENCY,P_ERR_MUT_CALL\nA1B,90,0.01\nC2D,40,0.01\n', self.context_map)
+            self.write_file(f'{sample}_seq_depth.txt', 'MN908947.3\t1\t10\nMN908947.3\t2\t20\n', self.context_map)
+            self.write_file(f'{sample}_mapped_report.txt', '1000 + 0 in total\n0\n0\n0\n800 + 0 mapped\n', self.context_map)
+        #QC REPORTS OF THE FIRST SAMPLE ONLY
+        fastp_summary = {'summary':{'before_filtering':{'total_reads':1200}, 'after_filtering':{'total_reads':1000, 'q30_rate':0.95}}}
+        self.write_file('COV000001_100001_fastp_report.json', json.dumps(fastp_summary), self.qc_context_map)
+        self.write_file('COV000001_100001_cutadapt_log.txt', 'Total read pairs processed:          1,000\nPairs written (passing filters):       900\n', self.qc_context_map)
+        self.write_file('COV000001_100001_ivar_log.txt', 'Trimmed primers from 97.5% (1950) of reads.\n', self.qc_context_map)
+
+
+    def tearDown(self):
+        rmtree(os.path.dirname(self.run_path))
+
+
+    def write_file(self, name:str, content:str, context_map:dict):
+        with open(f'{self.run_path}/{name}', 'w') as f: f.write(content)
+        context_map[[context for context in context_map if name.endswith(context)][0]].append(f'{self.run_path}/{name}')
+
+
+    def test_csv_info_extractor(self):
+        filter_list = {'F1':{'A1B'}, 'F2':{'A1B', 'C2D'}, 'F3':{'E3F'}}
+        with open(f'{self.run_path}/COV000003_100003.ann.csv', 'w') as f: f.write('MALFORMED\n')
+        test = {
+            'Valid case|Filter fractions':[self.context_map['ann.csv'][0], {'F1':'1', 'F2':'0.5', 'F3':'0.0'}],
+            'Valid case|Malformed file':[f'{self.run_path}/COV000003_100003.ann.csv', {'F1':'0', 'F2':'0', 'F3':'0'}],
+        }
+        for case in test:
+            result = csv_info_extractor(test[case][0], filter_list, 65)
+            self.assertDictEqual({key:result[key] for key in filter_list}, test[case][1], case)
+        #WRITTEN VALUES ARE THE SAME AS BEFORE (1 / FRACTION / 0, NO FLOAT 1.0)
+        result_df = run_extractors_parallel(self.context_map, filter_list, 65)
+        result_df.to_csv(f'{self.run_path}/report.csv', header=True, index=False)
+        with open(f'{self.run_path}/report.csv') as f: written_rows = f.read().splitlines()
+        self.assertTrue(written_rows[0].startswith('receiving_lab_sample_id,processing_id,F1,F2,F3,'))
+        self.assertListEqual([row.split(',')[2:5] for row in written_rows[1:]], [['1', '0.5', '0.0']]*2)
+
+
+    def test_qc_info_extractor(self):
+        test = {
+            'Valid case|All QC reports':[{context:paths[0] for context, paths in self.qc_context_map.items()}, [1200, 1000, 0.95, 0.9, 97.5]],
+            'Valid case|No QC reports':[{}, [np.nan]*5],
+            'Valid case|Unreadable report':[{'fastp_report.json':f'{self.run_path}/missing.json'}, [np.nan]*5],
+        }
+        for case in test:
+            result = qc_info_extractor(test[case][0])
+            self.assertListEqual(list(result), qc_columns, case)
+            np.testing.assert_equal(list(result.values()), test[case][1], case)
+
+
+    def test_run_extractors_parallel(self):
+        result_df = run_extractors_parallel(self.context_map, {'F1':{'A1B'}, 'F2':{'A1B', 'C2D'}}, 65, qc_context_map=self.qc_context_map)
+        result_df = result_df.set_index('receiving_lab_sample_id').sort_index()
+        self.assertListEqual(result_df.index.tolist(), ['100001', '100002']) #sample without QC reports is kept
+        self.assertListEqual(result_df.loc['100001', qc_columns].tolist(), [1200, 1000, 0.95, 0.9, 97.5])
+        self.assertTrue(result_df.loc['100002', qc_columns].isna().all())
+        self.assertListEqual(result_df['TOTAL_READS'].tolist(), [1000, 1000])
+
+        #QC reports are optional
+        result_df = run_extractors_parallel(self.context_map, {'F1':{'A1B'}}, 65)
+        self.assertTrue(result_df[qc_columns].isna().all().all())
+
+
+if __name__ == "__main__":
+    unittest.main()
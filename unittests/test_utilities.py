@@ -1,6 +1,6 @@
-import unittest, pandas as pd, os, uuid
+import unittest, pandas as pd, os, uuid, gzip, re
 from shutil import rmtree
-from subscripts.covipipe_utilities import covipipe_housekeeper as hk
+from subscripts.covipipe_utilities import covipipe_housekeeper as hk, Rename_journal, Sample_id_map
 
 
 class test_housekeeper(unittest.TestCase):
@@ -163,6 +163,78 @@ class test_housekeeper(unittest.TestCase):
                     hk.map_new_column(test[case][0],test[case][1], test[case][2], test[case][3])
 
 
+    def test_map_illumina_names(self):
+        prefixes, suffixes = ['CO-[0-9]{5}_LVA[0-9]{3}_'], ['_lib[0-9]{6}']
+        test = {
+            'Valid case|Prefix and suffix removed':[
+                ['/data/CO-12345_LVA001_S1_lib123456_1.fastq.gz', '/data/CO-12345_LVA001_S1_lib123456_2.fastq.gz'],
+                {'/data/CO-12345_LVA001_S1_lib123456_1.fastq.gz':'/data/S1_R1_001.fastq.gz', '/data/CO-12345_LVA001_S1_lib123456_2.fastq.gz':'/data/S1_R2_001.fastq.gz'}
+                ],
+            'Valid case|No prefix or suffix in name':[
+                ['/data/sample_1.fastq.gz', '/data/sample_lib_2.fastq.gz'],
+                {'/data/sample_1.fastq.gz':'/data/sample_R1_001.fastq.gz', '/data/sample_lib_2.fastq.gz':'/data/sample_lib_R2_001.fastq.gz'}
+                ],
+            'Valid case|Patterns outside file name are kept':[
+                ['/CO-12345_LVA001_/CO-12345_LVA001_S1_1.fastq.gz'],
+                {'/CO-12345_LVA001_/CO-12345_LVA001_S1_1.fastq.gz':'/CO-12345_LVA001_/S1_R1_001.fastq.gz'}
+                ],
+            'Valid case|Illumina names are not mapped':[
+                ['/data/S1_R1_001.fastq.gz'],
+                {}
+                ],
+            'Valid case|Empty list':[
+                [],
+                {}
+                ],
+            'Exception|Non-string path':[
+                [1],
+                AttributeError
+                ],
+        }
+
+        for case in test:
+            if 'Exception' not in case:
+                forward_map, backward_map = hk.map_illumina_names(test[case][0], prefixes, suffixes)
+                self.assertDictEqual(forward_map, test[case][1])
+                self.assertDictEqual(backward_map, {new:old for old, new in test[case][1].items()})
+            else:
+                with self.assertRaises(test[case][1]):
+                    hk.map_illumina_names(test[case][0], prefixes, suffixes)
+
+
+    def test_bucket_by_sample_id(self):
+        test = {
+            'Valid case|Prefix ids':[
+                ['S1_consensus.fasta', 'S10_consensus.fasta', 'S1.ann.csv', 'S1_qualimap', 'multiqc_report.html', 'S100.vcf'],
+                ['S1', 'S10'],
+                {'S1_consensus.fasta':'S1', 'S10_consensus.fasta':'S10', 'S1.ann.csv':'S1', 'S1_qualimap':'S1'}
+                ],
+            'Valid case|Ids containing separators':[
+                ['a_b_consensus.fasta', 'a_consensus.fasta', 'a_b'],
+                ['a', 'a_b'],
+                {'a_b_consensus.fasta':'a_b', 'a_consensus.fasta':'a', 'a_b':'a_b'}
+                ],
+            'Valid case|No ids':[
+                ['S1_consensus.fasta'],
+                [],
+                {}
+                ],
+        }
+        for case in test:
+            self.assertDictEqual(hk.bucket_by_sample_id(test[case][0], test[case][1]), test[case][2])
+
+
+    def test_sample_id_map(self):
+        id_map = Sample_id_map.from_processing_ids(['a_S1', 'b_S22', 'c_S333'], ['COV000001', 'COV000002', 'COV000003'], re.compile(r"_S[0-9]{1,3}"))
+        self.assertDictEqual(id_map.forward, {'a_S1':'COV000001_a', 'b_S22':'COV000002_b', 'c_S333':'COV000003_c'})
+        self.assertDictEqual(id_map.backward, {'COV000001_a':'a_S1', 'COV000002_b':'b_S22', 'COV000003_c':'c_S333'})
+        sample_sheet = pd.DataFrame({'sample_id':['c_S333', 'a_S1'], 'fq1':['c1', 'a1']})
+        sample_sheet = hk.map_replace_column(sample_sheet, id_map.forward, 'sample_id', 'sample_id')
+        self.assertEqual(sample_sheet, pd.DataFrame({'sample_id':['COV000003_c', 'COV000001_a'], 'fq1':['c1', 'a1']})) #column keeps its position
+        sample_sheet['sample_id'] = id_map.translate(sample_sheet['sample_id'], reverse=True)
+        self.assertEqual(sample_sheet, pd.DataFrame({'sample_id':['c_S333', 'a_S1'], 'fq1':['c1', 'a1']}))
+
+
     #############################################################
     
     # Tests for methods that DO interact with the file system
@@ -206,6 +278,7 @@ class test_housekeeper(unittest.TestCase):
             [fls.append(os.path.join(root,fl)) for fl in files]
         try:
             self.assertTrue(all(list(hk.check_file_existance(fls).values())))
+            self.assertFalse(any(hk.check_file_existance([f'{root_name}middle1', f'{root_name}missing/file']).values())) #folders and files in missing folders
         except AssertionError as e:
             rmtree(root_name)
             raise e
@@ -217,6 +290,64 @@ class test_housekeeper(unittest.TestCase):
         
 
     
+    def test_check_fastq_integrity(self):
+        fname = './unittest_file.fastq.gz'
+        record = b'@read_1\nACGTN\n+\nFFFFF\n'
+        valid = gzip.compress(record*1000)
+        test = {
+            'Valid file':[valid, True],
+            'Valid multi-member file':[valid+gzip.compress(record), True],
+            'Valid file with small chunks':[valid, True, 7],
+            'Valid file with trailing empty lines':[gzip.compress(record*10+b'\n\n'), True],
+            'Valid file with trailing empty line and small chunks':[gzip.compress(record*10+b'\n'), True, 7],
+            'Empty line inside file':[gzip.compress(record*10+b'\n'+record), False],
+            'Empty line inside file with small chunks':[gzip.compress(record*10+b'\n\n'+record), False, 7],
+            'Truncated file':[valid[:len(valid)//2], False],
+            'Corrupted crc':[valid[:-8]+bytes([valid[-8]^255])+valid[-7:], False],
+            'Missing quality line':[gzip.compress(record*10+b'@read_2\nACGT\n+\n'), False],
+            'Quality length mismatch':[gzip.compress(record+b'@read_2\nACGT\n+\nFFF\n'), False],
+            'Empty file':[b'', False]
+        }
+        for case in test:
+            with open(fname, 'wb') as f: f.write(test[case][0])
+            try:
+                result = hk.check_fastq_integrity(fname, *test[case][2:])
+                self.assertEqual(result[0], test[case][1], f'{case}: {result[2]}')
+                self.assertEqual(result[1], fname)
+                os.remove(fname)
+            except AssertionError as e:
+                os.remove(fname)
+                raise e
+
+
+    def test_integrity_cache(self):
+        fname, cache = './unittest_file.fastq.gz', './unittest_file.cache'
+        test_housekeeper.create_test_file(fname, content='@read_1\nACGT\n+\nFFFF\n')
+        try:
+            #Missing cache
+            self.assertEqual(hk.read_integrity_cache(cache), {})
+
+            #Unchanged file is found in cache
+            fingerprint = hk.fastq_fingerprint(fname, hash_content=True)
+            hk.update_integrity_cache(cache, [fingerprint])
+            with open(cache, 'a') as f: f.write('{"path": "interrupted')
+            self.assertEqual(hk.read_integrity_cache(cache)[os.path.abspath(fname)], hk.fastq_fingerprint(fname, hash_content=True))
+
+            #Record appended after interrupted write is kept
+            hk.update_integrity_cache(cache, [dict(fingerprint, path='/other/file.fastq.gz')])
+            self.assertEqual(sorted(hk.read_integrity_cache(cache)), sorted([os.path.abspath(fname), '/other/file.fastq.gz']))
+
+            #Changed file is not matched by cached fingerprint
+            test_housekeeper.create_test_file(fname, content='@read_1\nACGT\n+\nFFFF\n@read_2\n')
+            self.assertNotEqual(hk.read_integrity_cache(cache)[os.path.abspath(fname)], hk.fastq_fingerprint(fname))
+            os.remove(fname)
+            os.remove(cache)
+        except AssertionError as e:
+            os.remove(fname)
+            os.remove(cache)
+            raise e
+
+
     def test_create_sample_sheet(self):
         root_name = './top/'
         #Fasta
@@ -249,6 +380,21 @@ class test_housekeeper(unittest.TestCase):
             rmtree(root_name)
             raise e
 
+        #Fastq, ids that are prefixes of other ids, unpaired file
+        fpaths = ['/a/S1_R1_001.fastq.gz', '/a/S10_R2_001.fastq.gz', '/a/S1_R2_001.fastq.gz', '/a/S10_R1_001.fastq.gz', '/a/S2_R1_001.fastq.gz']
+        true = pd.DataFrame.from_dict({'sample_id':['S1', 'S10'], 'fq1':['/a/S1_R1_001.fastq.gz', '/a/S10_R1_001.fastq.gz'], 'fq2':['/a/S1_R2_001.fastq.gz', '/a/S10_R2_001.fastq.gz']})
+        self.assertEqual(hk.create_sample_sheet(fpaths, generic_str=r'_R[1,2]_001.fastq.gz'), true)
+
+        #Fastq, read 2 file sorts before read 1 file by path
+        fpaths = ['/b/S1_R1_001.fastq.gz', '/a/S1_R2_001.fastq.gz']
+        true = pd.DataFrame.from_dict({'sample_id':['S1'], 'fq1':['/b/S1_R1_001.fastq.gz'], 'fq2':['/a/S1_R2_001.fastq.gz']})
+        self.assertEqual(hk.create_sample_sheet(fpaths, generic_str=r'_R[1,2]_001.fastq.gz'), true)
+
+        #Fastq, two read 1 files of the same sample in different folders are not paired
+        fpaths = ['/a/S1_R1_001.fastq.gz', '/b/S1_R1_001.fastq.gz', '/a/S2_R1_001.fastq.gz', '/a/S2_R2_001.fastq.gz', '/b/S3_R1_001.fastq.gz', '/b/S3_R1_001.fastq.gz', '/b/S3_R2_001.fastq.gz']
+        true = pd.DataFrame.from_dict({'sample_id':['S2', 'S3'], 'fq1':['/a/S2_R1_001.fastq.gz', '/b/S3_R1_001.fastq.gz'], 'fq2':['/a/S2_R2_001.fastq.gz', '/b/S3_R2_001.fastq.gz']})
+        self.assertEqual(hk.create_sample_sheet(fpaths, generic_str=r'_R[1,2]_001.fastq.gz'), true)
+
     
     def test_extract_log_id(self):
 
@@ -437,6 +583,19 @@ class test_housekeeper(unittest.TestCase):
             rmtree(root_name)
             raise e
 
+
+        #depth limit, parallel listing keeps order
+        _, apaths = test_housekeeper.create_nested_dir_struct(file_count=3,root_name=root_name, silent=False)
+        try:
+            self.assertListEqual(hk.parse_folder(root_name, file_fmt_str='fasta', max_depth=1), [])
+            self.assertListEqual(sorted(apaths), sorted(hk.parse_folder(root_name, file_fmt_str='fasta', max_depth=2)))
+            self.assertListEqual(hk.parse_folder(root_name, file_fmt_str='fasta'), hk.parse_folder(root_name, file_fmt_str='fasta', threads=4))
+            self.assertListEqual(hk.parse_folder(root_name, file_fmt_str='fasta'), list(hk.scan_folder(root_name, file_fmt_str='fasta')))
+            rmtree(root_name)
+        except Exception as e:
+            rmtree(root_name)
+            raise e
+
     
     def test_parse_snakemake_log(self):
         test = {
@@ -489,6 +648,92 @@ class test_housekeeper(unittest.TestCase):
                 with self.assertRaises(Exception):
                     raise Exception
 
+    def test_rename_files(self):
+        root_name = './top/'
+        os.makedirs(root_name, exist_ok=True)
+        path_map = {f'{root_name}{i}.txt':f'{root_name}{i}_renamed.txt' for i in range(10)}
+        for path in path_map: test_housekeeper.create_test_file(path)
+        path_map[f'{root_name}missing.txt'] = f'{root_name}missing_renamed.txt'
+        log_path = f'{root_name}rename.log'
+        try:
+            #Dry run does not change files
+            logs = hk.rename_files(path_map, log_path=log_path, dry_run=True, progress_bar=False)
+            self.assertTrue(all(record.endswith('DRY_RUN\n') for record in logs))
+            self.assertTrue(all(os.path.isfile(path) for path in list(path_map)[:-1]))
+
+            #Renaming, single log in path_map order
+            logs = hk.rename_files(path_map, log_path=log_path, progress_bar=False)
+            self.assertListEqual([record.split(" ")[2].strip() for record in logs], ['OK']*10+['FAILED'])
+            self.assertTrue(all(os.path.isfile(path) for path in list(path_map.values())[:-1]))
+            with open(log_path, 'r') as f: self.assertEqual(f.read(), "".join(logs))
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
+
+
+    def test_rename_journal(self):
+        root_name = './top/'
+        os.makedirs(root_name, exist_ok=True)
+        path_map = {f'{root_name}{i}.txt':f'{root_name}{i}_renamed.txt' for i in range(6)}
+        for path in path_map: test_housekeeper.create_test_file(path)
+        journal = Rename_journal(f'{root_name}rename_journal.log')
+        try:
+            #Interrupted step: journal begun, part of the files renamed, no commit
+            journal.begin('step_1', path_map, f'{root_name}step_1.log')
+            for old_path in list(path_map)[:3]: os.rename(old_path, path_map[old_path])
+            with open(journal.journal_path, 'a') as f: f.write('MOVE\tstep_1\tincomplete') #torn last line is ignored
+            steps = journal.recover()
+            self.assertListEqual(list(steps), ['step_1'])
+            self.assertTrue(all(os.path.isfile(path) for path in path_map.values()))
+            with open(f'{root_name}step_1.log', 'r') as f: statuses = [line.split(" ")[2].strip() for line in f]
+            self.assertListEqual(statuses, ['SKIPPED']*3+['OK']*3)
+            self.assertTrue(journal.read_steps()['step_1']['committed'])
+
+            #Committed steps are not replayed, closing removes journal
+            os.remove(f'{root_name}step_1.log')
+            self.assertTrue(journal.recover()['step_1']['committed'])
+            self.assertFalse(os.path.isfile(f'{root_name}step_1.log'))
+            journal.close()
+            self.assertFalse(os.path.isfile(journal.journal_path))
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
+
+
+    def test_stage_files(self):
+        root_name = './top/'
+        os.makedirs(f'{root_name}wd', exist_ok=True)
+        path_map = {f'{root_name}{i}.fastq.gz':f'{root_name}wd/{i}.fastq.gz' for i in range(4)}
+        for path in path_map: test_housekeeper.create_test_file(path, content=path)
+        test_housekeeper.create_test_file(path_map[f'{root_name}3.fastq.gz'], content='different file')
+        try:
+            staged = hk.stage_files(path_map)
+            self.assertListEqual(list(staged.values()), ['link']*3+['FAILED']) #same file system, existing different file is not changed
+            self.assertDictEqual(hk.stage_files({f'{root_name}0.fastq.gz':f'{root_name}wd/0.fastq.gz'}), {f'{root_name}wd/0.fastq.gz':'existing'})
+            with open(f'{root_name}wd/3.fastq.gz', 'r') as f: self.assertEqual(f.read(), 'different file')
+
+            #Unstaging removes staged files, input files are kept; staged file is moved back if input is missing
+            self.assertTrue(hk.unstage_file(f'{root_name}wd/0.fastq.gz', f'{root_name}0.fastq.gz'))
+            os.remove(f'{root_name}1.fastq.gz')
+            self.assertTrue(hk.unstage_file(f'{root_name}wd/1.fastq.gz', f'{root_name}1.fastq.gz'))
+            self.assertTrue(os.path.isfile(f'{root_name}0.fastq.gz') and os.path.isfile(f'{root_name}1.fastq.gz'))
+            self.assertFalse(os.path.exists(f'{root_name}wd/0.fastq.gz') or os.path.exists(f'{root_name}wd/1.fastq.gz'))
+
+            #File staged onto itself (working directory is the input directory) is never removed, its hardlink is
+            self.assertTrue(hk.is_same_path(f'{root_name}2.fastq.gz', f'top/wd/../2.fastq.gz'))
+            self.assertFalse(hk.is_same_path(f'{root_name}2.fastq.gz', f'{root_name}wd/2.fastq.gz')) #hardlink
+            self.assertTrue(hk.unstage_file(f'top/wd/../2.fastq.gz', f'{root_name}2.fastq.gz'))
+            self.assertTrue(os.path.isfile(f'{root_name}2.fastq.gz'))
+            self.assertTrue(hk.unstage_file(f'{root_name}wd/2.fastq.gz', f'{root_name}2.fastq.gz'))
+            self.assertFalse(os.path.exists(f'{root_name}wd/2.fastq.gz'))
+            rmtree(root_name)
+        except AssertionError as e:
+            rmtree(root_name)
+            raise e
+
+
     def test_rename_file(self):
         test = {
             'Valid input':[],